@@ -0,0 +1,655 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+矢量标注图层模块
+
+功能描述：
+- 以矢量对象保存文字、矩形、圆形、直线等标注
+- 标注保存在独立图层中，可单独修改或删除
+- 仅对发生变化的区域重新栅格化，并缓存叠加层
+- 导出时一次性合成到底图上
+- 缓存栅格化后的文字蒙版，重复的文字和水印只需一次贴图
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, fields, replace
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+
+# 边界框 (left, top, right, bottom)，right/bottom不包含在内
+Box = Tuple[int, int, int, int]
+
+
+@lru_cache(maxsize=32)
+def load_font(font_path: Optional[str], font_size: int) -> ImageFont.ImageFont:
+    """
+    加载字体
+
+    参数：
+        font_path: 字体文件路径，为None或不存在时使用系统默认字体
+        font_size: 字体大小
+
+    返回：
+        字体对象
+    """
+    try:
+        if font_path and os.path.exists(font_path):
+            return ImageFont.truetype(font_path, font_size)
+        # 尝试使用系统默认字体
+        return ImageFont.load_default()
+    except OSError:
+        return ImageFont.load_default()
+
+
+# 仅用于测量文字范围的绘图对象
+_SCRATCH_DRAW = ImageDraw.Draw(Image.new('L', (1, 1)))
+
+# 字体对象在多个会话之间共享，FreeType字体不能被多个线程同时使用
+_FONT_LOCK = threading.RLock()
+
+
+@lru_cache(maxsize=256)
+def _text_box(text: str, x: int, y: int, font_path: Optional[str], font_size: int) -> Box:
+    font = load_font(font_path, font_size)
+    with _FONT_LOCK:
+        left, top, right, bottom = _SCRATCH_DRAW.textbbox((x, y), text, font=font)
+    return (int(left) - 1, int(top) - 1, int(right) + 2, int(bottom) + 2)
+
+
+# 文字蒙版及其相对锚点的偏移
+Stamp = Tuple[Image.Image, Tuple[int, int]]
+
+# 文字蒙版缓存的默认字节数上限
+STAMP_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+class StampCache:
+    """文字蒙版缓存类
+
+    以(文字, 字体路径, 字号)为键缓存ImageDraw.text栅格化得到的L模式蒙版及其相对锚点的偏移，
+    超出字节预算时按最近最少使用淘汰。颜色在贴图时作为填充色使用，不同颜色共享同一蒙版。
+    所有操作都持有锁，多个会话可以同时使用。
+    """
+
+    def __init__(self, max_bytes: int = STAMP_CACHE_MAX_BYTES) -> None:
+        """
+        初始化文字蒙版缓存
+
+        参数：
+            max_bytes: 缓存总字节数上限，默认32MB
+
+        异常：
+            无
+        """
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[Tuple[str, Optional[str], int], Stamp]' = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text: str, font_path: Optional[str],
+            font_size: int) -> Stamp:
+        """
+        获取文字蒙版，未命中时栅格化并写入缓存
+
+        参数：
+            text: 文字内容
+            font_path: 字体文件路径
+            font_size: 字体大小
+
+        返回：
+            (蒙版, 偏移)，蒙版左上角位于锚点加偏移处
+        """
+        key = (text, font_path, font_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # 栅格化在缓存锁外进行，同一文字被并发首次使用时最多重复绘制一次
+        entry = _render_stamp(text, font_path, font_size)
+        size = entry[0].width * entry[0].height
+        if size > self.max_bytes:
+            return entry
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old[0].width * old[0].height
+            self._entries[key] = entry
+            self._total += size
+
+            while self._total > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._total -= evicted.width * evicted.height
+        return entry
+
+    def clear(self) -> None:
+        """
+        清空缓存
+        """
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存的使用情况
+
+        返回：
+            包含entries、bytes、max_bytes、hits、misses的字典
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def _render_stamp(text: str, font_path: Optional[str],
+                  font_size: int) -> Stamp:
+    # 在刚好容纳文字的L模式图像上以255绘制，得到的像素值即ImageDraw.text使用的蒙版
+    font = load_font(font_path, font_size)
+    with _FONT_LOCK:
+        left, top, right, bottom = (int(v) for v in _SCRATCH_DRAW.textbbox((0, 0), text, font=font))
+        stamp = Image.new('L', (max(0, right - left), max(0, bottom - top)), 0)
+        if stamp.width and stamp.height:
+            ImageDraw.Draw(stamp).text((-left, -top), text, fill=255, font=font)
+    return stamp, (left, top)
+
+
+_stamp_cache = StampCache()
+
+
+def get_stamp_cache() -> StampCache:
+    """
+    获取进程内共享的文字蒙版缓存
+
+    返回：
+        共享缓存
+    """
+    return _stamp_cache
+
+
+def union_boxes(a: Optional[Box], b: Optional[Box]) -> Optional[Box]:
+    """
+    合并两个边界框
+
+    参数：
+        a: 边界框，可为None
+        b: 边界框，可为None
+
+    返回：
+        同时包含两者的最小边界框，两者均为None时返回None
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def clip_box(box: Box, size: Tuple[int, int]) -> Optional[Box]:
+    """
+    将边界框裁剪到图像范围内
+
+    参数：
+        box: 边界框
+        size: 图像尺寸 (width, height)
+
+    返回：
+        裁剪后的边界框，与图像无交集时返回None
+    """
+    left = max(0, box[0])
+    top = max(0, box[1])
+    right = min(size[0], box[2])
+    bottom = min(size[1], box[3])
+    if left >= right or top >= bottom:
+        return None
+    return (left, top, right, bottom)
+
+
+# 没有透明通道的底图模式。直接在这些模式上绘制时颜色的透明度被忽略，
+# 叠加层按不透明颜色绘制以保持相同的结果；带透明通道的底图按透明度混合
+OPAQUE_MODES = ('RGB', 'L')
+
+
+def is_opaque(base: Image.Image) -> bool:
+    """
+    判断底图是否没有透明度
+
+    参数：
+        base: 底图
+
+    返回：
+        RGB、L模式，或调色板没有透明色的P模式时返回True
+    """
+    if base.mode in OPAQUE_MODES:
+        return True
+    return base.mode == 'P' and 'transparency' not in base.info
+
+
+def composite_overlay(base: Image.Image, overlay: Image.Image) -> Image.Image:
+    """
+    将RGBA叠加层合成到同尺寸的底图上
+
+    参数：
+        base: 底图
+        overlay: 与底图同尺寸的RGBA叠加层
+
+    返回：
+        合成后的新图像。RGB、L、LA模式的底图保持原模式；调色板没有透明色的P模式输出RGB，
+        有透明色时输出RGBA；其他模式输出RGBA
+    """
+    result = base.convert('RGBA')
+    result.alpha_composite(overlay)
+    if base.mode in ('RGB', 'L', 'LA'):
+        result = result.convert(base.mode)
+    elif is_opaque(base):
+        result = result.convert('RGB')
+    return result
+
+
+def _check_colors(*colors: Optional[str]) -> None:
+    # 在创建标注时校验颜色，避免错误延迟到导出时才暴露
+    for color in colors:
+        if color is not None:
+            ImageColor.getrgb(color)
+
+
+# 标注中保存颜色的字段
+_COLOR_FIELDS = ('color', 'outline_color', 'fill_color')
+
+
+def _opaque_color(color: str) -> str:
+    return '#%02x%02x%02x' % ImageColor.getrgb(color)[:3]
+
+
+def _factors(factor_x: float, factor_y: Optional[float]) -> Tuple[float, float, float]:
+    # 返回(X比例, Y比例, 用于尺寸的几何平均比例)
+    if factor_y is None:
+        factor_y = factor_x
+    return factor_x, factor_y, math.sqrt(factor_x * factor_y)
+
+
+def _scaled_width(width: int, factor: float) -> int:
+    # 线宽缩放后至少保留1像素，0表示不绘制轮廓，保持不变
+    return max(1, round(width * factor)) if width > 0 else width
+
+
+def _intersects(a: Box, b: Box) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+@dataclass(frozen=True)
+class Annotation:
+    """标注基类
+
+    标注对象不可变，修改标注即用新对象替换旧对象，
+    因此历史记录可以直接共享标注对象而无需复制。
+    """
+
+    annotation_id: int
+
+    kind = 'annotation'
+
+    def bounding_box(self) -> Box:
+        """
+        计算标注覆盖的像素范围
+
+        返回：
+            保守的边界框，保证标注绘制的所有像素都在其中
+        """
+        raise NotImplementedError
+
+    def render(self, draw: ImageDraw.ImageDraw, dx: int = 0, dy: int = 0) -> None:
+        """
+        将标注绘制到绘图对象上
+
+        参数：
+            draw: 目标绘图对象
+            dx: X方向偏移量，用于在局部区域图像上绘制
+            dy: Y方向偏移量
+        """
+        raise NotImplementedError
+
+    def opaque(self) -> 'Annotation':
+        """
+        去掉颜色中的透明度
+
+        返回：
+            颜色均为不透明的副本，颜色本来就不透明时返回自身
+        """
+        changes = {f.name: _opaque_color(getattr(self, f.name)) for f in fields(self)
+                   if f.name in _COLOR_FIELDS and getattr(self, f.name) is not None}
+        if all(getattr(self, name) == value for name, value in changes.items()):
+            return self
+        return replace(self, **changes)
+
+    def scaled(self, factor_x: float, factor_y: Optional[float] = None) -> 'Annotation':
+        """
+        按比例缩放坐标、尺寸和线宽
+
+        用于把在缩小的工作副本上绘制的标注映射回原始分辨率。
+        坐标按各自方向的比例缩放，字号、半径和线宽按两者的几何平均缩放。
+        注意：未指定字体文件或字体加载失败时，load_font()使用ImageFont.load_default()，
+        其字号固定、不随font_size变化，因此缩放对这类文字的大小没有作用，
+        原始分辨率输出中的文字相对图像会变小。
+
+        参数：
+            factor_x: X方向缩放比例
+            factor_y: Y方向缩放比例，为None时与X方向相同
+
+        返回：
+            缩放后的新标注，ID不变
+        """
+        raise NotImplementedError
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        转换为字典，便于以JSON形式返回给前端
+
+        返回：
+            包含标注类型和全部参数的字典
+        """
+        result = asdict(self)
+        result['type'] = self.kind
+        return result
+
+
+@dataclass(frozen=True)
+class TextAnnotation(Annotation):
+    """文字标注
+
+    blend为True时，RGB、L模式的底图上也保留颜色的透明度，按透明度与底图混合，
+    用于半透明水印等需要透出底图的文字。
+    """
+
+    text: str = ''
+    x: int = 0
+    y: int = 0
+    font_size: int = 24
+    color: str = 'black'
+    font_path: Optional[str] = None
+    blend: bool = False
+
+    kind = 'text'
+
+    def __post_init__(self) -> None:
+        _check_colors(self.color)
+
+    def opaque(self) -> 'TextAnnotation':
+        if self.blend:
+            return self
+        return super().opaque()
+
+    def bounding_box(self) -> Box:
+        return _text_box(self.text, self.x, self.y, self.font_path, self.font_size)
+
+    def render(self, draw: ImageDraw.ImageDraw, dx: int = 0, dy: int = 0) -> None:
+        stamp, (left, top) = _stamp_cache.get(self.text, self.font_path, self.font_size)
+        if stamp.width and stamp.height:
+            draw.bitmap((self.x + dx + left, self.y + dy + top), stamp, fill=self.color)
+
+    def scaled(self, factor_x: float, factor_y: Optional[float] = None) -> 'TextAnnotation':
+        factor_x, factor_y, factor = _factors(factor_x, factor_y)
+        return replace(self, x=round(self.x * factor_x), y=round(self.y * factor_y),
+                       font_size=max(1, round(self.font_size * factor)))
+
+
+@dataclass(frozen=True)
+class RectangleAnnotation(Annotation):
+    """矩形标注"""
+
+    x1: int = 0
+    y1: int = 0
+    x2: int = 100
+    y2: int = 100
+    outline_color: str = 'black'
+    fill_color: Optional[str] = None
+    width: int = 2
+
+    kind = 'rectangle'
+
+    def __post_init__(self) -> None:
+        if self.x2 < self.x1 or self.y2 < self.y1:
+            raise ValueError("矩形右下角坐标必须不小于左上角坐标")
+        _check_colors(self.outline_color, self.fill_color)
+
+    def bounding_box(self) -> Box:
+        return (self.x1, self.y1, self.x2 + 1, self.y2 + 1)
+
+    def render(self, draw: ImageDraw.ImageDraw, dx: int = 0, dy: int = 0) -> None:
+        draw.rectangle([self.x1 + dx, self.y1 + dy, self.x2 + dx, self.y2 + dy],
+                       outline=self.outline_color, fill=self.fill_color, width=self.width)
+
+    def scaled(self, factor_x: float, factor_y: Optional[float] = None) -> 'RectangleAnnotation':
+        factor_x, factor_y, factor = _factors(factor_x, factor_y)
+        return replace(self, x1=round(self.x1 * factor_x), y1=round(self.y1 * factor_y),
+                       x2=round(self.x2 * factor_x), y2=round(self.y2 * factor_y),
+                       width=_scaled_width(self.width, factor))
+
+
+@dataclass(frozen=True)
+class CircleAnnotation(Annotation):
+    """圆形标注"""
+
+    x: int = 50
+    y: int = 50
+    radius: int = 25
+    outline_color: str = 'black'
+    fill_color: Optional[str] = None
+    width: int = 2
+
+    kind = 'circle'
+
+    def __post_init__(self) -> None:
+        if self.radius < 0:
+            raise ValueError("圆的半径不能为负数")
+        _check_colors(self.outline_color, self.fill_color)
+
+    def bounding_box(self) -> Box:
+        return (self.x - self.radius, self.y - self.radius,
+                self.x + self.radius + 1, self.y + self.radius + 1)
+
+    def render(self, draw: ImageDraw.ImageDraw, dx: int = 0, dy: int = 0) -> None:
+        x, y, r = self.x + dx, self.y + dy, self.radius
+        draw.ellipse([x - r, y - r, x + r, y + r],
+                     outline=self.outline_color, fill=self.fill_color, width=self.width)
+
+    def scaled(self, factor_x: float, factor_y: Optional[float] = None) -> 'CircleAnnotation':
+        factor_x, factor_y, factor = _factors(factor_x, factor_y)
+        return replace(self, x=round(self.x * factor_x), y=round(self.y * factor_y),
+                       radius=round(self.radius * factor), width=_scaled_width(self.width, factor))
+
+
+@dataclass(frozen=True)
+class LineAnnotation(Annotation):
+    """直线标注"""
+
+    x1: int = 0
+    y1: int = 0
+    x2: int = 100
+    y2: int = 100
+    color: str = 'black'
+    width: int = 2
+
+    kind = 'line'
+
+    def __post_init__(self) -> None:
+        _check_colors(self.color)
+
+    def bounding_box(self) -> Box:
+        # 宽线条按多边形绘制，向四周各扩展线宽作为余量
+        pad = max(1, self.width)
+        return (min(self.x1, self.x2) - pad, min(self.y1, self.y2) - pad,
+                max(self.x1, self.x2) + pad + 1, max(self.y1, self.y2) + pad + 1)
+
+    def render(self, draw: ImageDraw.ImageDraw, dx: int = 0, dy: int = 0) -> None:
+        draw.line([self.x1 + dx, self.y1 + dy, self.x2 + dx, self.y2 + dy],
+                  fill=self.color, width=self.width)
+
+    def scaled(self, factor_x: float, factor_y: Optional[float] = None) -> 'LineAnnotation':
+        factor_x, factor_y, factor = _factors(factor_x, factor_y)
+        return replace(self, x1=round(self.x1 * factor_x), y1=round(self.y1 * factor_y),
+                       x2=round(self.x2 * factor_x), y2=round(self.y2 * factor_y),
+                       width=_scaled_width(self.width, factor))
+
+
+class AnnotationLayer:
+    """标注图层类
+
+    保存当前的标注列表，并维护一张与底图同尺寸的RGBA叠加层缓存。
+    标注列表变化时只记录脏区域，叠加层在需要时才按脏区域重新绘制。
+    """
+
+    def __init__(self) -> None:
+        """
+        初始化标注图层
+        """
+        self.annotations: Tuple[Annotation, ...] = ()
+        self._overlay: Optional[Image.Image] = None
+        self._opaque = False
+        self._dirty: List[Box] = []
+
+    def set_annotations(self, annotations: Tuple[Annotation, ...]) -> Optional[Box]:
+        """
+        替换标注列表
+
+        通过比较新旧列表中的标注对象找出增删改的标注，并将其范围标记为脏区域。
+
+        参数：
+            annotations: 新的标注元组
+
+        返回：
+            本次变化涉及的边界框，无变化时返回None
+        """
+        old_ids = {id(a) for a in self.annotations}
+        new_ids = {id(a) for a in annotations}
+
+        boxes = [a.bounding_box() for a in self.annotations if id(a) not in new_ids]
+        boxes += [a.bounding_box() for a in annotations if id(a) not in old_ids]
+
+        # 仅顺序变化时也需要重绘
+        if not boxes and [id(a) for a in annotations] != [id(a) for a in self.annotations]:
+            boxes = [a.bounding_box() for a in annotations]
+
+        self.annotations = tuple(annotations)
+        self._dirty.extend(boxes)
+
+        changed: Optional[Box] = None
+        for box in boxes:
+            changed = union_boxes(changed, box)
+        return changed
+
+    def find(self, annotation_id: int) -> Optional[Annotation]:
+        """
+        按ID查找标注
+
+        参数：
+            annotation_id: 标注ID
+
+        返回：
+            标注对象，不存在时返回None
+        """
+        for annotation in self.annotations:
+            if annotation.annotation_id == annotation_id:
+                return annotation
+        return None
+
+    def overlay(self, size: Tuple[int, int], opaque: bool = False) -> Image.Image:
+        """
+        获取叠加层
+
+        只重新绘制脏区域：先清空该区域，再把与之相交的标注按顺序绘制上去。
+
+        参数：
+            size: 底图尺寸 (width, height)
+            opaque: 是否忽略颜色的透明度，底图没有透明度（见is_opaque()）时使用
+
+        返回：
+            与底图同尺寸的RGBA叠加层
+        """
+        if self._overlay is None or self._overlay.size != size or self._opaque != opaque:
+            self._overlay = Image.new('RGBA', size, (0, 0, 0, 0))
+            self._opaque = opaque
+            self._dirty = [a.bounding_box() for a in self.annotations]
+
+        for box in self._dirty:
+            region_box = clip_box(box, size)
+            if region_box is None:
+                continue
+            self._overlay.paste(self.render_region(region_box, opaque), region_box[:2])
+
+        self._dirty = []
+        return self._overlay
+
+    def render_region(self, box: Box, opaque: bool = False) -> Image.Image:
+        """
+        绘制指定区域内的标注
+
+        参数：
+            box: 区域边界框
+            opaque: 是否忽略颜色的透明度
+
+        返回：
+            区域大小的RGBA图像，未被标注覆盖的像素为透明
+        """
+        region = Image.new('RGBA', (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(region)
+        for annotation in self.annotations:
+            if _intersects(annotation.bounding_box(), box):
+                if opaque:
+                    annotation = annotation.opaque()
+                annotation.render(draw, -box[0], -box[1])
+        return region
+
+    def composite_region(self, base: Image.Image, box: Box) -> Image.Image:
+        """
+        合成底图指定区域及其上的标注
+
+        参数：
+            base: 底图
+            box: 区域边界框，需位于底图范围内
+
+        返回：
+            区域大小的合成图像，模式规则与composite()相同
+        """
+        region = base.crop(box)
+        if not self.annotations:
+            return region
+
+        return composite_overlay(region, self.overlay(base.size, is_opaque(base)).crop(box))
+
+    def composite(self, base: Image.Image) -> Image.Image:
+        """
+        将标注合成到底图上
+
+        RGB、L模式以及调色板没有透明色的P模式底图上颜色的透明度被忽略，
+        与直接在底图上绘制的结果一致；带透明度的底图上半透明颜色按透明度与底图混合。
+
+        参数：
+            base: 底图
+
+        返回：
+            合成后的新图像；没有标注时直接返回底图。模式规则与composite_overlay()相同。
+        """
+        if not self.annotations:
+            return base
+
+        return composite_overlay(base, self.overlay(base.size, is_opaque(base)))
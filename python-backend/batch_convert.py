@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件夹批量转换模块
+
+功能描述：
+- 按ImageProcessor的保存逻辑批量转换或重新编码文件夹中的截图，如BMP/PNG转为优化的PNG或JPEG
+- 三段流水线：读取线程读入文件字节，处理线程解码、加水印和编码，写入线程原子写出
+- 各段之间以有界队列连接，同时在内存中的图像数量固定，与文件夹大小无关
+- 每写完一个文件在清单中追加一行，中断后重新运行时跳过已完成且源文件未变化的图像
+- 输出各段的吞吐量报告（图像/秒、MB/秒）和忙碌比例，用于判断瓶颈所在
+
+用法：
+    python batch_convert.py screenshots converted --format JPEG --quality 85 --recursive
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Callable, Iterator, List, Set
+
+import tracing
+from annotation_layer import get_stamp_cache
+from derived_cache import DerivedCache
+from image_processor import DEFAULT_MEMORY_BUDGET, ImageProcessor
+from parallel_ops import worker_count
+from save_queue import atomic_write_bytes
+
+
+# 输出目录中的清单文件名
+MANIFEST_NAME = '.batch_manifest.jsonl'
+
+# 作为输入的文件扩展名
+INPUT_EXTENSIONS = ('.png', '.bmp', '.jpg', '.jpeg', '.gif', '.tif', '.tiff', '.webp')
+
+# 输出格式对应的文件扩展名
+FORMAT_EXTENSIONS = {
+    'PNG': '.png', 'JPEG': '.jpg', 'JPG': '.jpg', 'WEBP': '.webp',
+    'BMP': '.bmp', 'GIF': '.gif', 'TIFF': '.tif'
+}
+
+# 水印与图像右下角的距离（像素）
+WATERMARK_MARGIN = 10
+
+_MB = 1024 * 1024
+
+# 队列结束标记，每个线程消费一个
+_DONE = object()
+
+
+@dataclass(frozen=True)
+class ConvertJob:
+    """单个图像的转换任务"""
+    source: str
+    relative: str
+    output: str
+    size: int
+    mtime_ns: int
+
+
+class StageStats:
+    """流水线单段的统计
+
+    busy只计处理时间，不含在队列上等待的时间，
+    因此busy接近threads * 总时长的一段就是瓶颈。
+    """
+
+    def __init__(self, name: str, threads: int) -> None:
+        """
+        初始化统计
+
+        参数：
+            name: 段名称
+            threads: 该段的线程数
+        """
+        self.name = name
+        self.threads = threads
+        self.images = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, size: int, seconds: float) -> None:
+        """
+        记录一个已处理的图像
+
+        参数：
+            size: 处理的字节数
+            seconds: 处理耗时
+        """
+        with self._lock:
+            self.images += 1
+            self.bytes += size
+            self.busy += seconds
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        """
+        生成该段的吞吐量报告
+
+        images_per_second和mb_per_second为按忙碌时间计算的处理能力，
+        即输入充足时该段全部线程能达到的吞吐量。
+
+        参数：
+            elapsed: 流水线总时长（秒）
+
+        返回：
+            包含threads、images、megabytes、busy_seconds、images_per_second、
+            mb_per_second、utilization的字典
+        """
+        with self._lock:
+            rate = self.threads / self.busy if self.busy > 0 else 0.0
+            return {
+                'threads': self.threads,
+                'images': self.images,
+                'megabytes': round(self.bytes / _MB, 3),
+                'busy_seconds': round(self.busy, 3),
+                'images_per_second': round(self.images * rate, 1),
+                'mb_per_second': round(self.bytes / _MB * rate, 2),
+                'utilization': round(self.busy / (self.threads * elapsed), 3) if elapsed > 0 else 0.0,
+            }
+
+
+class Manifest:
+    """转换清单类
+
+    JSON Lines格式，每写完一个输出文件追加一行。输出文件先于清单行落盘，
+    因此清单中记录的图像一定已完整写出；中断时写了一半的最后一行在读取时忽略。
+    """
+
+    def __init__(self, path: str, resume: bool = True) -> None:
+        """
+        打开清单
+
+        参数：
+            path: 清单文件路径
+            resume: 是否读取已有条目，为False时清空清单
+
+        异常：
+            OSError: 当清单文件无法打开时抛出
+        """
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['source']] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def is_done(self, job: ConvertJob, settings: str) -> bool:
+        """
+        检查图像是否已按相同设置转换且源文件未变化
+
+        参数：
+            job: 转换任务
+            settings: 规范化的转换设置
+
+        返回：
+            是否可以跳过
+        """
+        entry = self.entries.get(job.relative)
+        return (entry is not None and entry.get('size') == job.size
+                and entry.get('mtime_ns') == job.mtime_ns and entry.get('settings') == settings
+                and entry.get('output') == os.path.basename(job.output)
+                and os.path.exists(job.output))
+
+    def record(self, job: ConvertJob, settings: str, output_bytes: int) -> None:
+        """
+        追加一条已完成的记录
+
+        输出文件已由atomic_write_bytes刷新到磁盘；清单行只刷新到操作系统，
+        断电丢失的记录只会导致对应图像重新转换。
+
+        参数：
+            job: 转换任务
+            settings: 规范化的转换设置
+            output_bytes: 输出文件字节数
+        """
+        entry = {'source': job.relative, 'output': os.path.basename(job.output), 'size': job.size,
+                 'mtime_ns': job.mtime_ns, 'settings': settings, 'bytes': output_bytes}
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        """
+        关闭清单文件
+        """
+        with self._lock:
+            self._file.close()
+
+
+class BatchConverter:
+    """文件夹批量转换类
+
+    读取、处理、写入三段各有独立的线程，段与段之间的队列容量为queue_size，
+    同时在内存中的图像最多为2 * queue_size加上各段线程数。
+    处理线程不属于共享线程池，目标大小模式下可以在共享线程池中并行评估候选质量。
+    """
+
+    def __init__(self, format: str = 'PNG', quality: int = 95, max_bytes: Optional[int] = None,
+                 readers: int = 2, workers: Optional[int] = None, writers: int = 2,
+                 queue_size: Optional[int] = None, recursive: bool = False, resume: bool = True,
+                 watermark: Optional[str] = None, watermark_size: int = 24,
+                 watermark_color: str = '#ffffffa0',
+                 memory_budget: Optional[int] = DEFAULT_MEMORY_BUDGET) -> None:
+        """
+        初始化批量转换
+
+        参数：
+            format: 输出格式（PNG、JPEG、WEBP、BMP、GIF、TIFF）
+            quality: 图像质量，仅对JPEG和WebP格式有效；目标大小模式下为允许的最高质量
+            max_bytes: 每个输出文件的大小上限（字节），为None时不限制
+            readers: 读取线程数
+            workers: 处理线程数，为None时等于CPU核心数
+            writers: 写入线程数
+            queue_size: 段间队列容量，为None时为处理线程数的2倍
+            recursive: 是否处理子目录，输出保持相同的目录结构
+            resume: 是否按清单跳过已完成的图像
+            watermark: 加在右下角的水印文字，为None时不加
+            watermark_size: 水印字号（按原始分辨率）
+            watermark_color: 水印颜色，可带透明度，在不透明图像上也按透明度混合
+            memory_budget: 每个图像解码后的字节数上限，超出时按缩小副本处理、原始分辨率输出
+
+        异常：
+            ValueError: 当格式不支持或线程数无效时抛出
+        """
+        if format.upper() not in FORMAT_EXTENSIONS:
+            raise ValueError(f"不支持的输出格式: {format}")
+        workers = workers or worker_count()
+        if min(readers, workers, writers) < 1:
+            raise ValueError(f"线程数无效: 读取{readers}, 处理{workers}, 写入{writers}")
+
+        self.format = format.upper()
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.readers = readers
+        self.workers = workers
+        self.writers = writers
+        self.queue_size = queue_size or 2 * workers
+        self.recursive = recursive
+        self.resume = resume
+        self.watermark = watermark
+        self.watermark_size = watermark_size
+        self.watermark_color = watermark_color
+        self.memory_budget = memory_budget
+        # 设置变化时清单中的旧记录不再匹配，图像会重新转换
+        self.settings = json.dumps({
+            'format': self.format, 'quality': quality, 'max_bytes': max_bytes,
+            'watermark': watermark, 'watermark_size': watermark_size,
+            'watermark_color': watermark_color, 'memory_budget': memory_budget
+        }, sort_keys=True)
+
+    def run(self, source_dir: str, output_dir: str) -> Dict[str, Any]:
+        """
+        转换文件夹中的全部图像
+
+        单个图像失败时记录错误并继续，失败的图像不写入清单，下次运行时重试。
+
+        参数：
+            source_dir: 输入目录
+            output_dir: 输出目录，不存在时自动创建，不能与输入目录相同
+
+        返回：
+            转换报告，包含found、converted、skipped、failed、seconds、images_per_second、
+            stages（read、process、write三段的吞吐量）、bottleneck（忙碌比例最高的段，
+            没有转换图像时为None）和errors
+
+        异常：
+            ValueError: 当输入目录不存在或与输出目录相同时抛出
+            OSError: 当输出目录或清单无法创建时抛出
+        """
+        if not os.path.isdir(source_dir):
+            raise ValueError(f"输入目录不存在: {source_dir}")
+        if os.path.realpath(source_dir) == os.path.realpath(output_dir):
+            raise ValueError("输出目录不能与输入目录相同")
+        os.makedirs(output_dir, exist_ok=True)
+
+        manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME), self.resume)
+        stats = {
+            'read': StageStats('read', self.readers),
+            'process': StageStats('process', self.workers),
+            'write': StageStats('write', self.writers),
+        }
+        counts = {'found': 0, 'skipped': 0}
+        errors: List[Dict[str, str]] = []
+        errors_lock = threading.Lock()
+
+        def fail(job: ConvertJob, error: Exception) -> None:
+            print(f"转换失败: {job.source}: {error}", file=sys.stderr)
+            with errors_lock:
+                errors.append({'source': job.relative, 'error': str(error)})
+
+        jobs: 'queue.Queue[Any]' = queue.Queue(maxsize=self.queue_size)
+        loaded: 'queue.Queue[Any]' = queue.Queue(maxsize=self.queue_size)
+        encoded: 'queue.Queue[Any]' = queue.Queue(maxsize=self.queue_size)
+
+        def read(job: ConvertJob) -> bytes:
+            with tracing.span('batch.read', 'io', path=job.relative):
+                with open(job.source, 'rb') as f:
+                    return f.read()
+
+        def write(job: ConvertJob, data: bytes) -> None:
+            with tracing.span('batch.write', 'io', path=job.relative):
+                os.makedirs(os.path.dirname(job.output), exist_ok=True)
+                atomic_write_bytes(job.output, data)
+            manifest.record(job, self.settings, len(data))
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._scan_into, name='batch-scan',
+                                    args=(source_dir, output_dir, manifest, jobs, counts),
+                                    daemon=True)]
+        threads += self._stage(stats['read'], jobs, loaded, self.workers,
+                               lambda job, _: read(job), fail)
+        threads += self._stage(stats['process'], loaded, encoded, self.writers,
+                               self._convert, fail)
+        threads += self._stage(stats['write'], encoded, None, 0, write, fail)
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            manifest.close()
+        elapsed = time.perf_counter() - started
+
+        stages = {name: stage.report(elapsed) for name, stage in stats.items()}
+        converted = stats['write'].images
+        return {
+            'found': counts['found'],
+            'converted': converted,
+            'skipped': counts['skipped'],
+            'failed': len(errors),
+            'seconds': round(elapsed, 3),
+            'images_per_second': round(converted / elapsed, 1) if elapsed > 0 else 0.0,
+            'mb_per_second': round(stats['read'].bytes / _MB / elapsed, 2) if elapsed > 0 else 0.0,
+            'stages': stages,
+            'bottleneck': (max(stages, key=lambda name: stages[name]['utilization'])
+                           if converted else None),
+            'errors': errors,
+        }
+
+    def _scan_into(self, source_dir: str, output_dir: str, manifest: Manifest,
+                   jobs: 'queue.Queue[Any]', counts: Dict[str, int]) -> None:
+        """
+        扫描输入目录，把需要转换的图像放入队列，结束后为每个读取线程放入结束标记
+
+        参数：
+            source_dir: 输入目录
+            output_dir: 输出目录
+            manifest: 转换清单
+            jobs: 读取段的输入队列
+            counts: 累计found和skipped
+        """
+        try:
+            for job in self._scan(source_dir, output_dir):
+                counts['found'] += 1
+                if self.resume and manifest.is_done(job, self.settings):
+                    counts['skipped'] += 1
+                    continue
+                jobs.put((job, None))
+        except OSError as e:
+            print(f"扫描输入目录失败: {e}", file=sys.stderr)
+        finally:
+            for _ in range(self.readers):
+                jobs.put(_DONE)
+
+    def _scan(self, source_dir: str, output_dir: str) -> Iterator[ConvertJob]:
+        """
+        按文件名顺序逐个列出输入图像
+
+        输出目录位于输入目录内时不进入输出目录。扩展名不同但主文件名相同的输入
+        （如a.png与a.bmp）会映射到同一输出文件，后者的输出文件名附加原扩展名。
+
+        参数：
+            source_dir: 输入目录
+            output_dir: 输出目录
+
+        返回：
+            转换任务的迭代器
+        """
+        extension = FORMAT_EXTENSIONS[self.format]
+        skip_dir = os.path.realpath(output_dir)
+        outputs: Set[str] = set()
+        for directory, dirnames, filenames in os.walk(source_dir):
+            if self.recursive:
+                dirnames[:] = sorted(d for d in dirnames
+                                     if os.path.realpath(os.path.join(directory, d)) != skip_dir)
+            else:
+                dirnames[:] = []
+            for filename in sorted(filenames):
+                stem, source_extension = os.path.splitext(filename)
+                if source_extension.lower() not in INPUT_EXTENSIONS:
+                    continue
+                source = os.path.join(directory, filename)
+                relative = os.path.relpath(source, source_dir)
+                output_relative = os.path.join(os.path.dirname(relative), stem + extension)
+                if output_relative in outputs:
+                    output_relative = os.path.join(
+                        os.path.dirname(relative), f"{stem}_{source_extension[1:].lower()}{extension}")
+                outputs.add(output_relative)
+                stat = os.stat(source)
+                yield ConvertJob(source, relative, os.path.join(output_dir, output_relative),
+                                 stat.st_size, stat.st_mtime_ns)
+
+    def _stage(self, stats: StageStats, inbox: 'queue.Queue[Any]',
+               outbox: Optional['queue.Queue[Any]'], downstream: int,
+               func: Callable[[ConvertJob, Any], Any],
+               fail: Callable[[ConvertJob, Exception], None]) -> List[threading.Thread]:
+        """
+        创建流水线中一段的线程
+
+        每个线程从inbox取出(任务, 数据)，处理后把(任务, 结果)放入outbox。
+        最后一个收到结束标记的线程为下游的每个线程放入结束标记。
+
+        参数：
+            stats: 该段的统计，线程数取自stats.threads
+            inbox: 输入队列
+            outbox: 输出队列，为None时是最后一段
+            downstream: 下游线程数
+            func: 处理函数，参数为(任务, 数据)
+            fail: 处理失败时的回调
+
+        返回：
+            未启动的线程列表
+        """
+        remaining = [stats.threads]
+        lock = threading.Lock()
+
+        def work() -> None:
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    with lock:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last and outbox is not None:
+                        for _ in range(downstream):
+                            outbox.put(_DONE)
+                    return
+
+                job, data = item
+                begin = time.perf_counter()
+                try:
+                    result = func(job, data)
+                except Exception as e:
+                    fail(job, e)
+                    continue
+                # 读取段按读入的字节计，其余按输入的字节计
+                stats.add(len(result if data is None else data), time.perf_counter() - begin)
+                del data, item
+                if outbox is not None:
+                    outbox.put((job, result))
+
+        return [threading.Thread(target=work, name=f'batch-{stats.name}-{i}', daemon=True)
+                for i in range(stats.threads)]
+
+    def _convert(self, job: ConvertJob, data: bytes) -> bytes:
+        """
+        解码、加水印并编码一个图像
+
+        参数：
+            job: 转换任务
+            data: 源文件字节
+
+        返回：
+            输出文件字节
+
+        异常：
+            ValueError: 当图像无法解码或编码时抛出
+        """
+        # 每个图像只编码一次，不需要派生数据缓存，避免占用进程内共享缓存
+        processor = ImageProcessor(max_history=1, derived_cache=DerivedCache(0),
+                                   memory_budget=self.memory_budget)
+        with tracing.span('batch.process', 'op', path=job.relative):
+            if not processor.load_from_bytes(data):
+                raise ValueError(f"无法解码图像: {processor.load_error}")
+            if self.watermark:
+                self._add_watermark(processor)
+            output = processor.to_bytes(self.format, self.quality, self.max_bytes)
+        if output is None:
+            raise ValueError(f"无法编码为{self.format}")
+        return output
+
+    def _add_watermark(self, processor: ImageProcessor) -> None:
+        """
+        在图像右下角添加水印文字
+
+        文字尺寸取自共享的文字蒙版缓存，测量与后续绘制只栅格化一次。
+        水印按颜色的透明度与图像混合，RGB、JPEG等不透明图像上同样半透明。
+        工作图像为缩小副本时按比例缩小字号和边距，输出时还原为原始分辨率下的大小。
+
+        参数：
+            processor: 已加载图像的处理器
+        """
+        scale = (processor.load_notice or {}).get('scale', 1.0)
+        font_size = max(1, round(self.watermark_size / scale))
+        margin = round(WATERMARK_MARGIN / scale)
+        stamp, (left, top) = get_stamp_cache().get(self.watermark, None, font_size)
+        x = processor.image.width - margin - left - stamp.width
+        y = processor.image.height - margin - top - stamp.height
+        processor.add_text(self.watermark, x, y, font_size, self.watermark_color, blend=True)
+
+
+def main() -> None:
+    """
+    命令行入口
+    """
+    parser = argparse.ArgumentParser(description='文件夹批量转换')
+    parser.add_argument('source', help='输入目录')
+    parser.add_argument('output', help='输出目录')
+    parser.add_argument('--format', default='PNG', help='输出格式（PNG、JPEG、WEBP等）')
+    parser.add_argument('--quality', type=int, default=95, help='图像质量（JPEG、WebP）')
+    parser.add_argument('--max-bytes', type=int, help='每个输出文件的大小上限（字节）')
+    parser.add_argument('--recursive', action='store_true', help='处理子目录')
+    parser.add_argument('--readers', type=int, default=2, help='读取线程数')
+    parser.add_argument('--workers', type=int, help='处理线程数，默认为CPU核心数')
+    parser.add_argument('--writers', type=int, default=2, help='写入线程数')
+    parser.add_argument('--queue-size', type=int, help='段间队列容量，默认为处理线程数的2倍')
+    parser.add_argument('--no-resume', action='store_true', help='忽略清单，重新转换全部图像')
+    parser.add_argument('--watermark', help='加在右下角的水印文字')
+    parser.add_argument('--watermark-size', type=int, default=24, help='水印字号')
+    parser.add_argument('--watermark-color', default='#ffffffa0', help='水印颜色')
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET,
+                        help='每个图像解码后的字节数上限，0表示不限制')
+    parser.add_argument('--json', action='store_true', help='以JSON输出报告')
+    args = parser.parse_args()
+
+    try:
+        converter = BatchConverter(
+            args.format, args.quality, args.max_bytes, args.readers, args.workers, args.writers,
+            args.queue_size, args.recursive, not args.no_resume, args.watermark,
+            args.watermark_size, args.watermark_color, args.memory_budget or None)
+        report = converter.run(args.source, args.output)
+    except (ValueError, OSError) as e:
+        print(f"批量转换失败: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print(f"共{report['found']}个图像: 转换{report['converted']}, 跳过{report['skipped']}, "
+              f"失败{report['failed']}, 用时{report['seconds']}秒, "
+              f"{report['images_per_second']}图像/秒, {report['mb_per_second']} MB/秒")
+        for name, stage in report['stages'].items():
+            print(f"  {name:>7}: {stage['threads']:>2}线程, {stage['images_per_second']:>8.1f} 图像/秒, "
+                  f"{stage['mb_per_second']:>8.2f} MB/秒, 忙碌 {stage['utilization'] * 100:5.1f}%")
+        if report['bottleneck']:
+            print(f"瓶颈: {report['bottleneck']}")
+    if report['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
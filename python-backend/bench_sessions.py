@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话并发压力测试脚本
+
+功能描述：
+- 在同一进程中创建不同数量的会话，每个会话由一个客户端线程连续发送编辑和导出请求
+- 统计每种会话数下的总吞吐量和调用延迟（p50、p99）
+- 用于观察会话数增加时多核利用情况和尾部延迟的变化
+
+用法：
+    python bench_sessions.py --sessions 1,2,4,8 --ops 40 --size 1280x720
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import json
+import math
+import base64
+import time
+import random
+import argparse
+import threading
+from io import BytesIO
+from typing import Dict, Any, List, Tuple
+from PIL import Image, ImageDraw
+
+from session_manager import SessionManager
+
+
+# 每个会话循环执行的操作：(方法名, 位置参数)
+WORKLOAD: List[Tuple[str, Tuple[Any, ...]]] = [
+    ('draw_rectangle', (20, 20, 300, 200, 'red', None, 3)),
+    ('add_text', ('bench', 40, 40, 24, 'blue')),
+    ('rotate', (7,)),
+    ('flip_horizontal', ()),
+    ('get_patch', ()),
+    ('to_base64', ('JPEG', 85)),
+    ('undo', ()),
+    ('undo', ()),
+]
+
+
+def make_image(width: int, height: int, seed: int) -> str:
+    """
+    生成带随机内容的测试图像
+
+    参数：
+        width: 图像宽度
+        height: 图像高度
+        seed: 随机种子
+
+    返回：
+        PNG图像的Base64 data URL
+    """
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for _ in range(200):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle([x, y, x + rng.randrange(150), y + rng.randrange(150)], fill=color)
+
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    计算分位数（最近秩法）
+
+    参数：
+        values: 样本
+        fraction: 分位，如0.99
+
+    返回：
+        分位数，样本为空时返回0
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run(session_count: int, ops: int, image_data: str) -> Dict[str, Any]:
+    """
+    以指定会话数运行一轮压力测试
+
+    参数：
+        session_count: 会话数
+        ops: 每个会话发送的请求数
+        image_data: 每个会话加载的图像
+
+    返回：
+        包含sessions、ops、seconds、throughput、p50_ms、p99_ms的字典
+    """
+    manager = SessionManager()
+    sessions = [manager.create_session() for _ in range(session_count)]
+    for session_id in sessions:
+        manager.call(session_id, 'load_from_base64', image_data)
+
+    latencies: List[float] = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(session_count + 1)
+
+    def client(session_id: str) -> None:
+        local: List[float] = []
+        start_barrier.wait()
+        for i in range(ops):
+            method, args = WORKLOAD[i % len(WORKLOAD)]
+            begin = time.perf_counter()
+            manager.submit(session_id, method, *args).result()
+            local.append(time.perf_counter() - begin)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client, args=(s,)) for s in sessions]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+    manager.shutdown()
+
+    return {
+        'sessions': session_count,
+        'ops': len(latencies),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def main() -> None:
+    """
+    命令行入口
+    """
+    parser = argparse.ArgumentParser(description='会话并发压力测试')
+    parser.add_argument('--sessions', default='1,2,4,8,16', help='逗号分隔的会话数列表')
+    parser.add_argument('--ops', type=int, default=40, help='每个会话发送的请求数')
+    parser.add_argument('--size', default='1280x720', help='测试图像尺寸，如1280x720')
+    parser.add_argument('--json', action='store_true', help='以JSON输出结果')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    image_data = make_image(width, height, 1)
+
+    results = []
+    for count in (int(v) for v in args.sessions.split(',')):
+        result = run(count, args.ops, image_data)
+        results.append(result)
+        if not args.json:
+            print(f"会话数 {result['sessions']:>3}: 吞吐量 {result['throughput']:>8.1f} 次/秒, "
+                  f"p50 {result['p50_ms']:>7.1f} ms, p99 {result['p99_ms']:>7.1f} ms")
+
+    if args.json:
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
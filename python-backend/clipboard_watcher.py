@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+剪贴板监听模块
+
+功能描述：
+- 在Linux X11下通过XFixes扩展订阅剪贴板所有者变化事件，无需轮询
+- 仅在剪贴板变化时读取图像数据，支持大数据量的INCR分段传输
+- 对原始字节做哈希，内容未变化时不重复通知
+- 直接交付剪贴板中的原始编码字节，不做PNG重新编码和Base64转换
+- 命令行方式运行时每检测到一张新图像输出一行JSON
+
+用法：
+    python clipboard_watcher.py [--output-dir DIR] [--raw]
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import sys
+import json
+import time
+import select
+import hashlib
+import argparse
+import threading
+import ctypes
+import ctypes.util
+from io import BytesIO
+from typing import Optional, Any, Callable, List, Tuple
+from PIL import Image
+
+from disk_cache import default_cache_dir
+from raw_frame import RAW_EXTENSION, write_raw_frame
+from save_queue import atomic_write_bytes
+
+
+# 按优先顺序请求的图像格式；BMP等未压缩格式解码最快
+PREFERRED_TARGETS = ('image/png', 'image/bmp', 'image/x-bmp', 'image/jpeg', 'image/tiff',
+                     'image/webp', 'image/gif')
+
+# 等待剪贴板所有者响应的秒数
+FETCH_TIMEOUT = 2.0
+
+# X11常量
+_SELECTION_NOTIFY = 31
+_PROPERTY_NOTIFY = 28
+_PROPERTY_CHANGE_MASK = 1 << 22
+_PROPERTY_NEW_VALUE = 0
+_ANY_PROPERTY_TYPE = 0
+_XFIXES_SET_SELECTION_OWNER_NOTIFY_MASK = 1 << 0
+_XFIXES_SELECTION_NOTIFY = 0
+_CURRENT_TIME = 0
+
+
+class _XAnyEvent(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_int), ('serial', ctypes.c_ulong), ('send_event', ctypes.c_int),
+                ('display', ctypes.c_void_p), ('window', ctypes.c_ulong)]
+
+
+class _XSelectionEvent(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_int), ('serial', ctypes.c_ulong), ('send_event', ctypes.c_int),
+                ('display', ctypes.c_void_p), ('requestor', ctypes.c_ulong),
+                ('selection', ctypes.c_ulong), ('target', ctypes.c_ulong),
+                ('property', ctypes.c_ulong), ('time', ctypes.c_ulong)]
+
+
+class _XPropertyEvent(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_int), ('serial', ctypes.c_ulong), ('send_event', ctypes.c_int),
+                ('display', ctypes.c_void_p), ('window', ctypes.c_ulong), ('atom', ctypes.c_ulong),
+                ('time', ctypes.c_ulong), ('state', ctypes.c_int)]
+
+
+class _XFixesSelectionNotifyEvent(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_int), ('serial', ctypes.c_ulong), ('send_event', ctypes.c_int),
+                ('display', ctypes.c_void_p), ('window', ctypes.c_ulong), ('subtype', ctypes.c_int),
+                ('owner', ctypes.c_ulong), ('selection', ctypes.c_ulong),
+                ('timestamp', ctypes.c_ulong), ('selection_timestamp', ctypes.c_ulong)]
+
+
+class _XEvent(ctypes.Union):
+    _fields_ = [('type', ctypes.c_int), ('xany', _XAnyEvent), ('xselection', _XSelectionEvent),
+                ('xproperty', _XPropertyEvent), ('xfixes', _XFixesSelectionNotifyEvent),
+                ('pad', ctypes.c_long * 24)]
+
+
+def _load_x11() -> Tuple[Any, Any]:
+    """
+    加载libX11和libXfixes并声明用到的函数签名
+
+    返回：
+        (libX11, libXfixes)
+
+    异常：
+        OSError: 当库不存在时抛出
+    """
+    x11_path = ctypes.util.find_library('X11') or 'libX11.so.6'
+    xfixes_path = ctypes.util.find_library('Xfixes') or 'libXfixes.so.3'
+    x11 = ctypes.CDLL(x11_path)
+    xfixes = ctypes.CDLL(xfixes_path)
+
+    ulong = ctypes.c_ulong
+    x11.XOpenDisplay.restype = ctypes.c_void_p
+    x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+    x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+    x11.XDefaultRootWindow.restype = ulong
+    x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+    x11.XCreateSimpleWindow.restype = ulong
+    x11.XCreateSimpleWindow.argtypes = [ctypes.c_void_p, ulong, ctypes.c_int, ctypes.c_int,
+                                        ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ulong, ulong]
+    x11.XDestroyWindow.argtypes = [ctypes.c_void_p, ulong]
+    x11.XSelectInput.argtypes = [ctypes.c_void_p, ulong, ctypes.c_long]
+    x11.XInternAtom.restype = ulong
+    x11.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+    x11.XGetAtomName.restype = ctypes.c_void_p
+    x11.XGetAtomName.argtypes = [ctypes.c_void_p, ulong]
+    x11.XGetSelectionOwner.restype = ulong
+    x11.XGetSelectionOwner.argtypes = [ctypes.c_void_p, ulong]
+    x11.XConvertSelection.argtypes = [ctypes.c_void_p, ulong, ulong, ulong, ulong, ulong]
+    x11.XGetWindowProperty.argtypes = [
+        ctypes.c_void_p, ulong, ulong, ctypes.c_long, ctypes.c_long, ctypes.c_int, ulong,
+        ctypes.POINTER(ulong), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ulong),
+        ctypes.POINTER(ulong), ctypes.POINTER(ctypes.c_void_p)]
+    x11.XDeleteProperty.argtypes = [ctypes.c_void_p, ulong, ulong]
+    x11.XFree.argtypes = [ctypes.c_void_p]
+    x11.XPending.argtypes = [ctypes.c_void_p]
+    x11.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XEvent)]
+    x11.XCheckTypedWindowEvent.argtypes = [ctypes.c_void_p, ulong, ctypes.c_int,
+                                           ctypes.POINTER(_XEvent)]
+    x11.XConnectionNumber.argtypes = [ctypes.c_void_p]
+    x11.XFlush.argtypes = [ctypes.c_void_p]
+
+    xfixes.XFixesQueryExtension.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int),
+                                            ctypes.POINTER(ctypes.c_int)]
+    xfixes.XFixesSelectSelectionInput.argtypes = [ctypes.c_void_p, ulong, ulong, ulong]
+    return x11, xfixes
+
+
+def is_available() -> bool:
+    """
+    判断当前环境能否监听剪贴板
+
+    返回：
+        设置了DISPLAY且X11和XFixes库可用时返回True
+    """
+    if not os.environ.get('DISPLAY'):
+        return False
+    try:
+        _load_x11()
+        return True
+    except OSError:
+        return False
+
+
+class ClipboardImage:
+    """剪贴板图像
+
+    保存剪贴板所有者提供的原始编码字节，需要像素时才解码。
+    """
+
+    def __init__(self, data: bytes, mime: str) -> None:
+        self.data = data
+        self.mime = mime
+        self.sha1 = hashlib.sha1(data).hexdigest()
+        self.timestamp = time.time()
+
+    def open(self) -> Image.Image:
+        """
+        解码图像
+
+        返回：
+            已加载的图像
+
+        异常：
+            IOError: 当数据无法解码时抛出
+        """
+        image = Image.open(BytesIO(self.data))
+        image.load()
+        return image
+
+    def save(self, directory: str, raw: bool = False) -> str:
+        """
+        将图像写入目录，文件名为内容哈希
+
+        参数：
+            directory: 目标目录，不存在时自动创建
+            raw: 为True时解码一次并写为原始帧，之后可通过mmap直接加载；
+                否则原样写出剪贴板中的编码字节
+
+        返回：
+            写出的文件路径
+
+        异常：
+            OSError: 当文件无法写入时抛出
+        """
+        os.makedirs(directory, exist_ok=True)
+        if raw:
+            path = os.path.join(directory, self.sha1 + RAW_EXTENSION)
+            if not os.path.exists(path):
+                write_raw_frame(self.open(), path)
+            return path
+
+        extension = self.mime.split('/')[-1].replace('x-', '')
+        path = os.path.join(directory, f"{self.sha1}.{extension}")
+        if not os.path.exists(path):
+            # 临时文件名唯一，多个进程同时保存同一图像时互不覆盖
+            atomic_write_bytes(path, self.data)
+        return path
+
+
+class ClipboardWatcher:
+    """剪贴板监听器类
+
+    在独立线程中持有X连接，阻塞在连接的文件描述符上等待XFixes所有者变化事件，
+    空闲时不占用CPU。所有者变化后先读取TARGETS，按PREFERRED_TARGETS选择格式再读取数据。
+    与上一次交付的内容哈希相同时不回调。
+    """
+
+    def __init__(self, callback: Callable[[ClipboardImage], None], selection: str = 'CLIPBOARD',
+                 targets: Tuple[str, ...] = PREFERRED_TARGETS, display: Optional[str] = None,
+                 timeout: float = FETCH_TIMEOUT) -> None:
+        """
+        初始化剪贴板监听器
+
+        参数：
+            callback: 检测到新图像时在监听线程中调用
+            selection: 监听的选区，默认CLIPBOARD，也可以是PRIMARY
+            targets: 按优先顺序接受的MIME类型
+            display: X显示名，为None时使用DISPLAY环境变量
+            timeout: 等待剪贴板所有者响应的秒数
+
+        异常：
+            无
+        """
+        self.callback = callback
+        self.selection = selection
+        self.targets = targets
+        self.display_name = display
+        self.timeout = timeout
+        self.last_sha1: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_read, self._stop_write = -1, -1
+        self._ready = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def start(self) -> None:
+        """
+        在后台线程中开始监听
+
+        异常：
+            OSError: 当无法连接X服务器或XFixes扩展不可用时抛出
+        """
+        if self._thread is not None:
+            return
+        self._ready.clear()
+        self._error = None
+        self._thread = threading.Thread(target=self.run, name='clipboard-watcher', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self._thread = None
+            raise self._error
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        停止监听并等待监听线程退出
+
+        参数：
+            timeout: 最长等待秒数
+        """
+        if self._thread is None:
+            return
+        os.write(self._stop_write, b'x')
+        self._thread.join(timeout)
+        self._thread = None
+
+    def run(self) -> None:
+        """
+        在当前线程中监听，直到stop()被调用
+
+        异常：
+            OSError: 当无法连接X服务器或XFixes扩展不可用时抛出
+        """
+        self._stop_read, self._stop_write = os.pipe()
+        try:
+            x11, xfixes = _load_x11()
+            display = x11.XOpenDisplay(self.display_name.encode() if self.display_name else None)
+            if not display:
+                raise OSError("无法连接X服务器")
+        except BaseException as e:
+            os.close(self._stop_read)
+            os.close(self._stop_write)
+            self._error = e
+            self._ready.set()
+            raise
+
+        window = 0
+        try:
+            event_base, error_base = ctypes.c_int(), ctypes.c_int()
+            if not xfixes.XFixesQueryExtension(display, ctypes.byref(event_base), ctypes.byref(error_base)):
+                raise OSError("X服务器不支持XFixes扩展")
+
+            root = x11.XDefaultRootWindow(display)
+            window = x11.XCreateSimpleWindow(display, root, 0, 0, 1, 1, 0, 0, 0)
+            x11.XSelectInput(display, window, _PROPERTY_CHANGE_MASK)
+            self._x11 = x11
+            self._display = display
+            self._window = window
+            self._selection_atom = self._atom(self.selection)
+            self._property_atom = self._atom('PFC_CLIPBOARD')
+            self._incr_atom = self._atom('INCR')
+
+            xfixes.XFixesSelectSelectionInput(display, window, self._selection_atom,
+                                              _XFIXES_SET_SELECTION_OWNER_NOTIFY_MASK)
+            x11.XFlush(display)
+        except BaseException as e:
+            if window:
+                x11.XDestroyWindow(display, window)
+            x11.XCloseDisplay(display)
+            os.close(self._stop_read)
+            os.close(self._stop_write)
+            self._error = e
+            self._ready.set()
+            raise
+
+        self._ready.set()
+        try:
+            # 启动时剪贴板中已有的图像也通知一次
+            if x11.XGetSelectionOwner(display, self._selection_atom):
+                self._fetch()
+
+            fd = x11.XConnectionNumber(display)
+            event = _XEvent()
+            while True:
+                while x11.XPending(display):
+                    x11.XNextEvent(display, ctypes.byref(event))
+                    if event.type == event_base.value + _XFIXES_SELECTION_NOTIFY:
+                        if event.xfixes.owner:
+                            self._fetch()
+
+                readable, _, _ = select.select([fd, self._stop_read], [], [])
+                if self._stop_read in readable:
+                    break
+        finally:
+            x11.XDestroyWindow(display, window)
+            x11.XCloseDisplay(display)
+            os.close(self._stop_read)
+            os.close(self._stop_write)
+            self._stop_read, self._stop_write = -1, -1
+
+    def deliver(self, data: bytes, mime: str) -> bool:
+        """
+        交付读取到的剪贴板数据，内容与上一次相同时忽略
+
+        参数：
+            data: 剪贴板中的原始编码字节
+            mime: 数据的MIME类型
+
+        返回：
+            是否调用了回调
+        """
+        image = ClipboardImage(data, mime)
+        if image.sha1 == self.last_sha1:
+            return False
+        self.last_sha1 = image.sha1
+        try:
+            self.callback(image)
+        except Exception as e:
+            print(f"剪贴板回调失败: {e}", file=sys.stderr)
+        return True
+
+    def _atom(self, name: str) -> int:
+        return self._x11.XInternAtom(self._display, name.encode('ascii'), 0)
+
+    def _atom_name(self, atom: int) -> str:
+        pointer = self._x11.XGetAtomName(self._display, atom)
+        if not pointer:
+            return ''
+        try:
+            return ctypes.string_at(pointer).decode('ascii', 'replace')
+        finally:
+            self._x11.XFree(pointer)
+
+    def _fetch(self) -> None:
+        """
+        读取剪贴板中的图像并交付
+        """
+        try:
+            targets_data = self._convert(self._atom('TARGETS'))
+            if targets_data is None:
+                return
+            data, format = targets_data
+            if format != 32:
+                return
+
+            # 32位格式的数据在客户端以long数组保存
+            count = len(data) // ctypes.sizeof(ctypes.c_ulong)
+            atoms = (ctypes.c_ulong * count).from_buffer_copy(data[:count * ctypes.sizeof(ctypes.c_ulong)])
+            offered = {self._atom_name(atom): atom for atom in atoms}
+
+            for mime in self.targets:
+                if mime in offered:
+                    result = self._convert(offered[mime])
+                    if result is not None and result[0]:
+                        self.deliver(result[0], mime)
+                    return
+        except Exception as e:
+            print(f"读取剪贴板失败: {e}", file=sys.stderr)
+
+    def _convert(self, target: int) -> Optional[Tuple[bytes, int]]:
+        """
+        请求剪贴板所有者把选区转换为指定格式，并读取结果
+
+        参数：
+            target: 目标格式的atom
+
+        返回：
+            (数据, 数据格式位数)，所有者拒绝或超时时返回None
+        """
+        x11, display, window = self._x11, self._display, self._window
+        x11.XDeleteProperty(display, window, self._property_atom)
+        x11.XConvertSelection(display, self._selection_atom, target, self._property_atom,
+                              window, _CURRENT_TIME)
+        x11.XFlush(display)
+
+        event = self._wait_event(_SELECTION_NOTIFY)
+        if event is None or event.xselection.property == 0:
+            return None
+
+        # 丢弃所有者写入结果时产生的属性事件，INCR分段只等待之后的新事件
+        while x11.XCheckTypedWindowEvent(display, window, _PROPERTY_NOTIFY, ctypes.byref(event)):
+            pass
+
+        data, format, actual_type = self._read_property(delete=True)
+        if actual_type != self._incr_atom:
+            return data, format
+
+        # INCR：所有者分段写入属性，每读取并删除一次属性后写入下一段，长度为0表示结束
+        chunks: List[bytes] = []
+        while True:
+            event = self._wait_event(_PROPERTY_NOTIFY, lambda e: (
+                e.xproperty.atom == self._property_atom and e.xproperty.state == _PROPERTY_NEW_VALUE))
+            if event is None:
+                return None
+            chunk, format, _ = self._read_property(delete=True)
+            if not chunk:
+                return b''.join(chunks), format
+            chunks.append(chunk)
+
+    def _read_property(self, delete: bool) -> Tuple[bytes, int, int]:
+        """
+        读取监听窗口上的转换结果属性
+
+        参数：
+            delete: 读取后是否删除属性
+
+        返回：
+            (数据, 数据格式位数, 实际类型atom)
+        """
+        actual_type = ctypes.c_ulong()
+        actual_format = ctypes.c_int()
+        items = ctypes.c_ulong()
+        remaining = ctypes.c_ulong()
+        pointer = ctypes.c_void_p()
+
+        # 长度以32位为单位，一次读取全部内容
+        self._x11.XGetWindowProperty(
+            self._display, self._window, self._property_atom, 0, 0x1FFFFFFF, int(delete),
+            _ANY_PROPERTY_TYPE, ctypes.byref(actual_type), ctypes.byref(actual_format),
+            ctypes.byref(items), ctypes.byref(remaining), ctypes.byref(pointer))
+        try:
+            format = actual_format.value
+            if not pointer.value or format == 0:
+                return b'', format, actual_type.value
+            # 格式为32时每项在客户端占一个long
+            item_size = {8: 1, 16: ctypes.sizeof(ctypes.c_short), 32: ctypes.sizeof(ctypes.c_long)}[format]
+            return ctypes.string_at(pointer.value, items.value * item_size), format, actual_type.value
+        finally:
+            if pointer.value:
+                self._x11.XFree(pointer)
+
+    def _wait_event(self, event_type: int,
+                    predicate: Optional[Callable[[_XEvent], bool]] = None) -> Optional[_XEvent]:
+        """
+        等待监听窗口上的指定类型事件，其他事件保留在队列中
+
+        参数：
+            event_type: X事件类型
+            predicate: 额外的筛选条件
+
+        返回：
+            事件，超时时返回None
+        """
+        deadline = time.monotonic() + self.timeout
+        fd = self._x11.XConnectionNumber(self._display)
+        event = _XEvent()
+        while True:
+            while self._x11.XCheckTypedWindowEvent(self._display, self._window, event_type,
+                                                   ctypes.byref(event)):
+                if predicate is None or predicate(event):
+                    return event
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            select.select([fd], [], [], min(remaining, 0.05))
+
+
+def main() -> None:
+    """
+    命令行入口
+
+    每检测到一张新图像，向标准输出写一行JSON：
+    {"event": "image", "path": ..., "mime": ..., "sha1": ..., "size": ..., "width": ..., "height": ...}
+    """
+    parser = argparse.ArgumentParser(description='剪贴板图像监听')
+    parser.add_argument('--output-dir', default=default_cache_dir('clipboard'),
+                        help='图像输出目录')
+    parser.add_argument('--raw', action='store_true',
+                        help='输出原始帧文件，可由image_processor直接映射加载')
+    parser.add_argument('--selection', default='CLIPBOARD', help='监听的选区')
+    args = parser.parse_args()
+
+    if not is_available():
+        print(json.dumps({'event': 'error', 'error': '当前环境不支持X11剪贴板监听'}), flush=True)
+        sys.exit(1)
+
+    def on_image(image: ClipboardImage) -> None:
+        try:
+            path = image.save(args.output_dir, args.raw)
+            with Image.open(BytesIO(image.data)) as decoded:
+                width, height = decoded.size
+            print(json.dumps({
+                'event': 'image',
+                'path': path,
+                'mime': image.mime,
+                'sha1': image.sha1,
+                'size': len(image.data),
+                'width': width,
+                'height': height,
+                'timestamp': int(image.timestamp * 1000)
+            }), flush=True)
+        except Exception as e:
+            print(json.dumps({'event': 'error', 'error': str(e)}), flush=True)
+
+    watcher = ClipboardWatcher(on_image, args.selection)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(json.dumps({'event': 'error', 'error': str(e)}), flush=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+派生数据缓存模块
+
+功能描述：
+- 按历史状态缓存合成图、白底展平图、编码字节、图像信息、大小估算等派生数据
+- 进程内所有处理器共享一个字节预算，超出时按最近最少使用淘汰
+- 历史状态被丢弃时一并移除其派生数据
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Callable, Hashable, Iterable, Tuple
+from PIL import Image
+
+
+# 缓存键：(状态ID, 数据类型, 参数)
+CacheKey = Tuple[int, str, Hashable]
+
+# 字典、字符串等小对象按固定大小计入预算
+_SMALL_OBJECT_BYTES = 256
+
+
+def artifact_size(value: Any) -> int:
+    """
+    估算派生数据占用的字节数
+
+    参数：
+        value: 派生数据
+
+    返回：
+        字节数估计值
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    return _SMALL_OBJECT_BYTES
+
+
+class DerivedCache:
+    """派生数据缓存类
+
+    状态ID全局唯一，且底图和标注都不会被原地修改，
+    因此同一状态ID上的派生数据永远有效，不需要比较内容。
+    所有操作都持有锁，后台线程也可以安全地读写。
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024) -> None:
+        """
+        初始化派生数据缓存
+
+        参数：
+            max_bytes: 缓存总字节数上限，默认128MB
+
+        异常：
+            无
+        """
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[CacheKey, Tuple[Any, int]]' = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, state_id: int, kind: str, params: Hashable = ()) -> Optional[Any]:
+        """
+        读取缓存条目
+
+        参数：
+            state_id: 历史状态ID
+            kind: 数据类型，如'composite'、'encoded'
+            params: 区分同类数据的参数
+
+        返回：
+            缓存的数据，未命中时返回None
+        """
+        key = (state_id, kind, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, state_id: int, kind: str, params: Hashable, value: Any,
+            size: Optional[int] = None) -> None:
+        """
+        写入缓存条目
+
+        参数：
+            state_id: 历史状态ID
+            kind: 数据类型
+            params: 区分同类数据的参数
+            value: 派生数据
+            size: 占用字节数，为None时按artifact_size()估算。
+                与其他对象共享内存的数据（如未合成标注时的底图本身）应传0
+        """
+        if size is None:
+            size = artifact_size(value)
+        if size > self.max_bytes:
+            return
+
+        key = (state_id, kind, params)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old[1]
+            self._entries[key] = (value, size)
+            self._total += size
+
+            while self._total > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._total -= evicted
+
+    def get_or_create(self, state_id: int, kind: str, params: Hashable,
+                      factory: Callable[[], Any]) -> Any:
+        """
+        读取缓存条目，未命中时调用factory生成并写入
+
+        参数：
+            state_id: 历史状态ID
+            kind: 数据类型
+            params: 区分同类数据的参数
+            factory: 生成派生数据的函数
+
+        返回：
+            派生数据
+        """
+        value = self.get(state_id, kind, params)
+        if value is None:
+            value = factory()
+            self.put(state_id, kind, params, value)
+        return value
+
+    def drop_states(self, state_ids: Iterable[int]) -> None:
+        """
+        移除指定历史状态的全部派生数据
+
+        参数：
+            state_ids: 被丢弃的历史状态ID
+        """
+        dropped = set(state_ids)
+        if not dropped:
+            return
+        with self._lock:
+            for key in [k for k in self._entries if k[0] in dropped]:
+                self._total -= self._entries.pop(key)[1]
+
+    def clear(self) -> None:
+        """
+        清空缓存
+        """
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存的使用情况
+
+        返回：
+            包含entries、bytes、max_bytes、hits、misses的字典
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_shared_cache: Optional[DerivedCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_derived_cache() -> DerivedCache:
+    """
+    获取进程内共享的派生数据缓存
+
+    返回：
+        共享缓存，首次调用时创建
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = DerivedCache()
+        return _shared_cache
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+磁盘缓存模块
+
+功能描述：
+- 提供按键存取二进制数据的磁盘缓存
+- 按总字节数限制缓存大小，超出时按最近使用时间淘汰
+- 写入采用临时文件加重命名，避免并发进程读到半写入的数据
+- 默认缓存目录位于当前用户的缓存目录下，权限为0700，不使用共享的系统临时目录
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import sys
+import stat
+import hashlib
+import tempfile
+from typing import Optional, List, Tuple
+
+
+# 当前用户缓存目录下的应用目录名
+APP_CACHE_NAME = 'picFromClipboard'
+
+
+def user_cache_root() -> str:
+    """
+    获取当前用户的应用缓存根目录
+
+    Windows上位于LOCALAPPDATA下；其他系统按XDG规范使用XDG_CACHE_HOME，
+    未设置或不是绝对路径时使用~/.cache。
+
+    返回：
+        应用缓存根目录路径
+    """
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', '')
+        if not os.path.isabs(base):
+            base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, APP_CACHE_NAME)
+
+
+def default_cache_dir(name: str) -> str:
+    """
+    获取默认缓存目录
+
+    参数：
+        name: 缓存子目录名称
+
+    返回：
+        位于当前用户应用缓存根目录下的缓存目录路径
+    """
+    return os.path.join(user_cache_root(), name)
+
+
+def ensure_private_dir(directory: str) -> None:
+    """
+    创建只有当前用户可以写入的目录，并检查已有目录是否安全
+
+    新建的目录权限为0700。POSIX系统上目录不能是符号链接，必须属于当前用户，
+    且不能允许同组或其他用户写入，否则其他用户可以预先放置缓存条目。
+    位于应用缓存根目录下时先以同样的规则创建并检查根目录。
+
+    参数：
+        directory: 目录路径
+
+    异常：
+        PermissionError: 当已有目录不安全时抛出
+        OSError: 当目录无法创建时抛出
+    """
+    root = os.path.abspath(user_cache_root())
+    if os.path.dirname(os.path.abspath(directory)) == root:
+        ensure_private_dir(root)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.name == 'nt':
+        return
+
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"缓存目录不是普通目录: {directory}")
+    if st.st_uid != os.getuid():
+        raise PermissionError(f"缓存目录不属于当前用户: {directory}")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"缓存目录允许其他用户写入: {directory}")
+
+
+class DiskCache:
+    """磁盘缓存类
+
+    每个条目保存为缓存目录下的一个文件，文件名为键的SHA-1摘要。
+    文件的修改时间用作最近使用时间，读取命中时会刷新。
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024) -> None:
+        """
+        初始化磁盘缓存
+
+        参数：
+            directory: 缓存目录，不存在时以0700权限创建
+            max_bytes: 缓存总字节数上限，默认64MB
+
+        异常：
+            PermissionError: 当缓存目录属于其他用户或允许其他用户写入时抛出
+            OSError: 当缓存目录无法创建时抛出
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        ensure_private_dir(self.directory)
+
+    def _path_for(self, key: str) -> str:
+        """
+        计算键对应的缓存文件路径
+
+        参数：
+            key: 缓存键
+
+        返回：
+            缓存文件的完整路径
+        """
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.bin')
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        读取缓存条目
+
+        参数：
+            key: 缓存键
+
+        返回：
+            缓存的数据，未命中时返回None
+        """
+        path = self._path_for(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # 刷新最近使用时间
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        写入缓存条目
+
+        写入完成后检查缓存总大小，超出上限时淘汰最久未使用的条目。
+        单个条目超过上限时不写入。
+
+        参数：
+            key: 缓存键
+            data: 要缓存的数据
+
+        异常：
+            无，写入失败时输出错误信息后忽略
+        """
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path_for(key)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入缓存失败: {e}", file=sys.stderr)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._evict()
+
+    def clear(self) -> None:
+        """
+        清空缓存目录中的所有条目
+        """
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """
+        列出缓存条目
+
+        返回：
+            (最近使用时间, 字节数, 路径) 元组列表
+        """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+
+        for name in names:
+            if not name.endswith('.bin'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self) -> None:
+        """
+        淘汰最久未使用的条目，直到总大小不超过上限
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分层历史记录存储模块
+
+功能描述：
+- 保存撤销/重做所需的历史状态
+- 当前状态及相邻状态的底图以Image对象常驻内存
+- 较远状态的底图用zlib快速压缩后保存在内存中
+- 压缩数据超出字节预算时，离当前状态最远的底图溢出到临时文件
+- 撤销/重做时透明地恢复底图
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import sys
+import zlib
+import shutil
+import weakref
+import itertools
+import tempfile
+from typing import Optional, Dict, Any, Callable, List, Tuple
+from PIL import Image
+
+from annotation_layer import Annotation
+from frame_sequence import Op
+
+
+# 全局唯一的状态ID，不同处理器之间也不会重复
+_state_ids = itertools.count(1)
+
+# 压缩时每次处理的字节数
+_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+class _Frame:
+    """单张底图的分层存储
+
+    底图处于以下三层之一：
+    - 常驻：image不为None
+    - 内存压缩：compressed不为None
+    - 磁盘溢出：spill_path不为None
+    溢出文件在底图恢复常驻后仍然保留，再次降级时无需重写。
+    """
+
+    def __init__(self, image: Image.Image) -> None:
+        self.image: Optional[Image.Image] = image
+        self.compressed: Optional[bytes] = None
+        self.spill_path: Optional[str] = None
+        self.mode = image.mode
+        self.size = image.size
+        self.info = image.info.copy()
+        self.palette: Optional[Tuple[str, List[int]]] = None
+        if image.mode in ('P', 'PA') and image.palette:
+            self.palette = (image.palette.mode, image.getpalette(image.palette.mode))
+
+    def load(self) -> Image.Image:
+        """
+        获取底图，必要时从压缩数据或溢出文件恢复
+
+        返回：
+            底图对象
+
+        异常：
+            OSError: 当溢出文件无法读取时抛出
+        """
+        if self.image is not None:
+            return self.image
+
+        data = self.compressed
+        if data is None:
+            with open(self.spill_path, 'rb') as f:
+                data = f.read()
+
+        image = Image.frombytes(self.mode, self.size, zlib.decompress(data))
+        if self.palette:
+            image.putpalette(self.palette[1], self.palette[0])
+        image.info = self.info.copy()
+
+        self.image = image
+        return image
+
+    def compress(self) -> None:
+        """
+        降级为内存压缩层
+
+        按行分块压缩，避免生成整张底图的未压缩字节副本。
+        """
+        if self.image is None:
+            return
+
+        if self.compressed is None and self.spill_path is None:
+            width, height = self.size
+            row_bytes = max(1, len(self.image.crop((0, 0, width, min(1, height))).tobytes()))
+            rows = max(1, _CHUNK_BYTES // row_bytes)
+
+            compressor = zlib.compressobj(1)
+            parts = []
+            for y in range(0, height, rows):
+                parts.append(compressor.compress(self.image.crop((0, y, width, min(height, y + rows))).tobytes()))
+            parts.append(compressor.flush())
+            self.compressed = b''.join(parts)
+
+        self.image = None
+
+    def spill(self, directory: str, name: str) -> None:
+        """
+        将压缩数据溢出到磁盘
+
+        参数：
+            directory: 溢出目录
+            name: 文件名
+        """
+        if self.compressed is None:
+            return
+
+        if self.spill_path is None:
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(self.compressed)
+            self.spill_path = path
+        self.compressed = None
+
+    def discard(self) -> None:
+        """
+        释放底图占用的所有资源
+        """
+        self.image = None
+        self.compressed = None
+        if self.spill_path:
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+            self.spill_path = None
+
+
+class HistoryState:
+    """历史记录状态
+
+    由底图、标注元组和操作日志组成。底图和标注对象都不会被原地修改，
+    因此仅改动标注的操作可以与前一状态共享同一张底图。
+    操作日志记录从加载到该状态的几何操作，用于在其他帧或原始分辨率上重放。
+    """
+
+    def __init__(self, frame: _Frame, annotations: Tuple[Annotation, ...],
+                 ops: Tuple[Op, ...] = ()) -> None:
+        self.state_id: int = next(_state_ids)
+        self.frame = frame
+        self.annotations = annotations
+        self.ops = ops
+
+    @property
+    def image(self) -> Image.Image:
+        """底图，必要时透明地从压缩层或磁盘恢复"""
+        return self.frame.load()
+
+
+class HistoryStore:
+    """分层历史记录存储类
+
+    维护历史状态列表和当前位置。每次位置变化后重新分层：
+    当前位置前后live_radius个状态的底图常驻，其余压缩；
+    压缩数据总量超过memory_budget时，按离当前位置由远到近溢出到磁盘。
+    """
+
+    def __init__(self, max_states: int = 50, memory_budget: int = 256 * 1024 * 1024,
+                 live_radius: int = 1) -> None:
+        """
+        初始化历史记录存储
+
+        参数：
+            max_states: 最多保留的状态数量，默认50
+            memory_budget: 内存压缩层的字节预算，默认256MB
+            live_radius: 当前状态前后常驻内存的状态数，默认1
+
+        异常：
+            无
+        """
+        self.max_states = max_states
+        self.memory_budget = memory_budget
+        self.live_radius = live_radius
+        self.states: List[HistoryState] = []
+        self.index: int = -1
+        self._spill_dir: Optional[str] = None
+        # 状态被丢弃时以其ID列表调用，用于清理按状态缓存的数据
+        self.on_discard: Optional[Callable[[List[int]], None]] = None
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    @property
+    def current(self) -> Optional[HistoryState]:
+        """当前状态，没有历史记录时为None"""
+        if self.index < 0:
+            return None
+        return self.states[self.index]
+
+    def reset(self, image: Image.Image, annotations: Tuple[Annotation, ...] = ()) -> HistoryState:
+        """
+        清空历史记录并以给定图像作为初始状态
+
+        参数：
+            image: 初始底图
+            annotations: 初始标注
+
+        返回：
+            初始状态
+        """
+        for frame in self._frames():
+            frame.discard()
+        self._notify_discard(self.states)
+        self.states = [HistoryState(_Frame(image), annotations)]
+        self.index = 0
+        return self.states[0]
+
+    def push(self, image: Image.Image, annotations: Tuple[Annotation, ...],
+             ops: Tuple[Op, ...] = ()) -> HistoryState:
+        """
+        添加新状态
+
+        移除当前位置之后的状态；底图与当前状态相同时共享同一存储。
+
+        参数：
+            image: 新状态的底图
+            annotations: 新状态的标注
+            ops: 新状态的操作日志
+
+        返回：
+            新状态
+        """
+        current = self.current
+        if current is not None and current.frame.image is image:
+            frame = current.frame
+        else:
+            frame = _Frame(image)
+
+        self._notify_discard(self.states[self.index + 1:])
+        self.states = self.states[:self.index + 1]
+        self.states.append(HistoryState(frame, annotations, ops))
+        self.index = len(self.states) - 1
+
+        if len(self.states) > self.max_states:
+            self._notify_discard(self.states[:len(self.states) - self.max_states])
+            del self.states[:len(self.states) - self.max_states]
+            self.index = len(self.states) - 1
+
+        self._release_unreferenced()
+        self._rebalance()
+        return self.states[self.index]
+
+    def undo(self) -> Optional[HistoryState]:
+        """
+        后退到上一个状态
+
+        返回：
+            上一个状态，已经是最早状态时返回None
+        """
+        if self.index <= 0:
+            return None
+        self.index -= 1
+        self._rebalance()
+        return self.states[self.index]
+
+    def redo(self) -> Optional[HistoryState]:
+        """
+        前进到下一个状态
+
+        返回：
+            下一个状态，已经是最新状态时返回None
+        """
+        if self.index >= len(self.states) - 1:
+            return None
+        self.index += 1
+        self._rebalance()
+        return self.states[self.index]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取各层的占用情况
+
+        返回：
+            包含states、live、compressed、spilled、compressed_bytes的字典
+        """
+        frames = self._frames()
+        return {
+            'states': len(self.states),
+            'live': sum(1 for f in frames if f.image is not None),
+            'compressed': sum(1 for f in frames if f.image is None and f.compressed is not None),
+            'spilled': sum(1 for f in frames if f.image is None and f.compressed is None),
+            'compressed_bytes': sum(len(f.compressed) for f in frames if f.compressed is not None),
+        }
+
+    def close(self) -> None:
+        """
+        清空历史记录并删除溢出目录
+        """
+        for frame in self._frames():
+            frame.discard()
+        self._notify_discard(self.states)
+        self.states = []
+        self.index = -1
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def _notify_discard(self, states: List[HistoryState]) -> None:
+        """
+        通知监听方这些状态已被丢弃
+        """
+        if self.on_discard is not None and states:
+            self.on_discard([state.state_id for state in states])
+
+    def _frames(self) -> List[_Frame]:
+        """
+        按状态顺序列出去重后的底图存储
+        """
+        seen = set()
+        frames = []
+        for state in self.states:
+            if id(state.frame) not in seen:
+                seen.add(id(state.frame))
+                frames.append(state.frame)
+        return frames
+
+    def _release_unreferenced(self) -> None:
+        """
+        释放不再被任何状态引用的底图存储的溢出文件
+        """
+        if not self._spill_dir:
+            return
+        referenced = {os.path.basename(f.spill_path) for f in self._frames() if f.spill_path}
+        for name in os.listdir(self._spill_dir):
+            if name not in referenced:
+                try:
+                    os.remove(os.path.join(self._spill_dir, name))
+                except OSError:
+                    pass
+
+    def _rebalance(self) -> None:
+        """
+        按当前位置重新分层
+        """
+        distance: Dict[int, int] = {}
+        frames: Dict[int, _Frame] = {}
+        for i, state in enumerate(self.states):
+            key = id(state.frame)
+            frames[key] = state.frame
+            distance[key] = min(distance.get(key, len(self.states)), abs(i - self.index))
+
+        for key, frame in frames.items():
+            if distance[key] <= self.live_radius:
+                frame.load()
+            else:
+                frame.compress()
+
+        compressed = [frames[k] for k in frames if frames[k].compressed is not None
+                      and frames[k].image is None]
+        total = sum(len(f.compressed) for f in compressed)
+        if total <= self.memory_budget:
+            return
+
+        for frame in sorted(compressed, key=lambda f: -distance[id(f)]):
+            size = len(frame.compressed)
+            try:
+                frame.spill(self._ensure_spill_dir(), f"frame-{next(_state_ids)}.z")
+            except OSError as e:
+                print(f"历史记录溢出到磁盘失败: {e}", file=sys.stderr)
+                return
+            total -= size
+            if total <= self.memory_budget:
+                break
+
+    def _ensure_spill_dir(self) -> str:
+        """
+        获取溢出目录，首次使用时创建，并在存储对象回收时自动删除
+        """
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='picFromClipboard-history-')
+            weakref.finalize(self, shutil.rmtree, self._spill_dir, True)
+        return self._spill_dir
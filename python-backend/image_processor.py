@@ -7,6 +7,10 @@
 - 提供图像裁剪、旋转、翻转等基础操作
 - 支持文字标注和图形绘制
 - 提供多种图像格式的保存功能
+- 动画GIF、多页TIFF等多帧图像逐帧重放操作后保存
+- 按内存预算加载超大图像：JPEG在解码阶段缩小为工作副本，保存时按原始分辨率重放操作；
+  无法在解码阶段缩小的格式超出预算时拒绝加载
+- 可选的性能追踪，导出Chrome trace event格式
 - 命令行接口供Electron调用
 
 作者：AI Assistant
@@ -18,9 +22,317 @@ import json
 import base64
 import argparse
 import os
+import math
+import hashlib
+import tempfile
+import weakref
+from dataclasses import replace
+from functools import partial
 from io import BytesIO
-from typing import Optional, Dict, Any, List
-from PIL import Image, ImageDraw, ImageFont
+from typing import Optional, Dict, Any, List, Tuple, Union
+
+# 追踪模块只依赖标准库，先于Pillow等模块导入，以便记录导入耗时
+import tracing
+from PIL import Image
+
+from annotation_layer import (
+    Annotation, AnnotationLayer, TextAnnotation, RectangleAnnotation,
+    CircleAnnotation, LineAnnotation, Box, clip_box, union_boxes
+)
+from derived_cache import DerivedCache, get_derived_cache
+from disk_cache import DiskCache, default_cache_dir
+from frame_sequence import (
+    MULTI_FRAME_FORMATS, Op, OpReplayer, apply_op, encode_frames, frame_count,
+    normalize_frame, scale_ops
+)
+from history_store import HistoryState, HistoryStore
+from parallel_ops import get_worker_pool
+from pre_encoder import PreEncoder
+from save_queue import SaveQueue, atomic_write_bytes
+from raw_frame import is_raw_frame, open_raw_frame, write_raw_frame
+from result_cache import ResultCache, result_cache_enabled, result_key
+from size_search import SearchResult, search
+
+_IMPORTS_FINISHED = tracing.now()
+
+
+# 不超过该像素数的图像直接完整编码来得到精确大小
+EXACT_ESTIMATE_MAX_PIXELS = 256 * 1024
+
+# 大小估算时抽样的水平条带数量和每个条带的行数（JPEG的MCU最高为16行）
+ESTIMATE_SAMPLE_BANDS = 8
+ESTIMATE_BAND_ROWS = 16
+
+# 大小估算误差界的最小相对值，抽样无法反映条带之间的上下文
+ESTIMATE_MIN_MARGIN = 0.03
+
+# 支持质量参数的有损格式
+QUALITY_FORMATS = ('JPEG', 'WEBP')
+
+# 目标大小模式下PNG依次尝试的调色板颜色数，按文件大小从小到大排列
+PALETTE_COLORS = (2, 4, 8, 16, 32, 64, 128, 256)
+
+# 目标大小模式下种子估算依次尝试的质量点
+SIZE_SEED_QUALITIES = (80, 50, 25, 10)
+
+# 工作图像解码后的默认内存预算
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def _read_source_bytes(source: str) -> bytes:
+    """
+    读取图像源的原始字节
+
+    参数：
+        source: 图像文件路径或Base64编码的图像数据（可包含data URL前缀）
+
+    返回：
+        未解码的图像文件字节
+
+    异常：
+        OSError: 当文件无法读取时抛出
+        ValueError: 当Base64数据格式无效时抛出
+    """
+    if os.path.exists(source):
+        with open(source, 'rb') as f:
+            return f.read()
+
+    if source.startswith('data:image/'):
+        source = source.split(',')[1]
+    return base64.b64decode(source)
+
+
+def _prepare_for_format(image: Image.Image, format: str,
+                        quality: int) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    按输出格式准备待编码的图像和保存参数
+
+    JPEG不支持透明度，带透明度或调色板的图像会合成到白色背景上。
+
+    参数：
+        image: 待保存的图像
+        format: 图像格式（PNG、JPEG、BMP、GIF等）
+        quality: 图像质量，仅对JPEG和WebP格式有效
+
+    返回：
+        (待编码的图像, 传给Image.save的参数)
+    """
+    if format.upper() == 'JPEG' or format.upper() == 'JPG':
+        # JPEG不支持透明度，需要转换为RGB
+        if image.mode in ('RGBA', 'LA', 'P'):
+            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+            rgb_image.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
+            image = rgb_image
+        return image, {'format': 'JPEG', 'quality': quality}
+    if format.upper() == 'WEBP':
+        return image, {'format': 'WEBP', 'quality': quality}
+    return image, {'format': format}
+
+
+def _decoded_bytes(size: Tuple[int, int], mode: str) -> int:
+    """
+    按Pillow的内部存储估算图像解码后占用的字节数
+
+    参数：
+        size: 图像尺寸 (width, height)
+        mode: 图像模式
+
+    返回：
+        字节数，三通道和四通道图像每像素按4字节计
+    """
+    if mode in ('1', 'L', 'P'):
+        pixel_bytes = 1
+    elif mode.startswith('I;16'):
+        pixel_bytes = 2
+    else:
+        pixel_bytes = 4
+    return size[0] * size[1] * pixel_bytes
+
+
+def _reducible(image: Image.Image) -> Image.Image:
+    """
+    转换为可以按块平均缩小的模式
+
+    调色板图像按索引平均没有意义，转换为RGBA；二值图像和16位灰度图像reduce不支持。
+
+    参数：
+        image: 已解码的图像
+
+    返回：
+        可直接调用reduce的图像
+    """
+    if image.mode in ('P', 'PA'):
+        return image.convert('RGBA')
+    if image.mode == '1':
+        return image.convert('L')
+    if image.mode.startswith('I;16'):
+        return image.convert('I')
+    return image
+
+
+def _render_full(source: str, ops: Tuple[Op, ...], scale: Tuple[float, float],
+                 annotations: Tuple[Annotation, ...]) -> Image.Image:
+    """
+    从原始分辨率的源图像重放操作日志并合成标注
+
+    坐标按scale从工作副本映射到原始分辨率。只使用传入的快照，可在后台线程中调用。
+
+    参数：
+        source: 源图像文件路径
+        ops: 在工作副本上记录的操作日志
+        scale: 原始分辨率与工作副本在X、Y方向上的尺寸比例
+        annotations: 在工作副本上绘制的当前标注
+
+    返回：
+        原始分辨率的合成图像
+    """
+    with open(source, 'rb') as f:
+        image = Image.open(f)
+        with tracing.span('decode_full', 'decode', size=image.size):
+            image.load()
+    full_ops, (scale_x, scale_y) = scale_ops(ops, scale)
+    replayer = OpReplayer(full_ops, tuple(a.scaled(scale_x, scale_y) for a in annotations))
+    with tracing.span('replay_full', 'op', ops=len(replayer.ops)):
+        return replayer.apply(_reducible(image), parallel=True)
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _format_key(format: str, quality: int) -> Tuple[str, int]:
+    """
+    规范化格式和质量，用作缓存键
+
+    参数：
+        format: 图像格式
+        quality: 图像质量
+
+    返回：
+        (大写格式名, 质量)，JPG视为JPEG，不支持质量参数的格式质量固定为0
+    """
+    format = format.upper()
+    if format == 'JPG':
+        format = 'JPEG'
+    return format, quality if format in QUALITY_FORMATS else 0
+
+
+def _quality_scale(quality: int) -> float:
+    """
+    计算质量对应的量化表缩放百分比（libjpeg的映射，WebP近似适用）
+
+    参数：
+        quality: 图像质量，范围1-100
+
+    返回：
+        缩放百分比，质量越低越大
+    """
+    quality = min(max(quality, 1), 100)
+    return 5000 / quality if quality < 50 else max(1, 200 - 2 * quality)
+
+
+def _frame_options(format: str, quality: int) -> Optional[Dict[str, Any]]:
+    """
+    获取多帧编码的额外保存参数
+
+    参数：
+        format: 图像格式
+        quality: 图像质量
+
+    返回：
+        多帧WebP的质量参数，其他格式返回None
+    """
+    format, quality = _format_key(format, quality)
+    return {'quality': quality} if format == 'WEBP' else None
+
+
+def _palette_image(image: Image.Image, colors: int) -> Image.Image:
+    """
+    将图像量化为指定颜色数的调色板图像
+
+    参数：
+        image: 输入图像
+        colors: 调色板颜色数
+
+    返回：
+        调色板模式的图像，带透明度的图像保留透明度
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    method = Image.Quantize.FASTOCTREE if image.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+    return image.quantize(colors=colors, method=method)
+
+
+def _encode_snapshot(image: Image.Image, annotations: Tuple[Annotation, ...],
+                     format: str, quality: int,
+                     frames: Optional[Tuple[bytes, Tuple[Op, ...]]] = None,
+                     full: Optional[Tuple[str, Tuple[Op, ...], Tuple[float, float]]] = None) -> bytes:
+    """
+    将底图和标注快照合成并编码
+
+    使用独立的标注图层，不触碰处理器正在使用的叠加层缓存，可在后台线程中调用。
+
+    参数：
+        image: 底图
+        annotations: 标注元组
+        format: 图像格式
+        quality: 图像质量，仅对JPEG和WebP格式有效
+        frames: 多帧输出时的(源图像字节, 操作日志)，为None时只编码底图
+        full: 底图为缩小的工作副本时的(源图像路径, 操作日志, (X比例, Y比例))，
+            此时按原始分辨率重放后编码
+
+    返回：
+        编码后的字节
+    """
+    if frames is not None:
+        return encode_frames(frames[0], frames[1], annotations, format,
+                             _frame_options(format, quality))
+    if full is not None:
+        image = _render_full(full[0], full[1], full[2], annotations)
+        annotations = ()
+
+    layer = AnnotationLayer()
+    layer.set_annotations(annotations)
+    image, save_options = _prepare_for_format(layer.composite(image), format, quality)
+    return _encoded_bytes(image, save_options)
+
+
+def _encoded_bytes(image: Image.Image, save_options: Dict[str, Any]) -> bytes:
+    """
+    编码图像
+
+    参数：
+        image: 待编码的图像
+        save_options: 传给Image.save的参数
+
+    返回：
+        编码后的字节
+    """
+    buffer = BytesIO()
+    with tracing.span('encode', 'encode', format=save_options['format'],
+                      quality=save_options.get('quality'), size=image.size):
+        image.save(buffer, **save_options)
+    return buffer.getvalue()
+
+
+def _encoded_size(image: Image.Image, save_options: Dict[str, Any]) -> int:
+    """
+    计算图像编码后的字节数
+
+    参数：
+        image: 待编码的图像
+        save_options: 传给Image.save的参数
+
+    返回：
+        编码后的字节数
+    """
+    buffer = BytesIO()
+    with tracing.span('encode_sample', 'encode', format=save_options['format'], size=image.size):
+        image.save(buffer, **save_options)
+    return buffer.tell()
 
 
 class ImageProcessor:
@@ -29,26 +341,59 @@ class ImageProcessor:
     提供完整的图像处理功能，包括基础操作、绘图功能和历史记录管理。
     """
     
-    def __init__(self) -> None:
+    def __init__(self, max_history: int = 50, history_budget: int = 256 * 1024 * 1024,
+                 pre_encode_delay: Optional[float] = None,
+                 derived_cache: Optional[DerivedCache] = None,
+                 memory_budget: Optional[int] = DEFAULT_MEMORY_BUDGET) -> None:
         """
         初始化图像处理器
         
         创建一个新的图像处理器实例，初始化图像对象和历史记录。
         
+        参数：
+            max_history: 最多保留的历史状态数量，默认50
+            history_budget: 历史记录内存压缩层的字节预算，超出部分溢出到磁盘，默认256MB
+            pre_encode_delay: 编辑空闲多少秒后按上次保存的格式在后台预编码，
+                为None时不预编码（默认，适用于单次命令行调用）
+            derived_cache: 按历史状态缓存派生数据的缓存，为None时使用进程内共享缓存
+            memory_budget: 工作图像解码后的字节数上限，超出时JPEG编辑在解码阶段缩小的副本，
+                其他格式拒绝加载；为None时不限制，默认256MB
+        
         异常：
             无
         """
         self.image: Optional[Image.Image] = None
         self.original_image: Optional[Image.Image] = None
-        self.history: List[Image.Image] = []
-        self.history_index: int = -1
+        self.layer: AnnotationLayer = AnnotationLayer()
+        self.history: HistoryStore = HistoryStore(max_history, history_budget)
+        self.dirty_box: Optional[Box] = None
+        self._pending_dirty: Optional[Box] = None
+        self._next_annotation_id: int = 1
+        self.n_frames: int = 1
+        self._frame_source: Optional[bytes] = None
+        self._ops: Tuple[Op, ...] = ()
+        self.derived: DerivedCache = derived_cache or get_derived_cache()
+        self.history.on_discard = self.derived.drop_states
+        self._last_save_format: Optional[Tuple[str, int]] = None
+        self.last_size_search: Optional[Dict[str, Any]] = None
+        self.memory_budget = memory_budget
+        self.load_notice: Optional[Dict[str, Any]] = None
+        self.load_error: Optional[str] = None
+        self._full_source: Optional[str] = None
+        self._full_scale: Tuple[float, float] = (1.0, 1.0)
+        self._release_full_source: Optional[weakref.finalize] = None
+        self._pre_encoder: Optional[PreEncoder] = None
+        if pre_encode_delay is not None:
+            self._pre_encoder = PreEncoder(_encode_snapshot, pre_encode_delay)
     
+    @tracing.traced()
     def load_from_base64(self, base64_data: str) -> bool:
         """
         从Base64数据加载图像
         
         解析Base64编码的图像数据并创建PIL图像对象，同时初始化历史记录。
         支持带有data URL前缀的Base64数据。
+        多帧图像以第一帧作为编辑预览，源数据保留用于保存全部帧。
         
         参数：
             base64_data: Base64编码的图像数据，可包含data URL前缀
@@ -68,25 +413,55 @@ class ImageProcessor:
             # 解码Base64数据
             image_data = base64.b64decode(base64_data)
             
-            # 创建PIL图像对象
-            self.image = Image.open(BytesIO(image_data))
-            self.original_image = self.image.copy()
+        except Exception as e:
+            print(f"加载图像失败: {e}", file=sys.stderr)
+            self.load_error = str(e)
+            return False
+        
+        return self.load_from_bytes(image_data)
+    
+    @tracing.traced()
+    def load_from_bytes(self, image_data: bytes) -> bool:
+        """
+        从编码后的图像字节加载图像
+        
+        用于剪贴板监听等已经持有原始文件字节的场景，省去Base64编解码。
+        解码后超出内存预算的图像按_open_within_budget()加载缩小的工作副本，
+        处理情况记录在load_notice中。
+        
+        参数：
+            image_data: PIL支持的任意格式的图像文件字节
+            
+        返回：
+            加载是否成功
+            
+        异常：
+            IOError: 当图像数据无法解析时抛出
+        """
+        try:
+            # 创建PIL图像对象，超出内存预算时解码为缩小的工作副本
+            self.load_error = None
+            self.image = self._open_within_budget(BytesIO(image_data), image_data)
+            self._init_frames(image_data)
+            self.original_image = self.image
             
             # 初始化历史记录
-            self.history = [self.image.copy()]
-            self.history_index = 0
+            self._init_history()
             
             return True
             
         except Exception as e:
             print(f"加载图像失败: {e}", file=sys.stderr)
+            self.load_error = str(e)
             return False
     
+    @tracing.traced()
     def load_from_file(self, file_path: str) -> bool:
         """
         从文件加载图像
         
-        从指定的文件路径加载图像，支持PIL支持的所有图像格式。
+        从指定的文件路径加载图像，支持PIL支持的所有图像格式以及原始帧格式。
+        多帧图像以第一帧作为编辑预览，源数据保留用于保存全部帧。
         
         参数：
             file_path: 图像文件的完整路径
@@ -99,19 +474,68 @@ class ImageProcessor:
             IOError: 当文件无法读取或格式不支持时抛出
         """
         try:
-            self.image = Image.open(file_path)
-            self.original_image = self.image.copy()
+            if is_raw_frame(file_path):
+                return self.load_from_raw(file_path)
+            
+            # 超出内存预算时解码为缩小的工作副本
+            self.load_error = None
+            self.image = self._open_within_budget(file_path, file_path)
+            
+            # 多帧图像保留源文件字节，保存时逐帧解码
+            image_data = None
+            if frame_count(self.image) > 1:
+                with open(file_path, 'rb') as f:
+                    image_data = f.read()
+            self._init_frames(image_data)
+            self.original_image = self.image
             
             # 初始化历史记录
-            self.history = [self.image.copy()]
-            self.history_index = 0
+            self._init_history()
             
             return True
             
         except Exception as e:
             print(f"加载图像文件失败: {e}", file=sys.stderr)
+            self.load_error = str(e)
+            return False
+    
+    @tracing.traced()
+    def load_from_raw(self, file_path: str) -> bool:
+        """
+        从原始帧文件加载图像
+        
+        通过mmap直接映射像素数据，跳过压缩格式的解码。映射的图像为只读，
+        由于底图不会被原地修改，可以直接作为工作图像和历史记录的初始状态。
+        Windows上复制像素后即关闭映射，之后可以覆盖该文件。
+        
+        参数：
+            file_path: 原始帧文件路径
+            
+        返回：
+            加载是否成功
+            
+        异常：
+            ValueError: 当文件不是有效的原始帧时抛出
+            IOError: 当文件无法读取时抛出
+        """
+        try:
+            self.load_error = None
+            self._drop_full_source()
+            self.image = open_raw_frame(file_path)
+            self._init_frames(None)
+            self.original_image = self.image
+            
+            # 初始化历史记录
+            self._init_history()
+            
+            return True
+            
+        except Exception as e:
+            print(f"加载原始帧失败: {e}", file=sys.stderr)
+            self.load_error = str(e)
             return False
     
+    @tracing.traced()
     def crop(self, x: int, y: int, width: int, height: int) -> bool:
         """
         裁剪图像
@@ -134,6 +558,8 @@ class ImageProcessor:
             if not self.image:
                 return False
             
+            self._flatten_annotations()
+            
             # 确保裁剪区域在图像范围内
             img_width, img_height = self.image.size
             x = max(0, min(x, img_width))
@@ -143,7 +569,7 @@ class ImageProcessor:
             
             # 执行裁剪
             crop_box = (x, y, x + width, y + height)
-            self.image = self.image.crop(crop_box)
+            self._apply_op(('crop', crop_box))
             
             # 添加到历史记录
             self._add_to_history()
@@ -154,11 +580,13 @@ class ImageProcessor:
             print(f"裁剪图像失败: {e}", file=sys.stderr)
             return False
     
+    @tracing.traced()
     def rotate(self, angle: float) -> bool:
         """
         旋转图像
         
         按指定角度旋转图像，使用白色背景填充空白区域。
+        大图像的任意角度旋转按水平条带在线程池中并行计算，结果与单线程一致。
         
         参数：
             angle: 旋转角度（度），正值为顺时针旋转
@@ -173,8 +601,10 @@ class ImageProcessor:
             if not self.image:
                 return False
             
+            self._flatten_annotations()
+            
             # 执行旋转，使用白色背景填充
-            self.image = self.image.rotate(-angle, expand=True, fillcolor='white')
+            self._apply_op(('rotate', (-angle,)))
             
             # 添加到历史记录
             self._add_to_history()
@@ -185,6 +615,7 @@ class ImageProcessor:
             print(f"旋转图像失败: {e}", file=sys.stderr)
             return False
     
+    @tracing.traced()
     def flip_horizontal(self) -> bool:
         """
         水平翻转图像
@@ -201,7 +632,9 @@ class ImageProcessor:
             if not self.image:
                 return False
             
-            self.image = self.image.transpose(Image.FLIP_LEFT_RIGHT)
+            self._flatten_annotations()
+            
+            self._apply_op(('flip_horizontal', ()))
             
             # 添加到历史记录
             self._add_to_history()
@@ -212,6 +645,7 @@ class ImageProcessor:
             print(f"水平翻转失败: {e}", file=sys.stderr)
             return False
     
+    @tracing.traced()
     def flip_vertical(self) -> bool:
         """
         垂直翻转图像
@@ -228,7 +662,9 @@ class ImageProcessor:
             if not self.image:
                 return False
             
-            self.image = self.image.transpose(Image.FLIP_TOP_BOTTOM)
+            self._flatten_annotations()
+            
+            self._apply_op(('flip_vertical', ()))
             
             # 添加到历史记录
             self._add_to_history()
@@ -239,12 +675,15 @@ class ImageProcessor:
             print(f"垂直翻转失败: {e}", file=sys.stderr)
             return False
     
+    @tracing.traced()
     def add_text(self, text: str, x: int, y: int, font_size: int = 24, 
-                 color: str = 'black', font_path: Optional[str] = None) -> bool:
+                 color: str = 'black', font_path: Optional[str] = None,
+                 blend: bool = False) -> bool:
         """
         添加文字标注
         
         在图像的指定位置添加文字。支持自定义字体、大小和颜色。
+        文字作为矢量标注保存在标注图层中，导出时才合成到图像上。
         
         参数：
             text: 要添加的文字内容
@@ -253,6 +692,8 @@ class ImageProcessor:
             font_size: 字体大小，默认24像素
             color: 文字颜色，支持颜色名称或十六进制值，默认黑色
             font_path: 字体文件路径，为None时使用系统默认字体
+            blend: 为True时在RGB、L模式的图像上也按颜色的透明度混合，
+                默认与直接绘制一致，忽略透明度
             
         返回：
             操作是否成功
@@ -265,24 +706,9 @@ class ImageProcessor:
             if not self.image:
                 return False
             
-            # 创建绘图对象
-            draw = ImageDraw.Draw(self.image)
-            
-            # 加载字体
-            try:
-                if font_path and os.path.exists(font_path):
-                    font = ImageFont.truetype(font_path, font_size)
-                else:
-                    # 尝试使用系统默认字体
-                    font = ImageFont.load_default()
-            except:
-                font = ImageFont.load_default()
-            
-            # 绘制文字
-            draw.text((x, y), text, fill=color, font=font)
-            
-            # 添加到历史记录
-            self._add_to_history()
+            self._add_annotation(TextAnnotation(
+                self._next_annotation_id, text, x, y, font_size, color, font_path, blend
+            ))
             
             return True
             
@@ -290,6 +716,7 @@ class ImageProcessor:
             print(f"添加文字失败: {e}", file=sys.stderr)
             return False
     
+    @tracing.traced()
     def draw_rectangle(self, x1: int, y1: int, x2: int, y2: int, 
                       outline_color: str = 'black', fill_color: Optional[str] = None, 
                       width: int = 2) -> bool:
@@ -297,6 +724,7 @@ class ImageProcessor:
         绘制矩形
         
         在图像上绘制矩形，支持自定义边框和填充颜色。
+        矩形作为矢量标注保存在标注图层中，导出时才合成到图像上。
         
         参数：
             x1: 矩形左上角X坐标
@@ -317,11 +745,9 @@ class ImageProcessor:
             if not self.image:
                 return False
             
-            draw = ImageDraw.Draw(self.image)
-            draw.rectangle([x1, y1, x2, y2], outline=outline_color, fill=fill_color, width=width)
-            
-            # 添加到历史记录
-            self._add_to_history()
+            self._add_annotation(RectangleAnnotation(
+                self._next_annotation_id, x1, y1, x2, y2, outline_color, fill_color, width
+            ))
             
             return True
             
@@ -329,6 +755,7 @@ class ImageProcessor:
             print(f"绘制矩形失败: {e}", file=sys.stderr)
             return False
     
+    @tracing.traced()
     def draw_circle(self, x: int, y: int, radius: int, 
                    outline_color: str = 'black', fill_color: Optional[str] = None, 
                    width: int = 2) -> bool:
@@ -336,6 +763,7 @@ class ImageProcessor:
         绘制圆形
         
         在图像上绘制圆形，支持自定义边框和填充颜色。
+        圆形作为矢量标注保存在标注图层中，导出时才合成到图像上。
         
         参数：
             x: 圆心X坐标
@@ -355,12 +783,9 @@ class ImageProcessor:
             if not self.image:
                 return False
             
-            draw = ImageDraw.Draw(self.image)
-            bbox = [x - radius, y - radius, x + radius, y + radius]
-            draw.ellipse(bbox, outline=outline_color, fill=fill_color, width=width)
-            
-            # 添加到历史记录
-            self._add_to_history()
+            self._add_annotation(CircleAnnotation(
+                self._next_annotation_id, x, y, radius, outline_color, fill_color, width
+            ))
             
             return True
             
@@ -368,12 +793,14 @@ class ImageProcessor:
             print(f"绘制圆形失败: {e}", file=sys.stderr)
             return False
     
+    @tracing.traced()
     def draw_line(self, x1: int, y1: int, x2: int, y2: int, 
                  color: str = 'black', width: int = 2) -> bool:
         """
         绘制直线
         
         在图像上绘制从起点到终点的直线。
+        直线作为矢量标注保存在标注图层中，导出时才合成到图像上。
         
         参数：
             x1: 起点X坐标
@@ -393,11 +820,9 @@ class ImageProcessor:
             if not self.image:
                 return False
             
-            draw = ImageDraw.Draw(self.image)
-            draw.line([x1, y1, x2, y2], fill=color, width=width)
-            
-            # 添加到历史记录
-            self._add_to_history()
+            self._add_annotation(LineAnnotation(
+                self._next_annotation_id, x1, y1, x2, y2, color, width
+            ))
             
             return True
             
@@ -405,16 +830,22 @@ class ImageProcessor:
             print(f"绘制直线失败: {e}", file=sys.stderr)
             return False
     
-    def save_to_file(self, file_path: str, format: str = 'PNG', quality: int = 95) -> bool:
+    @tracing.traced()
+    def save_to_file(self, file_path: str, format: str = 'PNG', quality: int = 95,
+                     max_bytes: Optional[int] = None) -> bool:
         """
         保存图像到文件
         
         将当前图像保存到指定路径，支持多种图像格式。对于JPEG格式会自动处理透明度。
+        先写入同一目录下的临时文件，完成后原子替换目标文件。
+        指定max_bytes时按encode_to_size()查找满足大小上限的编码，结果记录在last_size_search中。
         
         参数：
             file_path: 保存文件的完整路径
             format: 图像格式（PNG、JPEG、BMP、GIF等），默认PNG
-            quality: 图像质量，仅对JPEG格式有效，范围1-100，默认95
+            quality: 图像质量，仅对JPEG和WebP格式有效，范围1-100，默认95；
+                目标大小模式下为允许的最高质量
+            max_bytes: 文件大小上限（字节），为None时不限制
             
         返回：
             保存是否成功
@@ -430,17 +861,12 @@ class ImageProcessor:
             # 确保目录存在
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
             
-            # 保存图像
-            if format.upper() == 'JPEG' or format.upper() == 'JPG':
-                # JPEG不支持透明度，需要转换为RGB
-                if self.image.mode in ('RGBA', 'LA', 'P'):
-                    rgb_image = Image.new('RGB', self.image.size, (255, 255, 255))
-                    rgb_image.paste(self.image, mask=self.image.split()[-1] if self.image.mode == 'RGBA' else None)
-                    rgb_image.save(file_path, format='JPEG', quality=quality)
-                else:
-                    self.image.save(file_path, format='JPEG', quality=quality)
-            else:
-                self.image.save(file_path, format=format)
+            # 合成标注图层并编码，当前状态已编码过时直接复用
+            self._remember_save_format(format, quality)
+            data = self._encoded_within(format, quality, max_bytes)
+            
+            # 先写临时文件再原子替换，失败时不会留下不完整的目标文件
+            atomic_write_bytes(file_path, data)
             
             return True
             
@@ -448,138 +874,1053 @@ class ImageProcessor:
             print(f"保存图像失败: {e}", file=sys.stderr)
             return False
     
-    def to_base64(self, format: str = 'PNG', quality: int = 95) -> Optional[str]:
+    @tracing.traced()
+    def save_async(self, queue: SaveQueue, file_path: str, format: str = 'PNG',
+                   quality: int = 95) -> Optional[int]:
         """
-        将图像转换为Base64字符串
+        提交后台保存任务
         
-        将当前图像编码为Base64格式的data URL，便于在Web环境中使用。
+        以当前底图和标注元组作为快照，合成、编码和写入都在保存队列的工作线程中进行，
+        提交后即可继续编辑。后台已预编码当前状态时直接写出已编码的字节。
         
         参数：
+            queue: 保存队列
+            file_path: 保存文件的完整路径
             format: 图像格式（PNG、JPEG、BMP、GIF等），默认PNG
-            quality: 图像质量，仅对JPEG格式有效，范围1-100，默认95
+            quality: 图像质量，仅对JPEG和WebP格式有效，范围1-100，默认95
             
         返回：
-            Base64编码的data URL字符串，失败时返回None
+            任务ID，没有图像或提交失败时返回None
             
         异常：
-            ValueError: 当格式不支持或质量参数无效时抛出
-            MemoryError: 当图像过大无法编码时抛出
+            无
         """
         try:
             if not self.image:
                 return None
             
-            buffer = BytesIO()
-            
-            if format.upper() == 'JPEG' or format.upper() == 'JPG':
-                # JPEG不支持透明度，需要转换为RGB
-                if self.image.mode in ('RGBA', 'LA', 'P'):
-                    rgb_image = Image.new('RGB', self.image.size, (255, 255, 255))
-                    rgb_image.paste(self.image, mask=self.image.split()[-1] if self.image.mode == 'RGBA' else None)
-                    rgb_image.save(buffer, format='JPEG', quality=quality)
-                else:
-                    self.image.save(buffer, format='JPEG', quality=quality)
-            else:
-                self.image.save(buffer, format=format)
-            
-            buffer.seek(0)
-            base64_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
-            return f"data:image/{format.lower()};base64,{base64_data}"
+            self._remember_save_format(format, quality)
+            data = self._cached_encoding(format, quality)
+            if data is None:
+                data = partial(_encode_snapshot, self.image, self.layer.annotations, format, quality,
+                               self._frame_args(format), self._full_args())
+            return queue.submit(file_path, data)
             
         except Exception as e:
-            print(f"转换为Base64失败: {e}", file=sys.stderr)
+            print(f"提交后台保存失败: {e}", file=sys.stderr)
             return None
     
-    def undo(self) -> bool:
+    @tracing.traced()
+    def save_to_raw(self, file_path: str) -> bool:
         """
-        撤销操作
+        保存图像为原始帧文件
         
-        回退到历史记录中的上一个状态。
+        合成标注后直接写出像素数据，不做压缩编码，便于交给其他进程或处理阶段。
         
+        参数：
+            file_path: 保存文件的完整路径
+            
         返回：
-            撤销是否成功，如果已经是最早状态则返回False
+            保存是否成功
             
         异常：
-            无
+            IOError: 当文件无法写入时抛出
         """
-        if self.history_index > 0:
-            self.history_index -= 1
-            self.image = self.history[self.history_index].copy()
+        try:
+            if not self.image:
+                return False
+            
+            # 确保目录存在
+            os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+            
+            write_raw_frame(self._output_image(), file_path)
+            
             return True
-        return False
+            
+        except Exception as e:
+            print(f"保存原始帧失败: {e}", file=sys.stderr)
+            return False
     
-    def redo(self) -> bool:
+    @tracing.traced()
+    def to_base64(self, format: str = 'PNG', quality: int = 95,
+                  max_bytes: Optional[int] = None) -> Optional[str]:
         """
-        重做操作
+        将图像转换为Base64字符串
         
-        前进到历史记录中的下一个状态。
+        将当前图像编码为Base64格式的data URL，便于在Web环境中使用。
+        指定max_bytes时限制的是编码后的字节数，不含Base64膨胀。
         
+        参数：
+            format: 图像格式（PNG、JPEG、BMP、GIF等），默认PNG
+            quality: 图像质量，仅对JPEG和WebP格式有效，范围1-100，默认95；
+                目标大小模式下为允许的最高质量
+            max_bytes: 编码大小上限（字节），为None时不限制
+            
         返回：
-            重做是否成功，如果已经是最新状态则返回False
+            Base64编码的data URL字符串，失败时返回None
             
         异常：
-            无
+            ValueError: 当格式不支持或质量参数无效时抛出
+            MemoryError: 当图像过大无法编码时抛出
         """
-        if self.history_index < len(self.history) - 1:
-            self.history_index += 1
-            self.image = self.history[self.history_index].copy()
-            return True
-        return False
+        try:
+            if not self.image:
+                return None
+            
+            # 合成标注图层并编码，当前状态已编码过时直接复用
+            data = self._encoded_within(format, quality, max_bytes)
+            base64_data = base64.b64encode(data).decode('utf-8')
+            
+            return f"data:image/{format.lower()};base64,{base64_data}"
+            
+        except Exception as e:
+            print(f"转换为Base64失败: {e}", file=sys.stderr)
+            return None
     
-    def _add_to_history(self) -> None:
+    @tracing.traced()
+    def to_bytes(self, format: str = 'PNG', quality: int = 95,
+                 max_bytes: Optional[int] = None) -> Optional[bytes]:
         """
-        添加当前状态到历史记录
+        将图像编码为文件字节
         
-        将当前图像状态保存到历史记录中，用于撤销/重做功能。
-        自动管理历史记录数量，最多保留20个状态。
+        与save_to_file()使用相同的合成和编码逻辑，但不写入文件，
+        便于批量转换等由调用方安排写入的场景。
+        
+        参数：
+            format: 图像格式（PNG、JPEG、BMP、GIF等），默认PNG
+            quality: 图像质量，仅对JPEG和WebP格式有效，范围1-100，默认95；
+                目标大小模式下为允许的最高质量
+            max_bytes: 编码大小上限（字节），为None时不限制
+        
+        返回：
+            编码后的字节，失败时返回None
         
         异常：
-            无
+            ValueError: 当格式不支持或质量参数无效时抛出
         """
-        if self.image is None:
-            return
+        try:
+            if not self.image:
+                return None
             
-        # 移除当前位置之后的历史记录
-        self.history = self.history[:self.history_index + 1]
-        
-        # 添加新状态
-        self.history.append(self.image.copy())
-        self.history_index += 1
-        
-        # 限制历史记录数量（最多保留20个状态）
-        if len(self.history) > 20:
-            self.history.pop(0)
-            self.history_index -= 1
+            return self._encoded_within(format, quality, max_bytes)
+            
+        except Exception as e:
+            print(f"编码图像失败: {e}", file=sys.stderr)
+            return None
     
-    def get_image_info(self) -> Optional[Dict[str, Any]]:
+    @tracing.traced()
+    def estimate_size(self, format: str = 'PNG', quality: int = 95) -> Optional[Dict[str, Any]]:
         """
-        获取图像信息
+        估算输出文件大小
         
-        返回当前图像的基本信息，包括尺寸、颜色模式等。
-
+        小图像直接完整编码。大图像从上到下均匀抽取若干整行宽的水平条带，
+        在线程池中分别编码，按每像素字节数外推到整张图像，并给出约95%置信度的误差界。
+        每个条带连同其上方等高的引导区一起编码，再减去单独编码引导区的大小，
+        从而扣除压缩器在条带起始处缺少上下文带来的额外开销。
+        多帧输出按第一帧乘以帧数粗略外推，不区分帧间差分压缩，通常偏大。
+        结果按历史状态、格式和质量缓存在派生数据缓存中。
+        
+        参数：
+            format: 图像格式（PNG、JPEG、BMP、GIF等），默认PNG
+            quality: 图像质量，仅对JPEG和WebP格式有效，范围1-100，默认95
+            
         返回：
-            包含图像信息的字典，如果没有加载图像则返回None
-            字典包含以下键：
-            - width: 图像宽度
-            - height: 图像高度
-            - mode: 颜色模式（RGB、RGBA等）
-            - format: 原始文件格式
-            - has_transparency: 是否包含透明度
+            包含format、quality、estimated_size、error_bound（字节）、
+            exact（是否为精确值）和sample_ratio（抽样像素占比）的字典，失败时返回None
             
         异常：
             无
         """
-        if not self.image:
+        try:
+            if not self.image:
+                return None
+            
+            format_key = _format_key(format, quality)
+            format = format_key[0]
+            state_id = self.history.current.state_id
+            cached = self.derived.get(state_id, 'estimate', format_key)
+            if cached is not None:
+                # 不支持质量参数的格式以质量0为键，不同质量共享同一条目，返回本次的质量
+                return dict(cached, quality=quality)
+            
+            image, save_options = self._prepared(format, quality)
+            width, height = image.size
+            pixels = width * height
+            rows = ESTIMATE_BAND_ROWS
+            bands = min(ESTIMATE_SAMPLE_BANDS, height // (rows * 4))
+            
+            if pixels <= EXACT_ESTIMATE_MAX_PIXELS or bands < 2:
+                estimate = {
+                    'format': format,
+                    'quality': quality,
+                    'estimated_size': _encoded_size(image, save_options),
+                    'error_bound': 0,
+                    'exact': True,
+                    'sample_ratio': 1.0
+                }
+            else:
+                # 引导区起点按行数对齐，条带均匀分布在整张图像上
+                step = (height - rows * 2) / (bands - 1)
+                tops = [int(i * step) // rows * rows for i in range(bands)]
+                jobs = []
+                for top in tops:
+                    jobs.append(image.crop((0, top, width, top + rows)))
+                    jobs.append(image.crop((0, top, width, top + rows * 2)))
+                
+                # 文件头、调色板等固定开销用一个极小的图像测得
+                jobs.append(image.crop((0, 0, min(width, 8), min(height, 8))))
+                sizes = list(get_worker_pool().map(lambda im: _encoded_size(im, save_options), jobs))
+                overhead = sizes[-1]
+                band_pixels = width * rows
+                rates = [max(0, sizes[i + 1] - sizes[i]) / band_pixels for i in range(0, bands * 2, 2)]
+                
+                mean = sum(rates) / bands
+                variance = sum((r - mean) ** 2 for r in rates) / (bands - 1)
+                sampled = bands * band_pixels
+                # 有限总体校正：抽样占比越高，外推误差越小
+                correction = max(0.0, 1 - sampled / pixels) ** 0.5
+                estimated = int(round(overhead + mean * pixels))
+                bound = 1.96 * (variance / bands) ** 0.5 * pixels * correction
+                bound = max(bound, estimated * ESTIMATE_MIN_MARGIN)
+                
+                estimate = {
+                    'format': format,
+                    'quality': quality,
+                    'estimated_size': estimated,
+                    'error_bound': int(round(bound)),
+                    'exact': False,
+                    'sample_ratio': round(sampled / pixels, 4)
+                }
+            
+            if self._frame_args(format) is not None:
+                estimate['estimated_size'] *= self.n_frames
+                estimate['error_bound'] = max(estimate['error_bound'] * self.n_frames,
+                                              int(estimate['estimated_size'] * ESTIMATE_MIN_MARGIN))
+                estimate['exact'] = False
+                estimate['sample_ratio'] = round(estimate['sample_ratio'] / self.n_frames, 4)
+            
+            self.derived.put(state_id, 'estimate', format_key, estimate)
+            return dict(estimate)
+            
+        except Exception as e:
+            print(f"估算文件大小失败: {e}", file=sys.stderr)
+            return None
+    
+    @tracing.traced()
+    def thumbnail(self, source: str, max_width: int = 256, max_height: int = 256,
+                  format: str = 'PNG', cache: Optional[DiskCache] = None) -> Optional[str]:
+        """
+        生成缩略图
+
+        直接从图像源生成缩略图，不加载到处理器也不影响历史记录。
+        JPEG图像通过draft()在解码阶段按DCT缩放，其他格式解码后先用reduce()
+        做整数倍缩小，最后再做一次高质量重采样。结果按源数据哈希和目标尺寸缓存。
+
+        参数：
+            source: 图像文件路径或Base64编码的图像数据
+            max_width: 缩略图最大宽度，默认256像素
+            max_height: 缩略图最大高度，默认256像素
+            format: 缩略图格式，默认PNG
+            cache: 缩略图磁盘缓存，为None时不使用缓存
+
+        返回：
+            Base64编码的data URL字符串，失败时返回None
+
+        异常：
+            ValueError: 当尺寸参数无效时抛出
+            IOError: 当图像源无法读取或解码时抛出
+        """
+        try:
+            if max_width <= 0 or max_height <= 0:
+                raise ValueError(f"缩略图尺寸无效: {max_width}x{max_height}")
+
+            data = _read_source_bytes(source)
+            key = f"thumbnail:{hashlib.sha1(data).hexdigest()}:{max_width}x{max_height}:{format.upper()}"
+
+            encoded = cache.get(key) if cache else None
+            if encoded is None:
+                thumb = self._decode_thumbnail(data, max_width, max_height)
+
+                buffer = BytesIO()
+                if format.upper() == 'JPEG' or format.upper() == 'JPG':
+                    if thumb.mode in ('RGBA', 'LA'):
+                        rgb_image = Image.new('RGB', thumb.size, (255, 255, 255))
+                        rgb_image.paste(thumb, mask=thumb.split()[-1])
+                        thumb = rgb_image
+                    thumb.convert('RGB').save(buffer, format='JPEG', quality=85)
+                else:
+                    thumb.save(buffer, format=format)
+                encoded = buffer.getvalue()
+
+                if cache:
+                    cache.put(key, encoded)
+
+            base64_data = base64.b64encode(encoded).decode('utf-8')
+            return f"data:image/{format.lower()};base64,{base64_data}"
+
+        except Exception as e:
+            print(f"生成缩略图失败: {e}", file=sys.stderr)
             return None
 
-        return {
-            'width': self.image.width,
-            'height': self.image.height,
-            'mode': self.image.mode,
-            'format': self.image.format,
-            'has_transparency': self.image.mode in ('RGBA', 'LA', 'P')
+    @staticmethod
+    def _decode_thumbnail(data: bytes, max_width: int, max_height: int) -> Image.Image:
+        """
+        以尽量低的解码代价得到缩略图
+
+        参数：
+            data: 未解码的图像文件字节
+            max_width: 缩略图最大宽度
+            max_height: 缩略图最大高度
+
+        返回：
+            不超过目标尺寸且保持宽高比的图像
+
+        异常：
+            IOError: 当图像数据无法解码时抛出
+        """
+        image = Image.open(BytesIO(data))
+
+        # JPEG在解码阶段即可按1/2、1/4、1/8缩放，保留2倍余量用于最终重采样
+        if image.format == 'JPEG':
+            image.draft(None, (max_width * 2, max_height * 2))
+
+        image.load()
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+
+        # 整数倍缩小代价很低，同样保留2倍余量
+        factor = int(min(image.width / (max_width * 2), image.height / (max_height * 2)))
+        if factor > 1:
+            image = image.reduce(factor)
+
+        image.thumbnail((max_width, max_height), Image.LANCZOS, reducing_gap=None)
+        return image
+
+    @tracing.traced()
+    def get_patch(self, x: Optional[int] = None, y: Optional[int] = None,
+                  width: Optional[int] = None, height: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        获取局部更新补丁
+        
+        将指定区域（默认为最近一次操作的脏区域）的合成结果编码为PNG，
+        前端可直接贴到画布对应位置，无需重新传输整张图像。
+        
+        参数：
+            x: 区域左上角X坐标，为None时使用脏区域
+            y: 区域左上角Y坐标
+            width: 区域宽度
+            height: 区域高度
+            
+        返回：
+            包含x、y、width、height和base64（PNG data URL）的字典，
+            没有需要刷新的区域或失败时返回None
+            
+        异常：
+            无
+        """
+        try:
+            if not self.image:
+                return None
+            
+            if x is None or y is None or width is None or height is None:
+                box = self.dirty_box
+            else:
+                box = clip_box((x, y, x + width, y + height), self.image.size)
+            if box is None:
+                return None
+            
+            region = self.layer.composite_region(self.image, box)
+            buffer = BytesIO()
+            region.save(buffer, format='PNG')
+            base64_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            
+            return {
+                'x': box[0],
+                'y': box[1],
+                'width': box[2] - box[0],
+                'height': box[3] - box[1],
+                'base64': f"data:image/png;base64,{base64_data}"
+            }
+            
+        except Exception as e:
+            print(f"生成局部补丁失败: {e}", file=sys.stderr)
+            return None
+    
+    @tracing.traced()
+    def undo(self) -> bool:
+        """
+        撤销操作
+        
+        回退到历史记录中的上一个状态。
+        
+        返回：
+            撤销是否成功，如果已经是最早状态则返回False
+            
+        异常：
+            无
+        """
+        state = self.history.undo()
+        if state is not None:
+            self._restore_state(state)
+            return True
+        return False
+    
+    @tracing.traced()
+    def redo(self) -> bool:
+        """
+        重做操作
+        
+        前进到历史记录中的下一个状态。
+        
+        返回：
+            重做是否成功，如果已经是最新状态则返回False
+            
+        异常：
+            无
+        """
+        state = self.history.redo()
+        if state is not None:
+            self._restore_state(state)
+            return True
+        return False
+    
+    def _add_to_history(self) -> None:
+        """
+        添加当前状态到历史记录
+        
+        将当前图像状态保存到历史记录中，用于撤销/重做功能。
+        历史记录数量和各层存储由HistoryStore管理：相邻状态常驻内存，
+        较远状态压缩保存，超出预算时溢出到磁盘。
+        底图不会被原地修改，因此直接保存引用而不复制。
+        
+        异常：
+            无
+        """
+        if self.image is None:
+            return
+        
+        self._update_dirty_box(self.history.current.image)
+        with tracing.span('history.push', 'history', states=len(self.history)):
+            self.history.push(self.image, self.layer.annotations, self._ops)
+        self._schedule_pre_encode()
+    
+    @property
+    def history_index(self) -> int:
+        """当前状态在历史记录中的位置，没有历史记录时为-1"""
+        return self.history.index
+    
+    def _restore_state(self, state: HistoryState) -> None:
+        """
+        恢复历史记录状态
+        
+        参数：
+            state: 要恢复的历史记录状态
+        """
+        previous_image = self.image
+        self.image = state.image
+        self._ops = state.ops
+        self._set_annotations(state.annotations)
+        self._update_dirty_box(previous_image)
+        self._schedule_pre_encode()
+    
+    def _init_history(self) -> None:
+        """
+        以当前图像初始化历史记录和标注图层
+        """
+        self.layer = AnnotationLayer()
+        self._ops = ()
+        self.history.reset(self.image)
+        self.dirty_box = (0, 0, self.image.width, self.image.height)
+        self._pending_dirty = None
+        self._schedule_pre_encode()
+    
+    def _schedule_pre_encode(self) -> None:
+        """
+        当前状态变化后重新安排后台预编码
+        
+        之前的预编码随即失效。尚未保存过时不知道目标格式，只取消不安排。
+        底图和标注元组都不会被原地修改，直接作为快照交给后台线程。
+        """
+        if self._pre_encoder is None:
+            return
+        if self._last_save_format is None or self.history.current is None:
+            self._pre_encoder.cancel()
+            return
+        
+        # 撤销到已经编码过的状态时无需再次编码
+        state_id = self.history.current.state_id
+        if self.derived.get(state_id, 'encoded', self._last_save_format) is not None:
+            self._pre_encoder.cancel()
+            return
+        
+        format, quality = self._last_save_format
+        key = (state_id, format, quality)
+        self._pre_encoder.schedule(key, self.image, self.layer.annotations, format, quality,
+                                   self._frame_args(format), self._full_args())
+    
+    def close(self, timeout: float = 1.0) -> None:
+        """
+        释放处理器持有的后台线程和历史记录
+        
+        关闭后台预编码线程并最多等待timeout秒，然后清空历史记录。
+        关闭后不再安排预编码，处理器不应继续使用。
+        
+        参数：
+            timeout: 等待预编码线程退出的最长秒数，默认1秒
+        """
+        if self._pre_encoder is not None:
+            self._pre_encoder.shutdown(timeout)
+            self._pre_encoder = None
+        self.history.close()
+    
+    def _init_frames(self, source: Optional[bytes]) -> None:
+        """
+        记录刚加载图像的帧信息
+        
+        多帧图像保留源文件字节，工作图像替换为独立的第一帧。
+        
+        参数：
+            source: 源文件字节，单帧图像或原始帧可为None
+        """
+        self.n_frames = frame_count(self.image)
+        self._frame_source = None
+        if self.n_frames > 1 and source is not None:
+            self._frame_source = source
+            format = self.image.format
+            self.image = normalize_frame(self.image)
+            self.image.format = format
+    
+    def _frame_args(self, format: str) -> Optional[Tuple[bytes, Tuple[Op, ...]]]:
+        """
+        获取多帧输出所需的源数据和操作日志
+        
+        参数：
+            format: 输出格式
+            
+        返回：
+            (源图像字节, 操作日志)，单帧图像或输出格式不支持多帧时返回None
+        """
+        if self._frame_source is None or _format_key(format, 0)[0] not in MULTI_FRAME_FORMATS:
+            return None
+        return self._frame_source, self._ops
+    
+    def _open_within_budget(self, fp: Any, source: Union[str, bytes]) -> Image.Image:
+        """
+        打开图像并按内存预算解码
+        
+        先只读取文件头估算解码后的大小。未超出预算时完整解码；超出时只能在解码阶段缩小：
+        JPEG通过draft按1/2、1/4、1/8中满足预算的最小比例直接解码为缩小的工作副本，
+        解码占用的内存不超过预算。其他格式无法在解码阶段缩小，完整解码会超出预算，因此拒绝加载。
+        原始分辨率的源图像保留在磁盘上（字节数据写入临时文件），保存时据此重放操作日志。
+        多帧图像保存时按原始分辨率逐帧重放，不能使用缩小副本，预算按单帧检查，超出时拒绝加载。
+        
+        参数：
+            fp: 文件路径或文件对象
+            source: 源图像文件路径或源文件字节
+            
+        返回：
+            已解码的工作图像
+            
+        异常：
+            ValueError: 当图像像素数超过Pillow的解压炸弹保护上限，多帧图像的单帧超出内存预算，
+                或图像超出预算且无法在解码阶段缩小到预算以内时抛出
+        """
+        self._drop_full_source()
+        try:
+            with tracing.span('open', 'decode'):
+                image = Image.open(fp)
+        except Image.DecompressionBombError as e:
+            raise ValueError(f"图像像素数超过解压炸弹保护上限，拒绝解码: {e}") from e
+        
+        decoded = _decoded_bytes(image.size, image.mode)
+        if self.memory_budget is None or decoded <= self.memory_budget:
+            with tracing.span('decode', 'decode', format=image.format, size=image.size):
+                image.load()
+            return image
+        
+        budget_mb = self.memory_budget // (1024 * 1024)
+        if frame_count(image) > 1:
+            image.close()
+            raise ValueError(f"多帧图像单帧解码后约{decoded // (1024 * 1024)}MB，超过内存预算"
+                             f"{budget_mb}MB；多帧图像按原始分辨率逐帧保存，不能缩小编辑")
+        
+        # 选择满足预算的最小缩小比例；draft只对JPEG有效，其他格式尺寸不变
+        format = image.format
+        width, height = image.size
+        divisor = next((d for d in (2, 4, 8) if decoded / (d * d) <= self.memory_budget), 8)
+        image.draft(None, (width // divisor, height // divisor))
+        working = _decoded_bytes(image.size, image.mode)
+        if working > self.memory_budget:
+            image.close()
+            reason = "无法在解码阶段缩小" if (width, height) == image.size else "解码阶段最多缩小到1/8"
+            raise ValueError(f"图像解码后约{decoded // (1024 * 1024)}MB，超过内存预算{budget_mb}MB，"
+                             f"{format}格式{reason}，完整解码会超出预算，拒绝加载；"
+                             f"可提高内存预算（0表示不限制）")
+        
+        with tracing.span('decode_reduced', 'decode', format=format, size=image.size):
+            image.load()
+        image.format = format
+        
+        if isinstance(source, bytes):
+            fd, path = tempfile.mkstemp(prefix='picFromClipboard-source-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(source)
+            self._release_full_source = weakref.finalize(self, _remove_file, path)
+            source = path
+        self._full_source = source
+        # draft在两个方向上分别取整，比例按方向分别计算
+        self._full_scale = (width / image.width, height / image.height)
+        self.load_notice = {
+            'action': 'downscaled',
+            'original_width': width,
+            'original_height': height,
+            'width': image.width,
+            'height': image.height,
+            'scale': round(self._full_scale[0], 4),
+            'scale_y': round(self._full_scale[1], 4),
+            'decoded_bytes': decoded,
+            'working_bytes': working,
+            'memory_budget': self.memory_budget,
+            'message': (f"图像完整解码后约{decoded // (1024 * 1024)}MB，超过内存预算{budget_mb}MB；"
+                        f"已在解码阶段直接解码为{image.width}x{image.height}的缩小副本用于编辑，"
+                        f"解码占用约{math.ceil(working / (1024 * 1024))}MB，未超出预算；"
+                        f"保存时按原始分辨率{width}x{height}输出")
         }
+        return image
+    
+    def _drop_full_source(self) -> None:
+        """
+        丢弃上一次加载的原始分辨率源图像记录，删除为其写出的临时文件
+        """
+        if self._release_full_source is not None:
+            self._release_full_source()
+            self._release_full_source = None
+        self._full_source = None
+        self._full_scale = (1.0, 1.0)
+        self.load_notice = None
+    
+    def _full_args(self) -> Optional[Tuple[str, Tuple[Op, ...], Tuple[float, float]]]:
+        """
+        获取按原始分辨率输出所需的源图像、操作日志和缩放比例
+        
+        返回：
+            (源图像路径, 操作日志, (X比例, Y比例))，工作图像不是缩小副本时返回None
+        """
+        if self._full_source is None:
+            return None
+        return self._full_source, self._ops, self._full_scale
+    
+    def _apply_op(self, op: Op) -> None:
+        """
+        对底图执行几何操作并记入操作日志
+        
+        参数：
+            op: 操作日志项
+        """
+        self.image = apply_op(self.image, op)
+        self._ops += (op,)
+    
+    def _composite(self) -> Image.Image:
+        """
+        获取当前状态合成标注后的图像
+        
+        返回：
+            合成图像，没有标注时即底图本身
+        """
+        state_id = self.history.current.state_id
+        image = self.derived.get(state_id, 'composite')
+        if image is None:
+            image = self.layer.composite(self.image)
+            # 没有标注时合成结果就是底图，不额外占用内存
+            self.derived.put(state_id, 'composite', (), image, 0 if image is self.image else None)
+        return image
+    
+    def _output_image(self) -> Image.Image:
+        """
+        获取用于保存的合成图像
+        
+        工作图像为缩小副本时，从磁盘上的源图像按原始分辨率重放操作日志并合成标注。
+        
+        返回：
+            输出分辨率的合成图像
+        """
+        full = self._full_args()
+        if full is None:
+            return self._composite()
+        
+        state_id = self.history.current.state_id
+        image = self.derived.get(state_id, 'full')
+        if image is None:
+            image = _render_full(full[0], full[1], full[2], self.layer.annotations)
+            self.derived.put(state_id, 'full', (), image)
+        return image
+    
+    def _prepared(self, format: str, quality: int) -> Tuple[Image.Image, Dict[str, Any]]:
+        """
+        获取当前状态按输出格式准备好的图像和保存参数
+        
+        JPEG的白底展平结果按格式缓存，不同质量之间共享。
+        
+        参数：
+            format: 图像格式
+            quality: 图像质量
+            
+        返回：
+            (待编码的图像, 传给Image.save的参数)
+        """
+        state_id = self.history.current.state_id
+        format_name = _format_key(format, quality)[0]
+        image = self.derived.get(state_id, 'flattened', format_name)
+        if image is not None:
+            return _prepare_for_format(image, format, quality)
+        
+        composite = self._output_image()
+        image, save_options = _prepare_for_format(composite, format, quality)
+        self.derived.put(state_id, 'flattened', format_name, image, 0 if image is composite else None)
+        return image, save_options
+    
+    def _cached_encoding(self, format: str, quality: int) -> Optional[bytes]:
+        """
+        查找当前状态已有的编码结果
+        
+        依次查找派生数据缓存和后台预编码结果。
+        
+        参数：
+            format: 图像格式
+            quality: 图像质量
+            
+        返回：
+            已编码的字节，没有匹配结果时返回None
+        """
+        format_key = _format_key(format, quality)
+        state_id = self.history.current.state_id
+        data = self.derived.get(state_id, 'encoded', format_key)
+        if data is None and self._pre_encoder is not None:
+            data = self._pre_encoder.take((state_id,) + format_key)
+            if data is not None:
+                self.derived.put(state_id, 'encoded', format_key, data)
+        return data
+    
+    def _remember_save_format(self, format: str, quality: int) -> None:
+        """
+        记录保存使用的格式，之后的编辑按该格式预编码
+        
+        只在保存时调用，预览用的to_base64()等编码不改变预编码格式。
+        当前状态正在保存，下一次编辑后才按新格式预编码。
+        
+        参数：
+            format: 图像格式
+            quality: 图像质量
+        """
+        self._last_save_format = _format_key(format, quality)
+    
+    def _encoded(self, format: str, quality: int) -> bytes:
+        """
+        获取当前状态按指定格式编码的字节
+        
+        参数：
+            format: 图像格式
+            quality: 图像质量
+            
+        返回：
+            编码后的字节
+        """
+        data = self._cached_encoding(format, quality)
+        if data is None and self._frame_args(format) is not None:
+            with tracing.span('encode_frames', 'encode', format=format, frames=self.n_frames):
+                data = encode_frames(self._frame_source, self._ops, self.layer.annotations,
+                                     _format_key(format, quality)[0], _frame_options(format, quality))
+            self.derived.put(self.history.current.state_id, 'encoded', _format_key(format, quality), data)
+        elif data is None:
+            image, save_options = self._prepared(format, quality)
+            data = _encoded_bytes(image, save_options)
+            self.derived.put(self.history.current.state_id, 'encoded', _format_key(format, quality), data)
+        return data
+    
+    def _encoded_within(self, format: str, quality: int, max_bytes: Optional[int]) -> bytes:
+        """
+        获取当前状态按指定格式编码、且不超过大小上限的字节
+        
+        查找结果按历史状态、格式和大小上限缓存，并记录在last_size_search中。
+        
+        参数：
+            format: 图像格式
+            quality: 图像质量，目标大小模式下为允许的最高质量
+            max_bytes: 编码大小上限，为None时等同于_encoded()
+            
+        返回：
+            编码后的字节
+            
+        异常：
+            ValueError: 当任何质量或调色板颜色数都无法满足大小上限时抛出
+        """
+        if max_bytes is None:
+            return self._encoded(format, quality)
+        
+        state_id = self.history.current.state_id
+        params = (_format_key(format, quality), max_bytes)
+        found = self.derived.get(state_id, 'sized', params)
+        if found is None:
+            found = self._search_size(format, quality, max_bytes)
+            self.derived.put(state_id, 'sized', params, found, len(found[0] or b''))
+        
+        data, report = found
+        self.last_size_search = dict(report)
+        if data is None:
+            raise ValueError(f"无法编码到{max_bytes}字节以内，最小可达{report['size']}字节")
+        return data
+    
+    def _search_size(self, format: str, quality: int,
+                     max_bytes: int) -> Tuple[Optional[bytes], Dict[str, Any]]:
+        """
+        查找满足大小上限的最佳编码
+        
+        JPEG和WebP在1到quality之间查找最高质量，候选在共享线程池中并行编码，
+        第一轮候选集中在由抽样估算插值得到的种子质量附近。
+        单帧PNG先尝试无损编码，超出上限时依次缩小调色板颜色数。
+        其他格式没有可调参数，只检查默认编码是否满足上限。
+        多帧输出的每个候选内部已逐帧并行，候选之间顺序评估。
+        
+        参数：
+            format: 图像格式
+            quality: 允许的最高质量
+            max_bytes: 编码大小上限
+            
+        返回：
+            (编码后的字节, 查找报告)，无法满足上限时字节为None。报告包含format、
+            max_bytes、quality、colors（调色板颜色数，无损为None）、size、fits、encodes、rounds
+        """
+        format, quality = _format_key(format, quality)
+        state_id = self.history.current.state_id
+        frames = self._frame_args(format)
+        report: Dict[str, Any] = {'format': format, 'max_bytes': max_bytes,
+                                  'quality': None, 'colors': None}
+        
+        if format in QUALITY_FORMATS:
+            if frames is not None:
+                annotations = self.layer.annotations
+                encode = lambda q: encode_frames(frames[0], frames[1], annotations, format,
+                                                 {'quality': q})
+            else:
+                image, save_options = self._prepared(format, quality)
+                encode = lambda q: _encoded_bytes(image, dict(save_options, quality=q))
+            result = search(encode, max_bytes, 1, max(1, quality),
+                            self._size_seed(format, quality, max_bytes), parallel=frames is None)
+            report['quality'] = result.value
+            if result.data is not None:
+                self.derived.put(state_id, 'encoded', (format, result.value), result.data)
+        elif format == 'PNG' and frames is None:
+            image, save_options = self._prepared(format, quality)
+            # 最后一个取值表示无损编码，其余为调色板颜色数的下标
+            lossless = len(PALETTE_COLORS)
+            encode = lambda i: _encoded_bytes(
+                image if i == lossless else _palette_image(image, PALETTE_COLORS[i]), save_options)
+            result = search(encode, max_bytes, 0, lossless)
+            if result.value is not None and result.value < lossless:
+                report['colors'] = PALETTE_COLORS[result.value]
+            elif result.value == lossless:
+                self.derived.put(state_id, 'encoded', (format, 0), result.data)
+        else:
+            data = self._encoded(format, quality)
+            fits = len(data) <= max_bytes
+            result = SearchResult(0 if fits else None, data if fits else None, len(data), 1, 1)
+        
+        report.update(size=result.size, fits=result.data is not None,
+                      encodes=result.encodes, rounds=result.rounds)
+        return result.data, report
+    
+    def _size_seed(self, format: str, quality: int, max_bytes: int) -> int:
+        """
+        由抽样估算预测满足大小上限的质量
+        
+        从最高质量开始，依次向下估算SIZE_SEED_QUALITIES中各质量点的大小，直到满足上限，
+        再在相邻两点之间插值。文件大小的对数与量化表缩放比例的对数近似成线性，
+        按此插值后换算回质量。估算结果有缓存，重复查找不会再次抽样。
+        
+        参数：
+            format: 图像格式
+            quality: 允许的最高质量
+            max_bytes: 编码大小上限
+            
+        返回：
+            预测的质量
+        """
+        high = self.estimate_size(format, quality)
+        if high is None or high['estimated_size'] <= max_bytes:
+            return quality
+        
+        high_quality = quality
+        for low_quality in [q for q in SIZE_SEED_QUALITIES if q < quality]:
+            low = self.estimate_size(format, low_quality)
+            if low is None:
+                return low_quality
+            if low['estimated_size'] <= max_bytes:
+                break
+            high_quality, high = low_quality, low
+        else:
+            return high_quality
+        
+        low_size = max(1, low['estimated_size'])
+        ratio = math.log(max_bytes / low_size) / math.log(high['estimated_size'] / low_size)
+        low_scale = math.log(_quality_scale(low_quality))
+        scale = math.exp(low_scale + ratio * (math.log(_quality_scale(high_quality)) - low_scale))
+        return int(round(5000 / scale if scale > 100 else (200 - scale) / 2))
+    
+    def _set_annotations(self, annotations: Tuple[Annotation, ...]) -> None:
+        """
+        替换标注列表并累积变化区域
+        
+        参数：
+            annotations: 新的标注元组
+        """
+        self._pending_dirty = union_boxes(self._pending_dirty, self.layer.set_annotations(annotations))
+    
+    def _update_dirty_box(self, previous_image: Optional[Image.Image]) -> None:
+        """
+        计算最近一次操作的脏区域
+        
+        底图被替换时整张图像都需要刷新；否则只有标注变化的区域需要刷新。
+        
+        参数：
+            previous_image: 操作前的底图
+        """
+        if self.image is not previous_image:
+            self.dirty_box = (0, 0, self.image.width, self.image.height)
+        elif self._pending_dirty is not None:
+            self.dirty_box = clip_box(self._pending_dirty, self.image.size)
+        else:
+            self.dirty_box = None
+        self._pending_dirty = None
+    
+    def _add_annotation(self, annotation: Annotation) -> None:
+        """
+        向标注图层添加标注并记录历史
+        
+        参数：
+            annotation: 新的标注对象
+        """
+        self._next_annotation_id = max(self._next_annotation_id, annotation.annotation_id + 1)
+        self._set_annotations(self.layer.annotations + (annotation,))
+        self._add_to_history()
+    
+    def _flatten_annotations(self) -> None:
+        """
+        将标注栅格化到底图中
+        
+        裁剪、旋转、翻转等几何操作作用于整张图像，执行前需要先把标注合成进底图。
+        合成前的矢量标注仍保留在之前的历史记录中，撤销后可继续编辑。
+        """
+        if self.image is None or not self.layer.annotations:
+            return
+        
+        self._ops += (('annotate', (self.layer.annotations,)),)
+        self.image = self._composite()
+        self._set_annotations(())
+    
+    @tracing.traced()
+    def update_annotation(self, annotation_id: int, **changes: Any) -> bool:
+        """
+        修改标注
+        
+        用修改后的新标注替换原标注，只重绘新旧标注覆盖的区域。
+        
+        参数：
+            annotation_id: 标注ID
+            **changes: 要修改的标注参数，例如x、y、color
+            
+        返回：
+            操作是否成功，标注不存在或参数无效时返回False
+            
+        异常：
+            无
+        """
+        try:
+            annotation = self.layer.find(annotation_id)
+            if annotation is None:
+                return False
+            
+            changes.pop('annotation_id', None)
+            updated = replace(annotation, **changes)
+            
+            annotations = tuple(updated if a is annotation else a for a in self.layer.annotations)
+            self._set_annotations(annotations)
+            self._add_to_history()
+            
+            return True
+            
+        except Exception as e:
+            print(f"修改标注失败: {e}", file=sys.stderr)
+            return False
+    
+    @tracing.traced()
+    def remove_annotation(self, annotation_id: int) -> bool:
+        """
+        删除标注
+        
+        参数：
+            annotation_id: 标注ID
+            
+        返回：
+            操作是否成功，标注不存在时返回False
+            
+        异常：
+            无
+        """
+        annotation = self.layer.find(annotation_id)
+        if annotation is None:
+            return False
+        
+        self._set_annotations(tuple(a for a in self.layer.annotations if a is not annotation))
+        self._add_to_history()
+        return True
+    
+    def get_annotations(self) -> List[Dict[str, Any]]:
+        """
+        获取当前所有标注
+        
+        返回：
+            按绘制顺序排列的标注字典列表
+        """
+        return [annotation.to_dict() for annotation in self.layer.annotations]
+    
+    @tracing.traced()
+    def get_image_info(self) -> Optional[Dict[str, Any]]:
+        """
+        获取图像信息
+        
+        返回当前图像的基本信息，包括尺寸、颜色模式等。
+
+        返回：
+            包含图像信息的字典，如果没有加载图像则返回None
+            字典包含以下键：
+            - width: 图像宽度
+            - height: 图像高度
+            - mode: 颜色模式（RGB、RGBA等）
+            - format: 原始文件格式
+            - has_transparency: 是否包含透明度
+            - annotation_count: 标注图层中的标注数量
+            - n_frames: 帧数，单帧图像为1
+            
+        异常：
+            无
+        """
+        if not self.image:
+            return None
+
+        state_id = self.history.current.state_id
+        info = self.derived.get(state_id, 'info')
+        if info is None:
+            info = {
+                'width': self.image.width,
+                'height': self.image.height,
+                'mode': self.image.mode,
+                'format': self.image.format,
+                'has_transparency': self.image.mode in ('RGBA', 'LA', 'P'),
+                'annotation_count': len(self.layer.annotations),
+                'n_frames': self.n_frames
+            }
+            self.derived.put(state_id, 'info', (), info)
+        return dict(info)
 
 
 def main() -> None:
@@ -603,6 +1944,9 @@ def main() -> None:
         draw_line: 绘制直线
         save: 保存图像
         info: 获取图像信息
+        thumbnail: 生成缩略图
+        patch: 获取指定区域的局部更新补丁
+        estimate_size: 估算按指定格式和质量保存后的文件大小
         undo: 撤销操作
         redo: 重做操作
         
@@ -610,30 +1954,95 @@ def main() -> None:
         SystemExit: 当参数解析失败时退出
         Exception: 当命令执行失败时输出错误信息
     """
+    parse_started = tracing.now()
     parser = argparse.ArgumentParser(description='图像处理工具')
     parser.add_argument('command', help='操作命令')
     parser.add_argument('--input', help='输入图像（Base64或文件路径）')
     parser.add_argument('--output', help='输出文件路径')
-    parser.add_argument('--format', default='PNG', help='输出格式')
-    parser.add_argument('--quality', type=int, default=95, help='图像质量（JPEG）')
+    parser.add_argument('--format', default='PNG', help='输出格式（RAW表示原始帧格式）')
+    parser.add_argument('--quality', type=int, default=95, help='图像质量（JPEG、WebP）')
+    parser.add_argument('--max-bytes', type=int, help='输出大小上限（字节），自动选择满足上限的最高质量')
     parser.add_argument('--params', help='操作参数（JSON格式）')
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET,
+                        help='工作图像解码后的字节数上限，超出时JPEG编辑缩小的副本，'
+                             '其他格式拒绝加载，0表示不限制')
+    parser.add_argument('--cache', action='store_true',
+                        help='启用命令结果磁盘缓存（也可设置环境变量PICFROMCLIPBOARD_RESULT_CACHE=1）')
+    parser.add_argument('--no-cache', action='store_true', help='不读写命令结果缓存')
+    parser.add_argument('--trace', help='将性能追踪写入该文件（Chrome trace event格式），'
+                                        '也可设置环境变量PICFROMCLIPBOARD_TRACE')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='追踪时同时采样内存（也可设置环境变量PICFROMCLIPBOARD_TRACE_MEMORY=1）')
 
     args = parser.parse_args()
+    parse_finished = tracing.now()
 
-    # 创建图像处理器
-    processor = ImageProcessor()
+    # 性能追踪：导入和参数解析在启用前已结束，按记录的时间补上
+    settings = tracing.env_settings()
+    trace_path = args.trace or settings['path']
+    if not trace_path:
+        run_command(args)
+        return
 
-    # 加载图像
-    if args.input:
-        if os.path.exists(args.input):
-            success = processor.load_from_file(args.input)
-        else:
-            success = processor.load_from_base64(args.input)
+    tracing.enable(args.trace_memory or settings['memory'])
+    tracing.add_span('imports', 'startup', tracing.ORIGIN, _IMPORTS_FINISHED)
+    tracing.add_span('parse_args', 'startup', parse_started, parse_finished)
+    try:
+        with tracing.span(args.command, 'command'):
+            run_command(args)
+    finally:
+        try:
+            tracing.save(trace_path)
+        except OSError as e:
+            print(f"写入性能追踪失败: {e}", file=sys.stderr)
 
-        if not success:
-            print(json.dumps({'success': False, 'error': '加载图像失败'}))
+
+def run_command(args: argparse.Namespace) -> None:
+    """
+    执行一条已解析的命令行命令
+    
+    结果以JSON写到标准输出。
+    
+    参数：
+        args: main()解析得到的命令行参数
+    """
+    # 创建图像处理器
+    processor = ImageProcessor(memory_budget=args.memory_budget or None)
+
+    # 缩略图直接从图像源生成，避免完整解码
+    if args.command == 'thumbnail':
+        thumb_params: Dict[str, Any] = {}
+        if args.params:
+            try:
+                thumb_params = json.loads(args.params)
+            except:
+                print(json.dumps({'success': False, 'error': '参数格式错误'}))
+                return
+        if not args.input:
+            print(json.dumps({'success': False, 'error': '缺少输入图像'}))
             return
 
+        # 磁盘缓存需显式启用（参数cache为true），缓存目录不安全时不使用缓存
+        cache = None
+        if thumb_params.get('cache', False):
+            try:
+                cache = DiskCache(default_cache_dir('thumbnails'),
+                                  thumb_params.get('cache_size', 64 * 1024 * 1024))
+            except OSError as e:
+                print(f"缩略图缓存不可用: {e}", file=sys.stderr)
+        base64_data = processor.thumbnail(
+            args.input,
+            thumb_params.get('width', 256),
+            thumb_params.get('height', 256),
+            args.format,
+            cache
+        )
+        if base64_data:
+            print(json.dumps({'success': True, 'base64': base64_data}))
+        else:
+            print(json.dumps({'success': False, 'error': '生成缩略图失败'}))
+        return
+
     # 解析参数
     params = {}
     if args.params:
@@ -643,6 +2052,44 @@ def main() -> None:
             print(json.dumps({'success': False, 'error': '参数格式错误'}))
             return
 
+    # 相同输入和参数的重复请求直接返回缓存的结果。
+    # 只有保存命令会写出--output，其他命令不读取也不覆盖该路径上的文件；
+    # 原始帧不经过编码，不缓存
+    result_cache: Optional[ResultCache] = None
+    cache_key = ''
+    output_file = args.output if args.command == 'save' else None
+    cacheable = not (output_file and args.format.upper() == 'RAW')
+    if args.input and cacheable and not args.no_cache and (args.cache or result_cache_enabled()):
+        try:
+            cache_key = result_key(_read_source_bytes(args.input), args.command, params,
+                                   _format_key(args.format, args.quality), args.max_bytes,
+                                   bool(output_file), args.memory_budget)
+            result_cache = ResultCache()
+            with tracing.span('result_cache.get', 'io'):
+                cached = result_cache.get(cache_key, output_file,
+                                          args.format if args.command == 'save' else None)
+            if cached is not None:
+                cached['cached'] = True
+                print(json.dumps(cached))
+                return
+        except Exception as e:
+            print(f"读取结果缓存失败: {e}", file=sys.stderr)
+            result_cache = None
+
+    # 加载图像
+    if args.input:
+        if os.path.exists(args.input):
+            success = processor.load_from_file(args.input)
+        else:
+            success = processor.load_from_base64(args.input)
+
+        if not success:
+            error = '加载图像失败'
+            if processor.load_error:
+                error += f': {processor.load_error}'
+            print(json.dumps({'success': False, 'error': error}))
+            return
+
     # 执行命令
     success = False
     result: Dict[str, Any] = {}
@@ -699,18 +2146,43 @@ def main() -> None:
                 params.get('width', 2)
             )
         elif args.command == 'save':
-            if args.output:
-                success = processor.save_to_file(args.output, args.format, args.quality)
+            if args.output and args.format.upper() == 'RAW':
+                success = processor.save_to_raw(args.output)
+            elif args.output:
+                success = processor.save_to_file(args.output, args.format, args.quality,
+                                                 args.max_bytes)
             else:
-                base64_data = processor.to_base64(args.format, args.quality)
+                base64_data = processor.to_base64(args.format, args.quality, args.max_bytes)
                 if base64_data:
                     result['base64'] = base64_data
                     success = True
+            
+            # 目标大小模式返回选定的质量或调色板颜色数
+            size_search = processor.last_size_search
+            if size_search:
+                result['size_search'] = size_search
+                if not size_search['fits']:
+                    result['error'] = f"无法编码到{size_search['max_bytes']}字节以内"
         elif args.command == 'info':
             info = processor.get_image_info()
             if info:
                 result.update(info)
                 success = True
+        elif args.command == 'patch':
+            patch = processor.get_patch(
+                params.get('x', 0),
+                params.get('y', 0),
+                params.get('width', 100),
+                params.get('height', 100)
+            )
+            if patch:
+                result['patch'] = patch
+                success = True
+        elif args.command == 'estimate_size':
+            estimate = processor.estimate_size(args.format, args.quality)
+            if estimate:
+                result.update(estimate)
+                success = True
         elif args.command == 'undo':
             success = processor.undo()
         elif args.command == 'redo':
@@ -719,15 +2191,37 @@ def main() -> None:
             print(json.dumps({'success': False, 'error': f'未知命令: {args.command}'}))
             return
 
+        # 返回新建标注的ID及其局部更新补丁
+        if success and args.command in ('add_text', 'draw_rectangle', 'draw_circle', 'draw_line'):
+            result['annotation_id'] = processor.layer.annotations[-1].annotation_id
+            patch = processor.get_patch()
+            if patch:
+                result['patch'] = patch
+
+        # 超出内存预算的图像说明已改为编辑缩小的副本
+        if processor.load_notice:
+            result['load_notice'] = processor.load_notice
+
         # 返回结果
         result['success'] = success
-        if success and args.command != 'save' and args.command != 'info':
+        if success and args.command not in ('save', 'info', 'patch', 'estimate_size'):
             # 返回处理后的图像信息
             info = processor.get_image_info()
             if info:
                 result.update(info)
 
-        print(json.dumps(result))
+            # 返回需要刷新的区域
+            box = processor.dirty_box
+            result['dirty_box'] = None if box is None else {
+                'x': box[0], 'y': box[1], 'width': box[2] - box[0], 'height': box[3] - box[1]
+            }
+
+        with tracing.span('output', 'io'):
+            print(json.dumps(result))
+
+        if success and result_cache is not None:
+            with tracing.span('result_cache.put', 'io'):
+                result_cache.put(cache_key, result, output_file)
 
     except Exception as e:
         print(json.dumps({'success': False, 'error': str(e)}))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+并行图像操作模块
+
+功能描述：
+- 提供进程内共享的工作线程池
+- 提供按水平条带并行计算的任意角度旋转
+- 提供有界窗口的保序并行映射，用于逐帧等流式处理
+- Pillow在C循环中释放GIL，因此多线程可以利用多核
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import math
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Any, Callable, Deque, Iterable, Iterator, List, Tuple, Union
+from PIL import Image
+
+
+# 小于该像素数的图像直接单线程旋转，线程调度开销不值得
+PARALLEL_ROTATE_MIN_PIXELS = 1024 * 1024
+
+# 每个条带的最小行数
+MIN_STRIP_ROWS = 64
+
+# 可并行旋转的模式：走Pillow定点仿射路径且没有调色板。
+# 特殊类型（如I;16）走通用路径，条带拆分无法保证逐像素一致
+_PARALLEL_MODES = ('1', 'L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr', 'I', 'F')
+
+_worker_pool: Optional[ThreadPoolExecutor] = None
+_worker_pool_lock = threading.Lock()
+
+
+def worker_count() -> int:
+    """
+    获取工作线程数量
+
+    返回：
+        CPU核心数，至少为1
+    """
+    return max(1, os.cpu_count() or 1)
+
+
+def get_worker_pool() -> ThreadPoolExecutor:
+    """
+    获取共享的工作线程池
+
+    线程池在首次使用时创建，线程数等于CPU核心数。
+
+    返回：
+        共享线程池
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = ThreadPoolExecutor(max_workers=worker_count(),
+                                              thread_name_prefix='image-worker')
+        return _worker_pool
+
+
+def bounded_map(func: Callable[[Any], Any], items: Iterable[Any],
+                window: Optional[int] = None) -> Iterator[Any]:
+    """
+    在共享线程池中保序地并行映射，同时最多保留window个未取走的结果
+
+    输入在调用方线程中按需逐个读取，适合必须顺序解码的帧序列。
+    func内部不能再等待共享线程池中的任务，否则线程池占满时会互相等待。
+
+    参数：
+        func: 映射函数
+        items: 输入序列，可以是生成器
+        window: 同时提交的最大任务数，为None时为线程数的2倍
+
+    返回：
+        按输入顺序产生结果的迭代器
+
+    异常：
+        Exception: func抛出的异常在取到对应结果时传递
+    """
+    if window is None:
+        window = worker_count() * 2
+    pool = get_worker_pool()
+    pending: Deque['Future[Any]'] = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _rotation_matrix(size: Tuple[int, int], angle: float) -> Tuple[List[float], int, int]:
+    """
+    计算与Image.rotate(angle, expand=True)相同的逆向仿射矩阵和输出尺寸
+
+    参数：
+        size: 输入图像尺寸
+        angle: 逆时针旋转角度（度），与Image.rotate一致
+
+    返回：
+        (矩阵, 输出宽度, 输出高度)
+    """
+    w, h = size
+    center = (w / 2, h / 2)
+
+    angle = -math.radians(angle)
+    matrix = [
+        round(math.cos(angle), 15),
+        round(math.sin(angle), 15),
+        0.0,
+        round(-math.sin(angle), 15),
+        round(math.cos(angle), 15),
+        0.0,
+    ]
+
+    def transform(x: float, y: float, m: List[float]) -> Tuple[float, float]:
+        a, b, c, d, e, f = m
+        return a * x + b * y + c, d * x + e * y + f
+
+    matrix[2], matrix[5] = transform(-center[0], -center[1], matrix)
+    matrix[2] += center[0]
+    matrix[5] += center[1]
+
+    xx = []
+    yy = []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        tx, ty = transform(x, y, matrix)
+        xx.append(tx)
+        yy.append(ty)
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+
+    matrix[2], matrix[5] = transform(-(nw - w) / 2.0, -(nh - h) / 2.0, matrix)
+    return matrix, nw, nh
+
+
+def _fix(v: float) -> int:
+    # 与Pillow定点仿射变换中的FIX宏一致：16.16定点数
+    return math.floor(v * 65536.0 + 0.5)
+
+
+def _fits_fixed(matrix: List[float], width: int, height: int) -> bool:
+    # 与Pillow的check_fixed一致，判断是否走定点路径
+    a, b, c, d, e, f = matrix
+    for x, y in ((0, 0), (width, height), (0, height), (width, 0)):
+        if abs(x * a + y * b + c) >= 32768.0 or abs(x * d + y * e + f) >= 32768.0:
+            return False
+    return True
+
+
+def _strip_offset(a: float, b: float, target: int) -> Optional[float]:
+    """
+    求条带矩阵的平移分量，使其定点起始值与整图逐行累加到该行时完全相同
+
+    参数：
+        a: 矩阵中与x相乘的系数
+        b: 矩阵中与y相乘的系数
+        target: 条带首行的定点起始值
+
+    返回：
+        平移分量，找不到精确值时返回None
+    """
+    offset = target / 65536.0 - a * 0.5 - b * 0.5
+    for _ in range(8):
+        value = _fix(offset + a * 0.5 + b * 0.5)
+        if value == target:
+            return offset
+        offset += (target - value) / 65536.0
+    return None
+
+
+def rotate_expand(image: Image.Image, angle: float,
+                  fillcolor: Union[str, Tuple[int, ...], None] = None,
+                  strips: Optional[int] = None) -> Image.Image:
+    """
+    扩展画布的任意角度旋转
+
+    结果与image.rotate(angle, expand=True, fillcolor=fillcolor)逐像素一致。
+    输出按水平条带拆分，每个条带用共享仿射矩阵在线程池中调用Image.transform，
+    最后拼接。条带矩阵的平移分量按Pillow定点算法逐行累加的结果精确推算，
+    保证条带边界处的采样位置与整图计算完全相同。
+    直角旋转、小图像和无法保证一致的模式直接调用Image.rotate。
+
+    参数：
+        image: 输入图像
+        angle: 逆时针旋转角度（度），与Image.rotate一致
+        fillcolor: 空白区域填充颜色
+        strips: 条带数量，为None时按CPU核心数确定
+
+    返回：
+        旋转后的图像
+
+    异常：
+        ValueError: 当图像模式不支持旋转时抛出
+    """
+    def fallback() -> Image.Image:
+        return image.rotate(angle, expand=True, fillcolor=fillcolor)
+
+    if angle % 90 == 0 or image.mode not in _PARALLEL_MODES:
+        return fallback()
+
+    matrix, nw, nh = _rotation_matrix(image.size, angle)
+    a, b, c, d, e, f = matrix
+    if (nw * nh < PARALLEL_ROTATE_MIN_PIXELS or (b == 0 and d == 0)
+            or not _fits_fixed(matrix, nw, nh)):
+        return fallback()
+
+    if strips is None:
+        strips = worker_count()
+    strips = max(1, min(strips, nh // MIN_STRIP_ROWS))
+    if strips == 1:
+        return fallback()
+
+    # 整图定点计算时每行的起始值为 FIX(平移) + 行号 * FIX(y系数)
+    x_start = _fix(c + a * 0.5 + b * 0.5)
+    y_start = _fix(f + d * 0.5 + e * 0.5)
+    x_step = _fix(b)
+    y_step = _fix(e)
+
+    rows = math.ceil(nh / strips)
+    jobs = []
+    for y0 in range(0, nh, rows):
+        y1 = min(nh, y0 + rows)
+        strip_c = _strip_offset(a, b, x_start + y0 * x_step)
+        strip_f = _strip_offset(d, e, y_start + y0 * y_step)
+        strip_matrix = (a, b, strip_c, d, e, strip_f)
+        if strip_c is None or strip_f is None or not _fits_fixed(list(strip_matrix), nw, y1 - y0):
+            return fallback()
+        jobs.append((y0, y1, strip_matrix))
+
+    def render(job: Tuple[int, int, Tuple[float, ...]]) -> Image.Image:
+        y0, y1, strip_matrix = job
+        return image.transform((nw, y1 - y0), Image.AFFINE, strip_matrix,
+                               Image.NEAREST, fillcolor=fillcolor)
+
+    # 读取像素前确保图像已加载，避免多个线程同时触发解码
+    image.load()
+    results = list(get_worker_pool().map(render, jobs))
+
+    output = Image.new(image.mode, (nw, nh), fillcolor)
+    output.info = image.info.copy()
+    for (y0, _, _), strip in zip(jobs, results):
+        output.paste(strip, (0, y0))
+    return output
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+原始帧格式模块
+
+功能描述：
+- 定义未压缩的原始像素帧文件格式，用于进程间和处理阶段间传递整帧图像
+- 读取时通过mmap和Image.frombuffer直接映射像素数据，不做解码；RGBA、L等模式无需复制，
+  映射随图像释放而关闭。Windows上打开的映射会阻止替换该文件，因此复制后立即关闭映射
+- 写入时先写临时文件再重命名，读取方已映射的旧帧不受影响，文件权限按umask确定
+
+文件格式（小端序）：
+    偏移  长度  内容
+    0     8     魔数 b'PFCRAW\\x00\\x01'
+    8     4     头部长度（像素数据起始偏移）
+    12    4     宽度
+    16    4     高度
+    20    4     行跨度（每行字节数）
+    24    8     颜色模式（ASCII，以\\x00补齐）
+    32    ...   像素数据，共 行跨度 x 高度 字节
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import mmap
+import struct
+import tempfile
+from typing import Optional, Tuple
+from PIL import Image
+
+from save_queue import FILE_MODE
+
+
+RAW_MAGIC = b'PFCRAW\x00\x01'
+RAW_EXTENSION = '.pfraw'
+
+_HEADER = struct.Struct('<8sIIII8s')
+HEADER_SIZE = _HEADER.size
+
+# 各模式的每像素字节数
+_BYTES_PER_PIXEL = {
+    'L': 1,
+    'LA': 2,
+    'I;16': 2,
+    'RGB': 3,
+    'RGBA': 4,
+    'RGBX': 4,
+    'CMYK': 4,
+    'I': 4,
+    'F': 4,
+}
+
+# Pillow可以直接映射外部缓冲区的模式，其他模式在frombuffer时会复制一次
+ZERO_COPY_MODES = ('L', 'RGBA', 'RGBX', 'CMYK', 'I;16')
+
+# Windows上文件被映射时无法替换或删除，默认复制像素后关闭映射
+COPY_ON_LOAD = os.name == 'nt'
+
+
+def is_raw_frame(file_path: str) -> bool:
+    """
+    判断文件是否为原始帧格式
+
+    参数：
+        file_path: 文件路径
+
+    返回：
+        文件以原始帧魔数开头时返回True
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read(len(RAW_MAGIC)) == RAW_MAGIC
+    except OSError:
+        return False
+
+
+def read_header(buffer: bytes) -> Tuple[int, int, int, int, str]:
+    """
+    解析原始帧头部
+
+    参数：
+        buffer: 至少包含完整头部的字节数据
+
+    返回：
+        (头部长度, 宽度, 高度, 行跨度, 颜色模式)
+
+    异常：
+        ValueError: 当头部无效时抛出
+    """
+    if len(buffer) < HEADER_SIZE:
+        raise ValueError("原始帧头部不完整")
+
+    magic, header_size, width, height, stride, mode = _HEADER.unpack_from(buffer)
+    if magic != RAW_MAGIC:
+        raise ValueError("不是原始帧文件")
+
+    mode = mode.rstrip(b'\x00').decode('ascii')
+    if mode not in _BYTES_PER_PIXEL:
+        raise ValueError(f"不支持的原始帧颜色模式: {mode}")
+    if header_size < HEADER_SIZE or stride < width * _BYTES_PER_PIXEL[mode]:
+        raise ValueError("原始帧头部参数无效")
+
+    return header_size, width, height, stride, mode
+
+
+def open_raw_frame(file_path: str, copy: Optional[bool] = None) -> Image.Image:
+    """
+    打开原始帧文件
+
+    文件以只读方式映射到内存，返回的图像直接引用映射的像素数据。
+    图像为只读，任何修改操作都会由Pillow先复制一份。
+    图像持有映射的引用，映射在图像对象被释放时随之关闭。
+    复制时像素复制到返回的图像后立即关闭映射，之后可以替换或覆盖该文件。
+
+    参数：
+        file_path: 原始帧文件路径
+        copy: 是否复制像素并立即关闭映射，为None时按COPY_ON_LOAD（仅Windows上复制）
+
+    返回：
+        映射到文件内容（或复制了文件内容）的图像
+
+    异常：
+        ValueError: 当文件格式无效或数据长度不足时抛出
+        OSError: 当文件无法读取时抛出
+    """
+    with open(file_path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if copy is None:
+        copy = COPY_ON_LOAD
+
+    try:
+        header_size, width, height, stride, mode = read_header(mapped[:HEADER_SIZE])
+        end = header_size + stride * height
+        if len(mapped) < end:
+            raise ValueError("原始帧像素数据不完整")
+    except BaseException:
+        mapped.close()
+        raise
+
+    if not copy:
+        pixels = memoryview(mapped)[header_size:end]
+        return Image.frombuffer(mode, (width, height), pixels, 'raw', mode, stride, 1)
+
+    try:
+        with memoryview(mapped)[header_size:end] as pixels:
+            mapped_image = Image.frombuffer(mode, (width, height), pixels, 'raw', mode, stride, 1)
+            image = mapped_image.copy()
+            # 释放对映射的引用后才能关闭映射
+            del mapped_image
+        return image
+    finally:
+        mapped.close()
+
+
+def write_raw_frame(image: Image.Image, file_path: str) -> None:
+    """
+    将图像写为原始帧文件
+
+    不支持的颜色模式（如P、1）会先转换为RGBA。像素按行分块写入，
+    避免一次性生成整帧的字节副本。写入临时文件后原子重命名到目标路径。
+
+    参数：
+        image: 要写入的图像
+        file_path: 目标文件路径
+
+    异常：
+        OSError: 当文件无法写入时抛出
+    """
+    if image.mode not in _BYTES_PER_PIXEL:
+        image = image.convert('RGBA')
+
+    width, height = image.size
+    stride = width * _BYTES_PER_PIXEL[image.mode]
+    header = _HEADER.pack(RAW_MAGIC, HEADER_SIZE, width, height, stride,
+                          image.mode.encode('ascii'))
+
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            # 每次写入约4MB
+            rows = max(1, (4 * 1024 * 1024) // max(1, stride))
+            for y in range(0, height, rows):
+                f.write(image.crop((0, y, width, min(height, y + rows))).tobytes())
+        # mkstemp创建的文件权限为0600，改为普通文件权限
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
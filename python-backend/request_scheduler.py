@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求调度模块
+
+功能描述：
+- 在ImageProcessor前按会话和操作键调度请求
+- 相对当前状态的编辑（旋转、裁剪、标注等）按提交顺序全部执行，不会丢失
+- 参数为绝对值的请求（如从手势开始前的状态重新渲染预览）在同一操作键上只保留最新的待执行请求，
+  被取代的请求立即返回，连续的突发请求合并为最新参数的一次执行
+- 耗时的Pillow调用放到线程池中执行，不阻塞事件循环
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import Optional, Dict, Any, Callable, Tuple
+
+
+# 在当前状态上叠加增量的ImageProcessor方法，丢弃其中任何一个都会丢失用户的部分编辑，
+# 不能按最新优先合并
+RELATIVE_METHODS = frozenset({
+    'crop', 'rotate', 'flip_horizontal', 'flip_vertical',
+    'add_text', 'draw_rectangle', 'draw_circle', 'draw_line',
+    'undo', 'redo', 'remove_annotation',
+})
+
+
+def _method_name(func: Callable[..., Any]) -> str:
+    # functools.partial包装的函数取其原始函数名
+    while isinstance(func, partial):
+        func = func.func
+    return getattr(func, '__name__', '')
+
+
+class RequestSuperseded(Exception):
+    """请求在执行前被同一操作键上的更新请求取代"""
+
+
+class _PendingRequest:
+    """待执行的请求"""
+
+    def __init__(self, future: 'asyncio.Future[Any]', func: Callable[..., Any],
+                 args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> None:
+        self.future = future
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+
+class _Slot:
+    """单个(会话, 操作键)的调度状态"""
+
+    def __init__(self) -> None:
+        self.pending: Optional[_PendingRequest] = None
+        self.task: Optional['asyncio.Task[None]'] = None
+
+
+class RequestScheduler:
+    """请求调度器类
+
+    submit_ordered()提交的请求全部按顺序执行，用于旋转、裁剪等相对当前状态的编辑：
+    两次快速的10°旋转得到20°。
+    submit_latest()只用于参数为绝对值、结果只取决于最新参数的请求，例如按滑块角度
+    从手势开始前的状态重新渲染预览。每个(会话, 操作键)最多有一个正在执行的请求和一个待执行的请求，
+    新请求到达时，旧的待执行请求以RequestSuperseded结束；正在执行的请求无法中断，
+    完成后直接执行最新的待执行请求。
+    同一会话内的请求串行执行，因为单个ImageProcessor不是线程安全的；不同会话之间可以并行。
+    """
+
+    def __init__(self, executor: Optional[Executor] = None, max_workers: Optional[int] = None,
+                 coalesce_delay: float = 0.0) -> None:
+        """
+        初始化请求调度器
+
+        参数：
+            executor: 执行Pillow调用的线程池，为None时创建私有线程池
+            max_workers: 私有线程池的线程数，仅在executor为None时有效
+            coalesce_delay: 执行前等待的秒数，用于合并拖动产生的突发请求，默认0
+
+        异常：
+            无
+        """
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers,
+                                                        thread_name_prefix='request-scheduler')
+        self.coalesce_delay = coalesce_delay
+        self._slots: Dict[Tuple[str, str], _Slot] = {}
+        self._session_locks: Dict[str, asyncio.Lock] = {}
+
+    async def submit_ordered(self, session_id: str, func: Callable[..., Any],
+                             *args: Any, **kwargs: Any) -> Any:
+        """
+        提交必须执行的请求
+
+        同一会话内按提交顺序执行，不会被其他请求取代。
+
+        参数：
+            session_id: 会话ID
+            func: 要执行的函数，通常是ImageProcessor的方法
+            *args: 函数位置参数
+            **kwargs: 函数关键字参数
+
+        返回：
+            函数的返回值
+
+        异常：
+            Exception: 函数本身抛出的异常会原样传递
+        """
+        loop = asyncio.get_running_loop()
+        lock = self._session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def submit_latest(self, session_id: str, op_key: str, func: Callable[..., Any],
+                            *args: Any, **kwargs: Any) -> Any:
+        """
+        提交最新优先的请求
+
+        只用于参数为绝对值的请求：执行最新的一个与依次执行全部得到相同的结果，
+        例如从固定的基准状态按当前滑块值重新渲染预览。
+
+        参数：
+            session_id: 会话ID
+            op_key: 操作键，同一键上的请求按最新者优先处理，例如'rotate_preview'
+            func: 要执行的函数
+            *args: 函数位置参数
+            **kwargs: 函数关键字参数
+
+        返回：
+            函数的返回值
+
+        异常：
+            ValueError: 当func是RELATIVE_METHODS中的相对编辑时抛出，这类请求应使用submit_ordered()
+            RequestSuperseded: 当请求在执行前被更新的请求取代时抛出
+            asyncio.CancelledError: 当请求被cancel()取消时抛出
+            Exception: 函数本身抛出的异常会原样传递
+        """
+        name = _method_name(func)
+        if name in RELATIVE_METHODS:
+            raise ValueError(f"{name}相对当前状态编辑，合并会丢失编辑，请使用submit_ordered()")
+
+        loop = asyncio.get_running_loop()
+        future: 'asyncio.Future[Any]' = loop.create_future()
+
+        slot = self._slots.setdefault((session_id, op_key), _Slot())
+        if slot.pending is not None and not slot.pending.future.done():
+            slot.pending.future.set_exception(RequestSuperseded(f"{session_id}/{op_key}"))
+        slot.pending = _PendingRequest(future, func, args, kwargs)
+
+        if slot.task is None or slot.task.done():
+            slot.task = loop.create_task(self._drain(session_id, op_key, slot))
+
+        return await future
+
+    def cancel(self, session_id: str, op_key: Optional[str] = None) -> int:
+        """
+        取消最新优先的待执行请求
+
+        submit_ordered()提交的请求不受影响。
+
+        参数：
+            session_id: 会话ID
+            op_key: 操作键，为None时取消该会话的所有待执行请求
+
+        返回：
+            被取消的请求数量
+        """
+        count = 0
+        for (slot_session, slot_key), slot in self._slots.items():
+            if slot_session != session_id or (op_key is not None and slot_key != op_key):
+                continue
+            if slot.pending is not None and not slot.pending.future.done():
+                slot.pending.future.cancel()
+                count += 1
+            slot.pending = None
+        return count
+
+    def close_session(self, session_id: str) -> None:
+        """
+        关闭会话，取消其待执行请求并释放调度状态
+
+        参数：
+            session_id: 会话ID
+        """
+        self.cancel(session_id)
+        for key in [k for k in self._slots if k[0] == session_id]:
+            del self._slots[key]
+        self._session_locks.pop(session_id, None)
+
+    def shutdown(self) -> None:
+        """
+        关闭调度器，私有线程池会等待正在执行的调用结束
+        """
+        for slot in self._slots.values():
+            if slot.pending is not None and not slot.pending.future.done():
+                slot.pending.future.cancel()
+        self._slots.clear()
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    async def _drain(self, session_id: str, op_key: str, slot: _Slot) -> None:
+        """
+        依次执行某个操作键上的最新请求，直到没有待执行请求
+
+        参数：
+            session_id: 会话ID
+            op_key: 操作键
+            slot: 调度状态
+        """
+        loop = asyncio.get_running_loop()
+        lock = self._session_locks.setdefault(session_id, asyncio.Lock())
+
+        while slot.pending is not None:
+            if self.coalesce_delay > 0:
+                await asyncio.sleep(self.coalesce_delay)
+
+            async with lock:
+                # 等待锁期间可能有更新的请求到达，只取最新的一个
+                request = slot.pending
+                slot.pending = None
+                if request is None or request.future.done():
+                    continue
+
+                try:
+                    result = await loop.run_in_executor(
+                        self._executor, partial(request.func, *request.args, **request.kwargs)
+                    )
+                except Exception as e:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                else:
+                    if not request.future.done():
+                        request.future.set_result(result)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令结果缓存模块
+
+功能描述：
+- 按输入图像内容摘要和规范化的命令参数缓存命令行调用的结果
+- 每个条目保存JSON结果和输出字节（保存的文件或Base64图像），由DiskCache按大小淘汰
+- 命中时直接写出输出文件或重建Base64结果，不再解码和处理图像
+- 默认关闭，通过--cache参数或环境变量启用
+- 缓存位于当前用户的私有缓存目录；命中时校验条目的大小、摘要和图像格式后才写出
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import sys
+import json
+import base64
+import hashlib
+from io import BytesIO
+from typing import Optional, Dict, Any, Tuple
+from PIL import Image
+
+from disk_cache import DiskCache, default_cache_dir
+from save_queue import atomic_write_bytes
+
+
+# 设置为1、true、yes或on时启用结果缓存
+RESULT_CACHE_ENV = 'PICFROMCLIPBOARD_RESULT_CACHE'
+
+# 结果缓存的默认字节数上限
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# 结果格式变化时递增，使旧条目失效
+RESULT_CACHE_VERSION = 2
+
+# 结果与格式、质量有关的命令
+ENCODING_COMMANDS = ('save', 'estimate_size')
+
+
+def result_cache_enabled() -> bool:
+    """
+    检查环境变量是否启用了结果缓存
+
+    返回：
+        是否启用
+    """
+    return os.environ.get(RESULT_CACHE_ENV, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _normalize_format(format: str) -> str:
+    format = format.upper()
+    return {'JPG': 'JPEG', 'TIF': 'TIFF'}.get(format, format)
+
+
+def result_key(source: bytes, command: str, params: Dict[str, Any],
+               format_key: Tuple[str, int], max_bytes: Optional[int] = None,
+               to_file: bool = False, memory_budget: Optional[int] = None) -> str:
+    """
+    计算命令结果的缓存键
+
+    参数按键排序序列化；格式、质量、大小上限和是否输出到文件只对保存和估算命令计入，
+    其他命令改变这些参数仍命中同一条目。内存预算决定工作副本的尺寸，对所有命令计入。
+    输出路径不计入，命中时写到新的路径。
+
+    参数：
+        source: 输入图像的原始字节
+        command: 命令名
+        params: 解析后的操作参数
+        format_key: 规范化的(格式, 质量)，不支持质量参数的格式质量为0
+        max_bytes: 输出大小上限
+        to_file: 结果是否写入文件（否则以Base64返回）
+        memory_budget: 加载图像时使用的内存预算
+
+    返回：
+        缓存键
+    """
+    request: Dict[str, Any] = {'version': RESULT_CACHE_VERSION, 'command': command, 'params': params,
+                               'memory_budget': memory_budget}
+    if command in ENCODING_COMMANDS:
+        request.update(format=format_key[0], quality=format_key[1], max_bytes=max_bytes,
+                       to_file=to_file)
+    digest = hashlib.sha1(source).hexdigest()
+    return f"result:{digest}:{json.dumps(request, sort_keys=True, separators=(',', ':'))}"
+
+
+class ResultCache:
+    """命令结果缓存类
+
+    条目格式为一行JSON元数据，换行后紧跟输出字节。
+    JSON序列化不含原始换行符，因此第一个换行符即为分隔。
+    元数据记录输出字节的长度和SHA-1摘要，读取时不一致的条目视为损坏。
+    """
+
+    def __init__(self, directory: Optional[str] = None,
+                 max_bytes: int = RESULT_CACHE_MAX_BYTES) -> None:
+        """
+        初始化命令结果缓存
+
+        参数：
+            directory: 缓存目录，为None时使用默认缓存目录下的results
+            max_bytes: 缓存总字节数上限，默认256MB
+
+        异常：
+            PermissionError: 当缓存目录属于其他用户或允许其他用户写入时抛出
+            OSError: 当缓存目录无法创建时抛出
+        """
+        self._cache = DiskCache(directory or default_cache_dir('results'), max_bytes)
+
+    def get(self, key: str, output_path: Optional[str] = None,
+            format: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        读取命令结果
+
+        输出为文件的条目在命中时写到output_path。输出字节的长度或摘要与元数据不符、
+        或者指定了format而输出字节不是该格式的图像时，条目视为损坏。
+
+        参数：
+            key: 缓存键
+            output_path: 本次调用的输出文件路径
+            format: 本次调用期望的输出图像格式，为None时不检查
+
+        返回：
+            命令的JSON结果，未命中或条目损坏时返回None
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+
+        header, _, payload = entry.partition(b'\n')
+        try:
+            meta = json.loads(header.decode('utf-8'))
+            result = meta['result']
+            if meta['payload'] is not None:
+                if len(payload) != meta['size'] or hashlib.sha1(payload).hexdigest() != meta['sha1']:
+                    raise ValueError("条目长度或摘要不符")
+                if format is not None:
+                    with Image.open(BytesIO(payload)) as image:
+                        if image.format != _normalize_format(format):
+                            raise ValueError(f"条目格式为{image.format}，期望{format}")
+            if meta['payload'] == 'file':
+                if not output_path:
+                    return None
+                directory = os.path.dirname(os.path.abspath(output_path))
+                os.makedirs(directory, exist_ok=True)
+                atomic_write_bytes(output_path, payload)
+            elif meta['payload'] == 'base64':
+                result['base64'] = meta['prefix'] + base64.b64encode(payload).decode('ascii')
+            return result
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            print(f"读取结果缓存失败: {e}", file=sys.stderr)
+            return None
+
+    def put(self, key: str, result: Dict[str, Any], output_path: Optional[str] = None) -> None:
+        """
+        写入命令结果
+
+        Base64图像以原始字节保存，不计入Base64的膨胀。
+
+        参数：
+            key: 缓存键
+            result: 命令的JSON结果
+            output_path: 命令写出的输出文件，为None时没有输出文件
+
+        异常：
+            无，读取输出文件失败时输出错误信息后忽略
+        """
+        result = dict(result)
+        meta: Dict[str, Any] = {'payload': None}
+        payload = b''
+        try:
+            if output_path:
+                with open(output_path, 'rb') as f:
+                    payload = f.read()
+                meta['payload'] = 'file'
+            elif 'base64' in result:
+                prefix, _, data = result.pop('base64').partition(',')
+                payload = base64.b64decode(data)
+                meta.update(payload='base64', prefix=prefix + ',')
+        except (OSError, ValueError) as e:
+            print(f"写入结果缓存失败: {e}", file=sys.stderr)
+            return
+
+        if meta['payload'] is not None:
+            meta.update(size=len(payload), sha1=hashlib.sha1(payload).hexdigest())
+        meta['result'] = result
+        self._cache.put(key, json.dumps(meta).encode('utf-8') + b'\n' + payload)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台保存队列模块
+
+功能描述：
+- 在后台线程中编码并写入文件，调用方无需等待
+- 先写入目标目录中的临时文件并刷新到磁盘，再原子重命名到目标路径
+- 通过回调报告排队、编码、写入进度、完成和失败事件
+- 同时进行的保存数量可配置
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import sys
+import itertools
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, Union
+
+import tracing
+
+
+# 每次写入的字节数，也是写入进度事件的粒度
+WRITE_CHUNK_BYTES = 1024 * 1024
+
+# 最多保留的失败记录数，更早的失败任务按不存在处理
+MAX_FAILED_RECORDS = 1000
+
+
+def _default_file_mode() -> int:
+    # os.umask只能通过设置来读取，在导入时读取一次，避免与其他线程创建文件竞争
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# 新建文件的权限，与open()按umask创建的文件一致。mkstemp创建的临时文件为0600
+FILE_MODE = _default_file_mode()
+
+
+@tracing.traced('io', 'write')
+def atomic_write_bytes(file_path: str, data: bytes,
+                       progress: Optional[Callable[[int, int], None]] = None) -> None:
+    """
+    原子写入文件
+
+    数据写入同一目录下的临时文件并fsync，然后用os.replace替换目标文件，
+    读取方不会看到写了一半的文件，失败时目标文件保持原样。
+    临时文件在替换前改为按umask确定的普通权限（通常为0644）。
+
+    参数：
+        file_path: 目标文件路径
+        data: 文件内容
+        progress: 进度回调，参数为(已写入字节数, 总字节数)
+
+    异常：
+        OSError: 当文件无法写入时抛出
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            view = memoryview(data)
+            total = len(data)
+            for start in range(0, total, WRITE_CHUNK_BYTES):
+                f.write(view[start:start + WRITE_CHUNK_BYTES])
+                if progress:
+                    progress(min(total, start + WRITE_CHUNK_BYTES), total)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class SaveQueue:
+    """后台保存队列类
+
+    每个保存任务由一个编码函数和目标路径组成。编码函数应只引用不可变的快照
+    （底图和标注元组），这样调用方在保存进行期间可以继续编辑。
+    事件回调在工作线程中调用，参数为包含以下键的字典：
+    - job_id: 任务ID
+    - event: queued、encoding、writing、done或failed
+    - path: 目标路径
+    - written/total: 仅writing事件，已写入和总字节数
+    - error: 仅failed事件，错误信息
+    """
+
+    def __init__(self, max_workers: int = 2,
+                 listener: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """
+        初始化后台保存队列
+
+        参数：
+            max_workers: 同时进行的保存数量，默认2
+            listener: 事件回调，为None时不报告事件
+
+        异常：
+            ValueError: 当max_workers小于1时抛出
+        """
+        if max_workers < 1:
+            raise ValueError(f"并行保存数量无效: {max_workers}")
+
+        self.listener = listener
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='save-queue')
+        self._job_ids = itertools.count(1)
+        self._last_job_id = 0
+        self._jobs: Dict[int, 'Future[str]'] = {}
+        self._failed: Dict[int, str] = {}
+        # 失败记录超出上限时被丢弃的最大任务ID
+        self._forgotten_job_id = 0
+        # 可重入，回调中可以查询队列状态
+        self._lock = threading.RLock()
+
+    def submit(self, file_path: str, encode: Union[Callable[[], bytes], bytes]) -> int:
+        """
+        提交保存任务
+
+        参数：
+            file_path: 目标文件路径，所在目录不存在时自动创建
+            encode: 返回文件内容的编码函数，或已经编码好的字节
+
+        返回：
+            任务ID
+
+        异常：
+            RuntimeError: 当队列已关闭时抛出
+        """
+        with self._lock:
+            job_id = next(self._job_ids)
+            self._last_job_id = job_id
+            self._emit(job_id, 'queued', file_path)
+            future = self._executor.submit(self._run, job_id, file_path, encode)
+            self._jobs[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def pending(self) -> int:
+        """
+        获取尚未完成的任务数量
+
+        返回：
+            排队中和进行中的任务数量
+        """
+        with self._lock:
+            return len(self._jobs)
+
+    def wait(self, job_id: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """
+        等待任务完成
+
+        参数：
+            job_id: 任务ID，为None时等待当前所有任务
+            timeout: 最长等待秒数，为None时一直等待
+
+        返回：
+            等待的任务全部成功时返回True；失败、超时或任务不存在时返回False。
+            只保留最近MAX_FAILED_RECORDS个失败记录，更早的已完成任务按不存在处理
+        """
+        with self._lock:
+            if job_id is None:
+                futures = list(self._jobs.values())
+            elif job_id in self._jobs:
+                futures = [self._jobs[job_id]]
+            else:
+                return (self._forgotten_job_id < job_id <= self._last_job_id
+                        and job_id not in self._failed)
+
+        try:
+            for future in futures:
+                future.result(timeout)
+            return True
+        except Exception:
+            return False
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        关闭队列
+
+        参数：
+            wait: 是否等待已提交的任务全部完成，默认True
+        """
+        self._executor.shutdown(wait=wait)
+
+    def _finish(self, job_id: int, future: 'Future[str]') -> None:
+        # 完成的任务不再保留Future，只记录失败原因
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            if not future.cancelled() and future.exception() is not None:
+                self._failed[job_id] = str(future.exception())
+                while len(self._failed) > MAX_FAILED_RECORDS:
+                    forgotten = min(self._failed)
+                    del self._failed[forgotten]
+                    self._forgotten_job_id = max(self._forgotten_job_id, forgotten)
+
+    def _emit(self, job_id: int, event: str, file_path: str, **extra: Any) -> None:
+        if self.listener is None:
+            return
+        try:
+            self.listener(dict(job_id=job_id, event=event, path=file_path, **extra))
+        except Exception as e:
+            print(f"保存事件回调失败: {e}", file=sys.stderr)
+
+    def _run(self, job_id: int, file_path: str,
+             encode: Union[Callable[[], bytes], bytes]) -> str:
+        try:
+            if callable(encode):
+                self._emit(job_id, 'encoding', file_path)
+                data = encode()
+            else:
+                data = encode
+
+            directory = os.path.dirname(file_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            atomic_write_bytes(file_path, data, lambda written, total: self._emit(
+                job_id, 'writing', file_path, written=written, total=total))
+
+            self._emit(job_id, 'done', file_path)
+            return file_path
+
+        except Exception as e:
+            print(f"后台保存失败: {e}", file=sys.stderr)
+            self._emit(job_id, 'failed', file_path, error=str(e))
+            raise
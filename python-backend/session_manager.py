@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话管理模块
+
+功能描述：
+- 在同一进程中持有多个相互独立的ImageProcessor会话
+- 每个会话一把锁，同一会话的调用串行执行，不同会话可以并行
+- 会话调用在会话线程池中执行；旋转、估算等内部并行计算使用parallel_ops的共享线程池
+- Pillow在C循环中释放GIL，因此多个会话可以同时利用多核
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import uuid
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, List
+
+from image_processor import ImageProcessor
+from parallel_ops import worker_count
+
+
+class _Session:
+    """单个会话：处理器及其锁"""
+
+    def __init__(self, processor: ImageProcessor) -> None:
+        self.processor = processor
+        self.lock = threading.Lock()
+        self.closed = False
+
+
+class SessionManager:
+    """会话管理器类
+
+    会话调用与处理器内部的并行计算使用不同的线程池：会话调用会等待内部任务完成，
+    如果两者共用一个线程池，线程全部被会话调用占满时内部任务将无法执行。
+    """
+
+    def __init__(self, max_workers: Optional[int] = None,
+                 processor_factory: Callable[[], ImageProcessor] = ImageProcessor) -> None:
+        """
+        初始化会话管理器
+
+        参数：
+            max_workers: 会话线程池的线程数，为None时等于CPU核心数
+            processor_factory: 创建新会话处理器的函数，默认ImageProcessor
+
+        异常：
+            无
+        """
+        self.processor_factory = processor_factory
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or worker_count(),
+                                            thread_name_prefix='session')
+        self._sessions: Dict[str, _Session] = {}
+        self._lock = threading.Lock()
+
+    def create_session(self, session_id: Optional[str] = None) -> str:
+        """
+        创建会话
+
+        参数：
+            session_id: 会话ID，为None时自动生成
+
+        返回：
+            会话ID
+
+        异常：
+            ValueError: 当会话ID已存在时抛出
+        """
+        session_id = session_id or uuid.uuid4().hex
+        processor = self.processor_factory()
+        with self._lock:
+            if session_id in self._sessions:
+                raise ValueError(f"会话已存在: {session_id}")
+            self._sessions[session_id] = _Session(processor)
+        return session_id
+
+    def close_session(self, session_id: str) -> bool:
+        """
+        关闭会话并释放其处理器的后台线程和历史记录
+
+        正在执行的调用会先完成，之后提交到该会话的调用抛出KeyError。
+
+        参数：
+            session_id: 会话ID
+
+        返回：
+            会话存在并被关闭时返回True
+        """
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+
+        with session.lock:
+            session.closed = True
+            session.processor.close()
+        return True
+
+    def session_ids(self) -> List[str]:
+        """
+        列出当前的会话ID
+
+        返回：
+            会话ID列表
+        """
+        with self._lock:
+            return list(self._sessions)
+
+    def call(self, session_id: str, method: str, *args: Any, **kwargs: Any) -> Any:
+        """
+        在调用方线程中执行会话处理器的方法
+
+        持有会话锁直到方法返回。
+
+        参数：
+            session_id: 会话ID
+            method: ImageProcessor的方法名，如'rotate'
+            *args: 方法位置参数
+            **kwargs: 方法关键字参数
+
+        返回：
+            方法的返回值
+
+        异常：
+            KeyError: 当会话不存在或已关闭时抛出
+            AttributeError: 当方法不存在时抛出
+        """
+        session = self._get(session_id)
+        with session.lock:
+            if session.closed:
+                raise KeyError(session_id)
+            return getattr(session.processor, method)(*args, **kwargs)
+
+    def submit(self, session_id: str, method: str, *args: Any, **kwargs: Any) -> 'Future[Any]':
+        """
+        在会话线程池中执行会话处理器的方法
+
+        参数：
+            session_id: 会话ID
+            method: ImageProcessor的方法名
+            *args: 方法位置参数
+            **kwargs: 方法关键字参数
+
+        返回：
+            方法返回值的Future
+
+        异常：
+            KeyError: 当会话不存在时抛出
+        """
+        self._get(session_id)
+        return self._executor.submit(self.call, session_id, method, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        关闭所有会话和会话线程池
+
+        参数：
+            wait: 是否等待已提交的调用完成，默认True
+        """
+        self._executor.shutdown(wait=wait)
+        for session_id in self.session_ids():
+            self.close_session(session_id)
+
+    def _get(self, session_id: str) -> _Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+目标文件大小搜索模块
+
+功能描述：
+- 在质量（或调色板颜色数）范围内查找编码结果不超过字节预算的最大取值
+- 多路并行搜索：每轮在共享线程池中同时编码多个候选值，按结果缩小区间
+- 第一轮候选集中在抽样估算得到的种子值附近，通常一到两轮即可确定结果
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+from dataclasses import dataclass
+from typing import Optional, Callable, Dict, List
+
+from parallel_ops import get_worker_pool, worker_count
+
+
+# 每轮至少同时评估的候选数
+MIN_FANOUT = 3
+
+# 第一轮候选覆盖种子值上下的范围，对应抽样估算的典型误差
+SEED_RANGE = 8
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    """搜索结果
+
+    value为满足预算的最大取值，没有取值满足预算时为None，
+    此时size为所有候选中最小的编码大小。
+    """
+    value: Optional[int]
+    data: Optional[bytes]
+    size: int
+    encodes: int
+    rounds: int
+
+
+def _spread(low: int, high: int, count: int) -> List[int]:
+    """
+    在开区间(low, high)内均匀选取最多count个整数
+
+    参数：
+        low: 区间下界（不含）
+        high: 区间上界（不含）
+        count: 最大候选数
+
+    返回：
+        升序的候选列表
+    """
+    inner = high - low - 1
+    if inner <= count:
+        return list(range(low + 1, high))
+    return sorted({low + round((i + 1) * (high - low) / (count + 1)) for i in range(count)})
+
+
+def _seeded(seed: int, low: int, high: int, count: int) -> List[int]:
+    """
+    生成第一轮候选：在种子值上下SEED_RANGE内均匀选取
+
+    种子落在误差范围内时，第一轮即可把区间缩小到相邻候选之间，第二轮确定结果。
+    超出取值范围的候选截断到边界，种子为上界时上界本身也是候选。
+
+    参数：
+        seed: 预测的取值
+        low: 允许的最小取值
+        high: 允许的最大取值
+        count: 候选数
+
+    返回：
+        候选列表
+    """
+    seed = min(max(seed, low), high)
+    if count == 1:
+        return [seed]
+    step = 2 * SEED_RANGE / (count - 1)
+    return sorted({min(max(round(seed - SEED_RANGE + step * i), low), high) for i in range(count)})
+
+
+def search(encode: Callable[[int], bytes], max_bytes: int, low: int, high: int,
+           seed: Optional[int] = None, fanout: Optional[int] = None,
+           parallel: bool = True) -> SearchResult:
+    """
+    查找编码大小不超过max_bytes的最大取值
+
+    假定编码大小随取值单调不减；实际略有波动时，结果仍保证不超过预算。
+    encode会在共享线程池中被调用，内部不能再等待共享线程池中的任务，
+    此类编码函数（如逐帧并行的多帧编码）应传parallel=False。
+
+    参数：
+        encode: 按取值编码的函数
+        max_bytes: 字节预算
+        low: 最小取值
+        high: 最大取值
+        seed: 预测的取值，为None时第一轮在整个区间内均匀选取
+        fanout: 每轮的候选数，为None时等于线程数（至少MIN_FANOUT）
+        parallel: 是否在共享线程池中并行评估候选
+
+    返回：
+        搜索结果
+    """
+    fanout = max(MIN_FANOUT, fanout or worker_count())
+    sizes: Dict[int, int] = {}
+    best_value: Optional[int] = None
+    best_data: Optional[bytes] = None
+    smallest: Optional[int] = None
+    rounds = 0
+
+    if seed is None:
+        candidates = sorted(set(_spread(low - 1, high, fanout - 1)) | {high})
+    else:
+        candidates = _seeded(seed, low, high, fanout)
+
+    while candidates:
+        if parallel and len(candidates) > 1:
+            results = list(get_worker_pool().map(encode, candidates))
+        else:
+            results = [encode(value) for value in candidates]
+        rounds += 1
+
+        for value, data in zip(candidates, results):
+            sizes[value] = len(data)
+            smallest = len(data) if smallest is None else min(smallest, len(data))
+            if len(data) <= max_bytes and (best_value is None or value > best_value):
+                best_value, best_data = value, data
+
+        # 区间缩小到已知满足预算的最大值与其上方最近的超出预算的值之间
+        floor = low - 1 if best_value is None else best_value
+        ceiling = min([v for v, s in sizes.items() if s > max_bytes and v > floor] + [high + 1])
+        candidates = [v for v in _spread(floor, ceiling, fanout) if v not in sizes]
+
+    return SearchResult(
+        value=best_value,
+        data=best_data,
+        size=len(best_data) if best_data is not None else (smallest or 0),
+        encodes=len(sizes),
+        rounds=rounds
+    )
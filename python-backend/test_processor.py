@@ -168,6 +168,1347 @@ def test_command_line_interface():
         print(f"   裁剪命令异常: {e}")
 
 
+def test_thumbnail():
+    """
+    测试缩略图生成与缓存
+    """
+    print("\n=== 测试缩略图 ===")
+    
+    import base64
+    import tempfile
+    from io import BytesIO
+    from disk_cache import DiskCache
+    
+    processor = ImageProcessor()
+    
+    # 大尺寸JPEG走draft路径，PNG走reduce路径
+    img = Image.new('RGB', (2000, 1200), color='white')
+    ImageDraw.Draw(img).rectangle([100, 100, 1900, 1100], outline='blue', width=20)
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = DiskCache(os.path.join(tmp_dir, 'cache'), max_bytes=1024 * 1024)
+        
+        for fmt in ('JPEG', 'PNG'):
+            path = os.path.join(tmp_dir, f'source.{fmt.lower()}')
+            img.save(path, format=fmt)
+            
+            print(f"1. 测试{fmt}缩略图...")
+            data_url = processor.thumbnail(path, 200, 200, 'PNG', cache)
+            assert data_url is not None
+            thumb = Image.open(BytesIO(base64.b64decode(data_url.split(',')[1])))
+            print(f"   缩略图尺寸: {thumb.width} x {thumb.height}")
+            assert thumb.size == (200, 120)
+            
+            print(f"2. 测试{fmt}缩略图缓存命中...")
+            assert processor.thumbnail(path, 200, 200, 'PNG', cache) == data_url
+            print("   缓存命中: 成功")
+        
+        assert len(os.listdir(cache.directory)) == 2
+        
+        # 命令行的磁盘缓存需显式启用，位于用户私有缓存目录下
+        print("3. 测试命令行缓存开关...")
+        import subprocess
+        import disk_cache
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp_dir, 'xdg'),
+                   LOCALAPPDATA=os.path.join(tmp_dir, 'xdg'))
+        thumbnails = os.path.join(tmp_dir, 'xdg', disk_cache.APP_CACHE_NAME, 'thumbnails')
+        for params in ({}, {'cache': True}):
+            completed = subprocess.run([
+                sys.executable, 'image_processor.py', 'thumbnail', '--input', path,
+                '--params', json.dumps(params)
+            ], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+            assert json.loads(completed.stdout)['success']
+            if not params:
+                assert not os.path.exists(thumbnails)
+        assert len(os.listdir(thumbnails)) == 1
+        if os.name != 'nt':
+            assert os.stat(thumbnails).st_mode & 0o777 == 0o700
+            # 其他用户可写的缓存目录不被使用，缩略图照常生成
+            os.chmod(thumbnails, 0o777)
+            completed = subprocess.run([
+                sys.executable, 'image_processor.py', 'thumbnail', '--input', path,
+                '--params', json.dumps({'cache': True, 'width': 64, 'height': 64})
+            ], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+            assert json.loads(completed.stdout)['success']
+            assert len(os.listdir(thumbnails)) == 1
+        
+        # 缩略图不影响处理器状态
+        assert processor.image is None
+
+
+def test_annotation_layer():
+    """
+    测试矢量标注图层
+    """
+    print("\n=== 测试矢量标注图层 ===")
+    
+    from annotation_layer import load_font
+    
+    processor = ImageProcessor()
+    processor.load_from_base64(create_test_image())
+    base = processor.image.copy()
+    
+    # 标注不修改底图，导出结果与直接绘制一致
+    print("1. 测试添加标注...")
+    processor.draw_rectangle(20, 20, 100, 80, 'blue', None, 2)
+    processor.add_text("Label", 30, 30, 24, 'red')
+    assert processor.image.tobytes() == base.tobytes()
+    
+    expected = base.copy()
+    draw = ImageDraw.Draw(expected)
+    draw.rectangle([20, 20, 100, 80], outline='blue', width=2)
+    draw.text((30, 30), "Label", fill='red', font=load_font(None, 24))
+    assert processor.layer.composite(processor.image).tobytes() == expected.tobytes()
+    print(f"   标注数量: {len(processor.get_annotations())}")
+    
+    # 移动和删除单个标注
+    print("2. 测试修改和删除标注...")
+    rect_id, text_id = [a['annotation_id'] for a in processor.get_annotations()]
+    assert processor.update_annotation(rect_id, x1=200, x2=280)
+    assert processor.remove_annotation(text_id)
+    
+    expected = base.copy()
+    ImageDraw.Draw(expected).rectangle([200, 20, 280, 80], outline='blue', width=2)
+    assert processor.layer.composite(processor.image).tobytes() == expected.tobytes()
+    assert not processor.remove_annotation(text_id)
+    
+    # 撤销删除后标注恢复
+    print("3. 测试撤销标注操作...")
+    assert processor.undo()
+    assert len(processor.get_annotations()) == 2
+    
+    # 几何操作前标注被合成进底图
+    print("4. 测试几何操作合成标注...")
+    assert processor.flip_horizontal()
+    assert processor.get_annotations() == []
+    assert processor.undo()
+    assert len(processor.get_annotations()) == 2
+    
+    # 不带透明通道的底图上半透明颜色按不透明绘制，与直接绘制一致；
+    # 带透明通道的底图上按透明度混合
+    print("5. 测试半透明颜色...")
+    from annotation_layer import AnnotationLayer, RectangleAnnotation
+    layer = AnnotationLayer()
+    layer.set_annotations((RectangleAnnotation(1, 0, 0, 9, 9, '#ff000080', '#ff000080', 1),))
+    rgb = Image.new('RGB', (10, 10), (0, 0, 255))
+    expected = rgb.copy()
+    ImageDraw.Draw(expected).rectangle([0, 0, 9, 9], outline='#ff000080', fill='#ff000080', width=1)
+    assert layer.composite(rgb).tobytes() == expected.tobytes()
+    assert layer.composite(rgb).getpixel((5, 5)) == (255, 0, 0)
+    rgba = Image.new('RGBA', (10, 10), (0, 0, 255, 255))
+    assert layer.composite(rgba).getpixel((5, 5)) == (128, 0, 127, 255)
+    # 叠加层按底图模式重建
+    assert layer.composite(rgb).getpixel((5, 5)) == (255, 0, 0)
+    
+    # 调色板图像：没有透明色时输出RGB，有透明色时输出RGBA
+    print("6. 测试调色板底图...")
+    import tempfile
+    from io import BytesIO
+    palette = rgb.convert('P')
+    assert layer.composite(palette).mode == 'RGB'
+    assert layer.composite(palette).getpixel((5, 5)) == (255, 0, 0)
+    transparent = palette.copy()
+    transparent.info['transparency'] = 0
+    assert layer.composite(transparent).mode == 'RGBA'
+    processor = ImageProcessor()
+    buffer = BytesIO()
+    rgb.convert('P').save(buffer, format='GIF')
+    assert processor.load_from_bytes(buffer.getvalue())
+    assert processor.draw_rectangle(2, 2, 6, 6, 'red', None, 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'annotated.png')
+        assert processor.save_to_file(path, 'PNG')
+        with Image.open(path) as saved:
+            assert saved.mode == 'RGB'
+    print("   标注图层测试: 成功")
+
+
+def test_dirty_patch():
+    """
+    测试脏区域与局部更新补丁
+    """
+    print("\n=== 测试局部更新补丁 ===")
+    
+    import base64
+    from io import BytesIO
+    
+    processor = ImageProcessor()
+    processor.load_from_base64(create_test_image())
+    
+    # 绘制操作只报告标注覆盖的区域
+    print("1. 测试绘制操作的脏区域...")
+    processor.draw_rectangle(20, 30, 60, 50, 'red', None, 2)
+    print(f"   脏区域: {processor.dirty_box}")
+    assert processor.dirty_box == (20, 30, 61, 51)
+    
+    # 补丁内容与整图合成结果的对应区域一致
+    print("2. 测试补丁内容...")
+    patch = processor.get_patch()
+    patch_image = Image.open(BytesIO(base64.b64decode(patch['base64'].split(',')[1])))
+    full = processor.layer.composite(processor.image)
+    assert (patch['x'], patch['y'], patch['width'], patch['height']) == (20, 30, 41, 21)
+    assert patch_image.tobytes() == full.crop((20, 30, 61, 51)).tobytes()
+    
+    # 撤销标注只刷新该标注区域，几何操作刷新整图
+    print("3. 测试撤销和几何操作的脏区域...")
+    processor.undo()
+    assert processor.dirty_box == (20, 30, 61, 51)
+    processor.rotate(90)
+    assert processor.dirty_box == (0, 0, 300, 400)
+    print("   局部更新补丁测试: 成功")
+
+
+def test_request_scheduler():
+    """
+    测试请求调度器的顺序编辑与最新优先合并
+    """
+    print("\n=== 测试请求调度器 ===")
+    
+    import asyncio
+    import time
+    from request_scheduler import RequestScheduler, RequestSuperseded
+    
+    executed = []
+    
+    def render_preview(angle):
+        # 从固定的基准状态按绝对角度渲染，只有最新的角度有意义
+        time.sleep(0.05)
+        executed.append(angle)
+        return angle
+    
+    async def drag():
+        scheduler = RequestScheduler(max_workers=2)
+        try:
+            # 模拟拖动滑块：第一个请求执行期间又到达多个请求
+            tasks = [asyncio.ensure_future(scheduler.submit_latest('s1', 'rotate_preview', render_preview, 0))]
+            await asyncio.sleep(0.01)
+            tasks += [asyncio.ensure_future(scheduler.submit_latest('s1', 'rotate_preview', render_preview, angle))
+                      for angle in range(10, 50, 10)]
+            # 其他会话的请求不受影响
+            other = asyncio.ensure_future(scheduler.submit_latest('s2', 'rotate_preview', render_preview, 90))
+            return await asyncio.gather(*tasks, other, return_exceptions=True)
+        finally:
+            scheduler.shutdown()
+    
+    print("1. 测试拖动过程中的过期预览请求...")
+    results = asyncio.run(drag())
+    superseded = [r for r in results if isinstance(r, RequestSuperseded)]
+    print(f"   执行的角度: {sorted(executed)}, 被取代的请求: {len(superseded)}")
+    assert results[0] == 0
+    assert results[4] == 40
+    assert results[5] == 90
+    assert len(superseded) == 3
+    assert sorted(executed) == [0, 40, 90]
+    
+    # 相对编辑按顺序全部执行：两次快速的旋转都生效
+    print("2. 测试快速的相对编辑...")
+    processor = ImageProcessor()
+    processor.load_from_base64(create_test_image())
+    start_index = processor.history_index
+    
+    async def edits():
+        scheduler = RequestScheduler(max_workers=2)
+        try:
+            first = asyncio.ensure_future(scheduler.submit_ordered('s1', processor.rotate, 90))
+            second = asyncio.ensure_future(scheduler.submit_ordered('s1', processor.rotate, 90))
+            crop = asyncio.ensure_future(scheduler.submit_ordered('s1', processor.crop, 0, 0, 200, 100))
+            results = await asyncio.gather(first, second, crop)
+            # 相对编辑不能提交为最新优先
+            try:
+                await scheduler.submit_latest('s1', 'rotate', processor.rotate, 10)
+                assert False, "相对编辑应被拒绝"
+            except ValueError:
+                pass
+            return results
+        finally:
+            scheduler.shutdown()
+    
+    assert asyncio.run(edits()) == [True, True, True]
+    assert processor.history_index == start_index + 3
+    # 400x300旋转两次90°后仍为400x300，再裁剪
+    assert processor.image.size == (200, 100)
+    processor.undo()
+    assert processor.image.size == (400, 300)
+    print("   请求调度器测试: 成功")
+
+
+def test_parallel_rotate():
+    """
+    测试条带并行旋转与单线程旋转结果一致
+    """
+    print("\n=== 测试并行旋转 ===")
+    
+    import parallel_ops
+    
+    img = Image.effect_noise((640, 480), 64).convert('RGB')
+    old_threshold = parallel_ops.PARALLEL_ROTATE_MIN_PIXELS
+    parallel_ops.PARALLEL_ROTATE_MIN_PIXELS = 0
+    
+    try:
+        for mode in ('RGB', 'RGBA', 'L'):
+            for angle in (45, -17.5, 1, 133.3):
+                source = img.convert(mode)
+                expected = source.rotate(angle, expand=True, fillcolor='white')
+                result = parallel_ops.rotate_expand(source, angle, 'white', strips=5)
+                assert result.size == expected.size
+                assert result.tobytes() == expected.tobytes(), (mode, angle)
+            print(f"   {mode}模式逐像素一致: 成功")
+    finally:
+        parallel_ops.PARALLEL_ROTATE_MIN_PIXELS = old_threshold
+
+
+def test_raw_frame():
+    """
+    测试原始帧格式的零复制加载与写回
+    """
+    print("\n=== 测试原始帧格式 ===")
+    
+    import tempfile
+    
+    img = Image.effect_noise((320, 240), 64).convert('RGBA')
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_path = os.path.join(tmp_dir, 'frame.pfraw')
+        
+        print("1. 测试写入原始帧...")
+        processor = ImageProcessor()
+        processor.image = img
+        processor._init_history()
+        assert processor.save_to_raw(raw_path)
+        assert os.path.getsize(raw_path) == 32 + 320 * 240 * 4
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(raw_path).st_mode & 0o777 == 0o666 & ~umask
+        
+        # 加载后像素直接映射文件内容（Windows上复制后关闭映射），文件仍可被覆盖
+        print("2. 测试映射加载...")
+        import raw_frame
+        loaded = ImageProcessor()
+        assert loaded.load_from_file(raw_path)
+        assert loaded.image.readonly == (not raw_frame.COPY_ON_LOAD)
+        assert loaded.image.tobytes() == img.tobytes()
+        flipped = ImageProcessor()
+        flipped.image = img.transpose(Image.FLIP_LEFT_RIGHT)
+        flipped._init_history()
+        assert flipped.save_to_raw(raw_path)
+        assert loaded.image.tobytes() == img.tobytes()
+        
+        # 编辑操作不会改动映射的数据
+        print("3. 测试在映射图像上编辑...")
+        assert loaded.flip_vertical()
+        assert loaded.undo()
+        assert loaded.image.tobytes() == img.tobytes()
+        del loaded
+        
+        # 映射随图像释放而关闭；复制时立即关闭
+        if os.path.exists('/proc/self/maps'):
+            print("4. 测试映射生命周期...")
+            import gc
+            
+            def mapped() -> bool:
+                with open('/proc/self/maps') as f:
+                    return raw_path in f.read()
+            
+            image = raw_frame.open_raw_frame(raw_path, copy=False)
+            assert image.readonly and mapped()
+            del image
+            gc.collect()
+            assert not mapped()
+            image = raw_frame.open_raw_frame(raw_path, copy=True)
+            assert not image.readonly and not mapped()
+            assert image.tobytes() == img.transpose(Image.FLIP_LEFT_RIGHT).tobytes()
+        print("   原始帧测试: 成功")
+
+
+def test_tiered_history():
+    """
+    测试分层历史记录的压缩、溢出与恢复
+    """
+    print("\n=== 测试分层历史记录 ===")
+    
+    # 压缩层预算很小，迫使较早的状态溢出到磁盘
+    processor = ImageProcessor(max_history=30, history_budget=64 * 1024)
+    processor.load_from_base64(create_test_image())
+    
+    print("1. 测试深度历史记录...")
+    snapshots = [processor.image.tobytes()]
+    for i in range(12):
+        processor.rotate(90) if i % 2 else processor.flip_horizontal()
+        snapshots.append(processor.image.tobytes())
+    
+    stats = processor.history.stats()
+    print(f"   分层情况: {stats}")
+    assert stats['live'] <= 2
+    assert stats['spilled'] > 0
+    assert stats['compressed_bytes'] <= 64 * 1024
+    
+    # 逐步撤销，每个状态都能透明恢复
+    print("2. 测试撤销恢复...")
+    for expected in reversed(snapshots[:-1]):
+        assert processor.undo()
+        assert processor.image.tobytes() == expected
+    assert not processor.undo()
+    
+    print("3. 测试重做恢复...")
+    for expected in snapshots[1:]:
+        assert processor.redo()
+        assert processor.image.tobytes() == expected
+    
+    processor.history.close()
+    print("   分层历史记录测试: 成功")
+
+
+def test_estimate_size():
+    """
+    测试输出文件大小估算
+    """
+    print("\n=== 测试文件大小估算 ===")
+    from io import BytesIO
+    import random
+    
+    # 小图像直接完整编码，结果精确
+    print("1. 测试小图像精确估算...")
+    processor = ImageProcessor()
+    processor.load_from_base64(create_test_image())
+    estimate = processor.estimate_size('PNG')
+    buffer = BytesIO()
+    processor.image.save(buffer, format='PNG')
+    assert estimate['exact'] and estimate['estimated_size'] == buffer.tell()
+    assert processor.estimate_size('PNG') == estimate
+    # PNG不使用质量参数，共享缓存条目但返回本次调用的质量
+    assert processor.estimate_size('PNG', 50) == dict(estimate, quality=50)
+    assert processor.estimate_size('PNG')['quality'] == 95
+    
+    # 大图像抽样外推，实际大小落在误差界内
+    print("2. 测试大图像抽样估算...")
+    rng = random.Random(1)
+    img = Image.new('RGB', (1600, 1200), 'white')
+    draw = ImageDraw.Draw(img)
+    for _ in range(300):
+        x, y = rng.randrange(1600), rng.randrange(1200)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle([x, y, x + rng.randrange(200), y + rng.randrange(200)], fill=color)
+    processor.image = img
+    processor.original_image = img
+    processor._init_history()
+    
+    for format in ('JPEG', 'PNG'):
+        estimate = processor.estimate_size(format, 85)
+        buffer = BytesIO()
+        img.save(buffer, format=format, quality=85)
+        actual = buffer.tell()
+        print(f"   {format}: 估算 {estimate['estimated_size']} ± {estimate['error_bound']}，实际 {actual}")
+        assert not estimate['exact']
+        assert abs(estimate['estimated_size'] - actual) <= estimate['error_bound']
+    
+    # 估算结果按历史状态缓存
+    state_id = processor.history.current.state_id
+    assert processor.derived.get(state_id, 'estimate', ('PNG', 0)) == estimate
+    processor.flip_horizontal()
+    assert processor.derived.get(processor.history.current.state_id, 'estimate', ('JPEG', 85)) is None
+    print("   文件大小估算测试: 成功")
+
+
+def test_pre_encode():
+    """
+    测试空闲时的后台预编码
+    """
+    print("\n=== 测试后台预编码 ===")
+    import base64
+    import tempfile
+    
+    processor = ImageProcessor(pre_encode_delay=0.05)
+    processor.load_from_base64(create_test_image())
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # 第一次保存确定格式，之后的编辑在空闲时按该格式预编码
+        print("1. 测试预编码结果...")
+        assert processor.save_to_file(os.path.join(tmp, 'first.jpg'), 'JPEG', 80)
+        processor.draw_rectangle(10, 10, 120, 90, 'red')
+        assert processor._pre_encoder.wait_idle(5)
+        state_id = processor.history.current.state_id
+        data = processor._pre_encoder.take((state_id, 'JPEG', 80))
+        assert data is not None
+        
+        path = os.path.join(tmp, 'second.jpg')
+        assert processor.save_to_file(path, 'jpg', 80)
+        with open(path, 'rb') as f:
+            assert f.read() == data
+        assert processor.to_base64('JPEG', 80).endswith(base64.b64encode(data).decode('utf-8'))
+        
+        # 新编辑使旧结果失效
+        print("2. 测试编辑后失效...")
+        processor.flip_horizontal()
+        assert processor._pre_encoder.take((state_id, 'JPEG', 80)) is None
+        
+        # 结果与同步编码一致
+        print("3. 测试与同步编码一致...")
+        processor.undo()
+        processor.redo()
+        assert processor._pre_encoder.wait_idle(5)
+        redo_state = processor.history.current.state_id
+        assert processor._pre_encoder.take((redo_state, 'JPEG', 80)) == processor._encoded('JPEG', 80)
+        
+        # 撤销回已保存过的状态时直接使用缓存的编码结果
+        processor.undo()
+        assert processor._pre_encoder.take((state_id, 'JPEG', 80)) is None
+        assert processor.derived.get(state_id, 'encoded', ('JPEG', 80)) == data
+        
+        # 格式不匹配时正常同步保存
+        assert processor.save_to_file(os.path.join(tmp, 'third.png'), 'PNG')
+        with Image.open(os.path.join(tmp, 'third.png')) as img:
+            assert img.format == 'PNG'
+        
+        # 预览编码不改变预编码格式
+        print("4. 测试预览不改变格式...")
+        assert processor.to_base64('JPEG', 50) is not None
+        processor.draw_rectangle(5, 5, 30, 30, 'blue')
+        assert processor._pre_encoder.wait_idle(5)
+        preview_state = processor.history.current.state_id
+        assert processor._pre_encoder.take((preview_state, 'PNG', 0)) is not None
+        assert processor._pre_encoder.take((preview_state, 'JPEG', 50)) is None
+    
+    # 连续编辑只复用同一个工作线程
+    print("5. 测试单个工作线程...")
+    import threading
+    before = threading.active_count()
+    for _ in range(20):
+        processor.rotate(90)
+    assert threading.active_count() <= before + 1
+    assert processor._pre_encoder.wait_idle(5)
+    assert processor._pre_encoder.take((processor.history.current.state_id, 'PNG', 0)) is not None
+    
+    processor._pre_encoder.shutdown()
+    print("   后台预编码测试: 成功")
+
+
+def test_save_queue():
+    """
+    测试后台保存队列
+    """
+    print("\n=== 测试后台保存队列 ===")
+    import tempfile
+    import threading
+    from save_queue import SaveQueue
+    
+    events = []
+    lock = threading.Lock()
+    
+    def listener(event):
+        with lock:
+            events.append(event)
+    
+    queue = SaveQueue(max_workers=2, listener=listener)
+    processor = ImageProcessor()
+    processor.load_from_base64(create_test_image())
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # 提交后立即继续编辑，保存的是提交时的快照
+        print("1. 测试快照保存...")
+        processor.draw_rectangle(20, 20, 200, 150, 'red', 'yellow')
+        expected = processor.layer.composite(processor.image).tobytes()
+        first = processor.save_async(queue, os.path.join(tmp, 'out', 'first.png'))
+        processor.flip_vertical()
+        second = processor.save_async(queue, os.path.join(tmp, 'out', 'second.jpg'), 'JPEG', 80)
+        assert queue.wait(timeout=10)
+        assert queue.wait(first) and queue.wait(second)
+        
+        with Image.open(os.path.join(tmp, 'out', 'first.png')) as img:
+            assert img.tobytes() == expected
+        with Image.open(os.path.join(tmp, 'out', 'second.jpg')) as img:
+            assert img.format == 'JPEG'
+        
+        # 每个任务依次经历queued、encoding、writing、done
+        print("2. 测试进度事件...")
+        for job_id in (first, second):
+            kinds = [e['event'] for e in events if e['job_id'] == job_id]
+            assert kinds[0] == 'queued' and kinds[1] == 'encoding' and kinds[-1] == 'done'
+            assert 'writing' in kinds
+        
+        # 写入失败时目标目录中不残留临时文件
+        print("3. 测试失败处理...")
+        blocked = os.path.join(tmp, 'blocked')
+        with open(blocked, 'w') as f:
+            f.write('x')
+        failed = processor.save_async(queue, os.path.join(blocked, 'x.png'))
+        assert not queue.wait(failed, timeout=10)
+        assert any(e['event'] == 'failed' and e['job_id'] == failed for e in events)
+        assert sorted(os.listdir(os.path.join(tmp, 'out'))) == ['first.png', 'second.jpg']
+        
+        # 失败记录有上限，超出时最早的失败任务按不存在处理
+        import time
+        import save_queue
+        limit = save_queue.MAX_FAILED_RECORDS
+        save_queue.MAX_FAILED_RECORDS = 2
+        try:
+            more = [processor.save_async(queue, os.path.join(blocked, f'{i}.png')) for i in range(2)]
+            # 失败记录在完成回调中写入，等到没有未完成的任务
+            while queue.pending():
+                time.sleep(0.01)
+            assert len(queue._failed) == 2 and failed not in queue._failed
+            assert not queue.wait(failed) and not any(queue.wait(job_id) for job_id in more)
+        finally:
+            save_queue.MAX_FAILED_RECORDS = limit
+        
+        # 保存的文件按umask设置权限，而不是临时文件的0600
+        print("4. 测试文件权限...")
+        if os.name == 'posix':
+            umask = os.umask(0o022)
+            os.umask(umask)
+            mode = os.stat(os.path.join(tmp, 'out', 'first.png')).st_mode & 0o777
+            assert mode == 0o666 & ~umask
+    
+    queue.shutdown()
+    print("   后台保存队列测试: 成功")
+
+
+def test_derived_cache():
+    """
+    测试按历史状态缓存的派生数据
+    """
+    print("\n=== 测试派生数据缓存 ===")
+    from derived_cache import DerivedCache
+    
+    # 超出字节预算时淘汰最久未使用的条目
+    print("1. 测试LRU淘汰...")
+    cache = DerivedCache(max_bytes=100)
+    cache.put(1, 'encoded', ('PNG', 0), b'a' * 40)
+    cache.put(2, 'encoded', ('PNG', 0), b'b' * 40)
+    assert cache.get(1, 'encoded', ('PNG', 0)) is not None
+    cache.put(3, 'encoded', ('PNG', 0), b'c' * 40)
+    assert cache.get(2, 'encoded', ('PNG', 0)) is None
+    assert cache.stats()['bytes'] == 80
+    
+    # 重复的保存和信息查询直接命中缓存
+    print("2. 测试重复调用命中...")
+    cache = DerivedCache()
+    processor = ImageProcessor(derived_cache=cache)
+    processor.load_from_base64(create_test_image())
+    processor.draw_rectangle(10, 10, 100, 100, 'blue', 'white')
+    first = processor.to_base64('JPEG', 80)
+    hits = cache.stats()['hits']
+    assert processor.to_base64('JPEG', 80) == first
+    assert processor.get_image_info() == processor.get_image_info()
+    assert cache.stats()['hits'] > hits
+    
+    # 撤销后再编辑，被截断的状态的派生数据一并移除
+    print("3. 测试状态丢弃...")
+    dropped = processor.history.current.state_id
+    processor.undo()
+    processor.flip_horizontal()
+    assert cache.get(dropped, 'encoded', ('JPEG', 80)) is None
+    assert all(k[0] != dropped for k in cache._entries)
+    print("   派生数据缓存测试: 成功")
+
+
+def test_multi_frame():
+    """
+    测试动画GIF和多页TIFF的逐帧处理
+    """
+    print("\n=== 测试多帧图像 ===")
+    import tempfile
+    
+    frames = []
+    for i in range(5):
+        frame = Image.new('RGB', (120, 80), (i * 50, 120, 200))
+        ImageDraw.Draw(frame).rectangle([i * 15, 10, i * 15 + 20, 40], fill='red')
+        frames.append(frame)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'anim.gif')
+        frames[0].save(source, save_all=True, append_images=frames[1:],
+                       duration=[40, 50, 60, 70, 80], loop=0)
+        
+        processor = ImageProcessor()
+        assert processor.load_from_file(source)
+        assert processor.get_image_info()['n_frames'] == 5
+        
+        # 标注和几何操作作用于每一帧
+        print("1. 测试逐帧重放...")
+        processor.draw_rectangle(5, 5, 60, 60, 'blue')
+        processor.rotate(90)
+        processor.crop(0, 0, 70, 100)
+        processor.add_text('hi', 10, 10, 16, 'green')
+        preview = processor._composite().convert('RGBA')
+        
+        gif_path = os.path.join(tmp, 'out.gif')
+        assert processor.save_to_file(gif_path, 'GIF')
+        with Image.open(gif_path) as result:
+            assert result.n_frames == 5 and result.size == preview.size
+            durations = []
+            for index in range(result.n_frames):
+                result.seek(index)
+                durations.append(result.info.get('duration'))
+            assert durations == [40, 50, 60, 70, 80]
+            assert result.info.get('loop') == 0
+        
+        # TIFF无损，第一帧与编辑预览逐像素一致
+        print("2. 测试多页TIFF...")
+        tiff_path = os.path.join(tmp, 'out.tiff')
+        assert processor.save_to_file(tiff_path, 'TIFF')
+        with Image.open(tiff_path) as result:
+            assert result.n_frames == 5
+            assert result.convert('RGBA').tobytes() == preview.tobytes()
+            result.seek(4)
+            assert result.convert('RGBA').tobytes() != preview.tobytes()
+        
+        # 撤销恢复操作日志
+        print("3. 测试撤销...")
+        processor.undo()
+        processor.undo()
+        assert processor.save_to_file(gif_path, 'GIF')
+        with Image.open(gif_path) as result:
+            assert result.n_frames == 5 and result.size == (80, 120)
+        
+        # 不支持多帧的格式只保存第一帧
+        jpeg_path = os.path.join(tmp, 'out.jpg')
+        assert processor.save_to_file(jpeg_path, 'JPEG')
+        with Image.open(jpeg_path) as result:
+            assert getattr(result, 'n_frames', 1) == 1
+        
+        # 完全不透明的动画不带透明通道，有透明色的动画保留透明度
+        print("4. 测试透明度...")
+        opaque = ImageProcessor()
+        assert opaque.load_from_file(source)
+        info = opaque.get_image_info()
+        assert info['mode'] == 'RGB' and not info['has_transparency']
+        assert opaque.draw_rectangle(5, 5, 30, 30, 'blue')
+        assert opaque.save_to_file(tiff_path, 'TIFF')
+        with Image.open(tiff_path) as result:
+            for index in range(result.n_frames):
+                result.seek(index)
+                assert result.mode == 'RGB'
+        
+        transparent_path = os.path.join(tmp, 'transparent.gif')
+        clear = []
+        for i in range(3):
+            frame = Image.new('RGBA', (120, 80), (0, 0, 0, 0))
+            ImageDraw.Draw(frame).rectangle([i * 15, 10, i * 15 + 20, 40], fill='red')
+            clear.append(frame)
+        clear[0].save(transparent_path, save_all=True, append_images=clear[1:])
+        transparent = ImageProcessor()
+        assert transparent.load_from_file(transparent_path)
+        info = transparent.get_image_info()
+        assert info['mode'] == 'RGBA' and info['has_transparency']
+    print("   多帧图像测试: 成功")
+
+
+def test_session_manager():
+    """
+    测试多会话并发访问
+    """
+    print("\n=== 测试会话管理 ===")
+    import threading
+    from session_manager import SessionManager
+    
+    manager = SessionManager(max_workers=4)
+    image_data = create_test_image()
+    sessions = [manager.create_session() for _ in range(4)]
+    for session_id in sessions:
+        assert manager.call(session_id, 'load_from_base64', image_data)
+    
+    # 每个会话由独立线程并发编辑，会话之间互不影响
+    print("1. 测试并发编辑...")
+    def client(index, session_id):
+        for i in range(index + 1):
+            assert manager.submit(session_id, 'rotate', 90).result()
+            assert manager.submit(session_id, 'draw_line', 0, 0, 50, 50, 'red').result()
+    
+    threads = [threading.Thread(target=client, args=(i, s)) for i, s in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    for index, session_id in enumerate(sessions):
+        info = manager.call(session_id, 'get_image_info')
+        expected = (300, 400) if (index + 1) % 2 else (400, 300)
+        assert (info['width'], info['height']) == expected
+        assert len(manager.call(session_id, 'get_annotations')) == 1
+        assert manager.submit(session_id, 'to_base64', 'JPEG', 80).result()
+    
+    # 关闭后的会话不再接受调用
+    print("2. 测试关闭会话...")
+    assert manager.close_session(sessions[0])
+    try:
+        manager.call(sessions[0], 'get_image_info')
+        assert False
+    except KeyError:
+        pass
+    manager.shutdown()
+    
+    # 关闭会话时后台预编码线程随之退出
+    print("3. 测试关闭会话释放预编码线程...")
+    import tempfile
+    manager = SessionManager(max_workers=2,
+                             processor_factory=lambda: ImageProcessor(pre_encode_delay=0.01))
+    session_id = manager.create_session()
+    with tempfile.TemporaryDirectory() as tmp:
+        assert manager.call(session_id, 'load_from_base64', image_data)
+        assert manager.call(session_id, 'save_to_file', os.path.join(tmp, 'out.png'))
+        assert manager.call(session_id, 'rotate', 90)
+    pre_encoder = manager._get(session_id).processor._pre_encoder
+    assert pre_encoder.wait_idle(5)
+    worker = pre_encoder._thread
+    assert worker is not None and worker.is_alive() and worker.name == 'pre-encoder'
+    manager.shutdown()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert pre_encoder._pending is None and pre_encoder._result is None
+    print("   会话管理测试: 成功")
+
+
+def test_clipboard_watcher():
+    """
+    测试剪贴板监听的去重与交付
+    """
+    print("\n=== 测试剪贴板监听 ===")
+    import base64
+    import tempfile
+    import clipboard_watcher
+    from clipboard_watcher import ClipboardWatcher
+    
+    png_data = base64.b64decode(create_test_image().split(',')[1])
+    received = []
+    watcher = ClipboardWatcher(received.append)
+    
+    # 相同内容只交付一次
+    print("1. 测试内容去重...")
+    assert watcher.deliver(png_data, 'image/png')
+    assert not watcher.deliver(png_data, 'image/png')
+    assert len(received) == 1
+    
+    # 交付的是原始字节，可直接加载或写为原始帧
+    print("2. 测试交付...")
+    image = received[0]
+    assert image.data is png_data
+    processor = ImageProcessor()
+    assert processor.load_from_bytes(image.data)
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_path = image.save(tmp, raw=True)
+        loaded = ImageProcessor()
+        assert loaded.load_from_file(raw_path)
+        assert loaded.image.convert('RGB').tobytes() == processor.image.convert('RGB').tobytes()
+        png_path = image.save(tmp)
+        assert png_path.endswith('.png')
+        # 写入使用唯一的临时文件，不留下残留文件
+        assert sorted(os.listdir(tmp)) == sorted([os.path.basename(raw_path), os.path.basename(png_path)])
+        del loaded
+    
+    # 真实的X11事件需要显示服务器和设置剪贴板的工具
+    print("3. 测试XFixes事件监听...")
+    import shutil
+    import subprocess
+    xvfb = None
+    display = os.environ.get('DISPLAY')
+    if not display and shutil.which('Xvfb'):
+        read_fd, write_fd = os.pipe()
+        xvfb = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd), '-nolisten', 'tcp'],
+                                pass_fds=(write_fd,), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            number = f.readline().strip()
+        display = f":{number}" if number else None
+    try:
+        if not display or not shutil.which('xclip'):
+            print("   未检测到Xvfb/X11显示或xclip，跳过事件监听测试")
+        else:
+            old_display = os.environ.get('DISPLAY')
+            os.environ['DISPLAY'] = display
+            try:
+                if not clipboard_watcher.is_available():
+                    print("   X11或XFixes库不可用，跳过事件监听测试")
+                else:
+                    import threading
+                    delivered = []
+                    event = threading.Event()
+                    watcher = ClipboardWatcher(lambda image: (delivered.append(image), event.set()),
+                                               display=display)
+                    watcher.start()
+                    try:
+                        with tempfile.NamedTemporaryFile(suffix='.png') as f:
+                            f.write(png_data)
+                            f.flush()
+                            # xclip在后台持有选区，直到被其他所有者取代
+                            subprocess.run(['xclip', '-selection', 'clipboard', '-t', 'image/png',
+                                            '-i', f.name], check=True, timeout=10)
+                        assert event.wait(10), "未收到剪贴板图像"
+                    finally:
+                        watcher.stop(5)
+                        subprocess.run(['xclip', '-selection', 'clipboard', '-i', '/dev/null'],
+                                       timeout=10)
+                    assert delivered[0].mime == 'image/png'
+                    assert delivered[0].data == png_data
+            finally:
+                if old_display is None:
+                    os.environ.pop('DISPLAY', None)
+                else:
+                    os.environ['DISPLAY'] = old_display
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait(10)
+    print("   剪贴板监听测试: 成功")
+
+
+def test_target_size():
+    """
+    测试目标文件大小模式
+    """
+    print("\n=== 测试目标文件大小 ===")
+    import base64
+    import os
+    import random
+    import tempfile
+    from io import BytesIO
+    
+    rng = random.Random(2)
+    img = Image.new('RGB', (800, 600), 'white')
+    draw = ImageDraw.Draw(img)
+    for _ in range(200):
+        x, y = rng.randrange(800), rng.randrange(600)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse([x, y, x + rng.randrange(150), y + rng.randrange(150)], fill=color)
+    processor = ImageProcessor()
+    processor.image = img
+    processor.original_image = img
+    processor._init_history()
+    
+    def jpeg_size(quality):
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', quality=quality)
+        return buffer.tell()
+    
+    # 选出满足上限的最高质量
+    print("1. 测试JPEG质量查找...")
+    max_bytes = jpeg_size(60) + 1
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'out.jpg')
+        assert processor.save_to_file(path, 'JPEG', 95, max_bytes)
+        search = processor.last_size_search
+        print(f"   质量 {search['quality']}，{search['size']} 字节，编码 {search['encodes']} 次 / {search['rounds']} 轮")
+        assert os.path.getsize(path) == search['size'] <= max_bytes
+        assert jpeg_size(search['quality']) <= max_bytes < jpeg_size(search['quality'] + 1)
+    
+    # 上限足够时直接使用给定质量
+    assert processor.to_base64('JPEG', 80, jpeg_size(80))
+    assert processor.last_size_search['quality'] == 80
+    
+    # PNG超出上限时改用调色板
+    print("2. 测试PNG调色板查找...")
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    max_bytes = buffer.tell() - 1
+    data = processor.to_base64('PNG', 95, max_bytes)
+    assert data and processor.last_size_search['colors'] in (2, 4, 8, 16, 32, 64, 128, 256)
+    encoded = base64.b64decode(data.split(',')[1])
+    assert len(encoded) <= max_bytes
+    assert Image.open(BytesIO(encoded)).mode == 'P'
+    
+    # 任何质量都无法满足时失败并报告最小大小
+    print("3. 测试无法满足的上限...")
+    assert processor.to_base64('JPEG', 95, 100) is None
+    assert not processor.last_size_search['fits']
+    assert processor.last_size_search['size'] > 100
+    print("   目标文件大小测试: 成功")
+
+
+def test_result_cache():
+    """
+    测试命令结果缓存
+    """
+    print("\n=== 测试命令结果缓存 ===")
+    import base64
+    import tempfile
+    from result_cache import ResultCache, result_key
+    
+    source = base64.b64decode(create_test_image().split(',')[1])
+    
+    # 缓存键只包含影响结果的参数
+    print("1. 测试缓存键规范化...")
+    key = result_key(source, 'crop', {'x': 1, 'y': 2}, ('PNG', 0))
+    assert key == result_key(source, 'crop', {'y': 2, 'x': 1}, ('JPEG', 80))
+    assert key != result_key(source + b'\0', 'crop', {'x': 1, 'y': 2}, ('PNG', 0))
+    assert (result_key(source, 'save', {}, ('JPEG', 80))
+            != result_key(source, 'save', {}, ('JPEG', 90)))
+    assert (result_key(source, 'save', {}, ('PNG', 0))
+            != result_key(source, 'save', {}, ('PNG', 0), to_file=True))
+    
+    processor = ImageProcessor()
+    processor.load_from_bytes(source)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ResultCache(os.path.join(tmp, 'results'))
+        
+        # Base64结果以原始字节保存，读取时重建
+        print("2. 测试Base64结果...")
+        key = result_key(source, 'save', {}, ('PNG', 0))
+        assert cache.get(key) is None
+        result = {'base64': processor.to_base64('PNG'), 'success': True}
+        cache.put(key, result)
+        assert cache.get(key) == result
+        
+        # 文件结果在命中时写到本次的输出路径
+        print("3. 测试文件结果...")
+        key = result_key(source, 'save', {}, ('JPEG', 85), to_file=True)
+        first = os.path.join(tmp, 'first.jpg')
+        processor.save_to_file(first, 'JPEG', 85)
+        cache.put(key, {'success': True}, first)
+        second = os.path.join(tmp, 'out', 'second.jpg')
+        assert cache.get(key, second) == {'success': True}
+        with open(first, 'rb') as a, open(second, 'rb') as b:
+            assert a.read() == b.read()
+        assert cache.get(key) is None
+        
+        # 非保存命令不读取也不覆盖--output上的文件
+        print("4. 测试非保存命令的输出路径...")
+        import subprocess
+        input_path = os.path.join(tmp, 'input.png')
+        with open(input_path, 'wb') as f:
+            f.write(source)
+        output_path = os.path.join(tmp, 'unrelated.bin')
+        env = dict(os.environ, XDG_CACHE_HOME=tmp, LOCALAPPDATA=tmp)
+        for content in (b'first', b'second'):
+            with open(output_path, 'wb') as f:
+                f.write(content)
+            completed = subprocess.run([
+                sys.executable, 'image_processor.py', 'crop', '--input', input_path,
+                '--output', output_path, '--cache',
+                '--params', json.dumps({'x': 0, 'y': 0, 'width': 100, 'height': 100})
+            ], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+            response = json.loads(completed.stdout)
+            assert response['success']
+            with open(output_path, 'rb') as f:
+                assert f.read() == content
+        assert response.get('cached')
+        
+        # 被篡改或格式不符的条目不会写到输出路径
+        print("5. 测试条目校验...")
+        key = result_key(source, 'save', {}, ('PNG', 0), to_file=True)
+        png_path = os.path.join(tmp, 'first.png')
+        processor.save_to_file(png_path, 'PNG')
+        cache.put(key, {'success': True}, png_path)
+        target = os.path.join(tmp, 'target.png')
+        assert cache.get(key, target, 'JPEG') is None
+        assert not os.path.exists(target)
+        assert cache.get(key, target, 'PNG') == {'success': True}
+        entry_path = cache._cache._path_for(key)
+        with open(entry_path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xFF]))
+        assert cache.get(key, os.path.join(tmp, 'tampered.png'), 'PNG') is None
+        assert not os.path.exists(os.path.join(tmp, 'tampered.png'))
+        
+        # 缓存目录位于用户目录下，其他用户可写的目录拒绝使用
+        print("6. 测试缓存目录权限...")
+        import disk_cache
+        old_xdg = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(tmp, 'xdg')
+        try:
+            if os.name != 'nt':
+                assert disk_cache.default_cache_dir('results').startswith(os.path.join(tmp, 'xdg'))
+                default = ResultCache()
+                for path in (disk_cache.user_cache_root(), default._cache.directory):
+                    assert os.stat(path).st_mode & 0o777 == 0o700
+                shared = os.path.join(tmp, 'shared')
+                os.mkdir(shared)
+                os.chmod(shared, 0o777)
+                try:
+                    ResultCache(shared)
+                    assert False, "应拒绝其他用户可写的缓存目录"
+                except PermissionError:
+                    pass
+        finally:
+            if old_xdg is None:
+                os.environ.pop('XDG_CACHE_HOME', None)
+            else:
+                os.environ['XDG_CACHE_HOME'] = old_xdg
+    print("   命令结果缓存测试: 成功")
+
+
+def test_memory_budget():
+    """
+    测试内存预算与缩小的工作副本
+    """
+    print("\n=== 测试内存预算 ===")
+    import tempfile
+    from io import BytesIO
+    
+    img = Image.linear_gradient('L').resize((1200, 800)).convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    data = buffer.getvalue()
+    
+    # 未超出预算时完整加载，工作图像与原图共享
+    print("1. 测试预算内加载...")
+    processor = ImageProcessor()
+    assert processor.load_from_bytes(data)
+    assert processor.image.size == (1200, 800) and processor.load_notice is None
+    assert processor.original_image is processor.image
+    
+    # 超出预算时编辑缩小的副本
+    print("2. 测试超出预算加载...")
+    processor = ImageProcessor(memory_budget=1024 * 1024)
+    assert processor.load_from_bytes(data)
+    notice = processor.load_notice
+    print(f"   {notice['message']}")
+    assert notice['action'] == 'downscaled' and notice['original_width'] == 1200
+    assert processor.image.width * processor.image.height * 4 <= 1024 * 1024
+    assert processor.get_image_info()['width'] == notice['width'] < 1200
+    
+    # 保存时按原始分辨率重放操作
+    print("3. 测试原始分辨率输出...")
+    scale = notice['scale']
+    assert processor.crop(0, 0, round(600 / scale), round(400 / scale))
+    assert processor.rotate(90)
+    assert processor.draw_rectangle(5, 5, 20, 20, 'red', None, 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'full.png')
+        assert processor.save_to_file(path, 'PNG')
+        with Image.open(path) as saved:
+            assert saved.size == (400, 600)
+            assert saved.convert('RGB').getpixel((round(5 * scale), round(12 * scale))) == (255, 0, 0)
+    
+    # 两个方向分别取整时按各自的比例映射标注
+    print("4. 测试两个方向的缩放比例...")
+    buffer = BytesIO()
+    Image.new('RGB', (1207, 801), 'white').save(buffer, format='JPEG', quality=95)
+    processor = ImageProcessor(memory_budget=64 * 1024)
+    assert processor.load_from_bytes(buffer.getvalue())
+    notice = processor.load_notice
+    assert notice['scale'] == round(1207 / processor.image.width, 4)
+    assert notice['scale_y'] == round(801 / processor.image.height, 4)
+    assert abs(notice['scale'] - notice['scale_y']) > 0.05
+    width, height = processor.image.size
+    assert processor.draw_rectangle(width - 11, height - 11, width - 6, height - 6, 'red', 'red', 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'full.png')
+        assert processor.save_to_file(path, 'PNG')
+        with Image.open(path) as saved:
+            marked = Image.eval(saved.convert('L'), lambda v: 255 - v).getbbox()
+    assert marked[:2] == (round((width - 11) * notice['scale']), round((height - 11) * notice['scale_y']))
+    
+    # 多帧图像按原始分辨率逐帧保存，单帧超出预算时拒绝加载
+    print("5. 测试多帧图像的内存预算...")
+    buffer = BytesIO()
+    frames = [Image.new('RGB', (400, 300), color) for color in ('red', 'blue')]
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:])
+    processor = ImageProcessor(memory_budget=64 * 1024)
+    assert not processor.load_from_bytes(buffer.getvalue())
+    assert '多帧' in processor.load_error
+    assert ImageProcessor(memory_budget=1024 * 1024).load_from_bytes(buffer.getvalue())
+    
+    # 无法在解码阶段缩小的格式超出预算时拒绝加载，峰值内存不随完整解码增长
+    print("6. 测试PNG的峰值内存...")
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is None:
+        print("   当前平台不支持getrusage，跳过峰值内存测试")
+    else:
+        import zlib
+        import struct
+        import subprocess
+        
+        def chunk(kind, body):
+            return (struct.pack('>I', len(body)) + kind + body
+                    + struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff))
+        
+        # 6000x6000的RGB图像完整解码约需144MB，逐行压缩生成，测试本身不占用这么多内存
+        width = height = 6000
+        compressor = zlib.compressobj()
+        row = b'\0' * (1 + width * 3)
+        idat = b''.join(compressor.compress(row) for _ in range(height)) + compressor.flush()
+        png = (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+               + chunk(b'IDAT', idat) + chunk(b'IEND', b''))
+        script = (
+            "import sys, json, resource, tracing\n"
+            "from image_processor import ImageProcessor\n"
+            "processor = ImageProcessor(memory_budget=16 * 1024 * 1024)\n"
+            "loaded = processor.load_from_file(sys.argv[1]) if sys.argv[2] == 'load' else None\n"
+            "rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * tracing.MAX_RSS_UNIT\n"
+            "print(json.dumps({'loaded': loaded, 'error': processor.load_error, 'rss': rss}))\n")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'large.png')
+            with open(path, 'wb') as f:
+                f.write(png)
+            runs = {}
+            for mode in ('idle', 'load'):
+                completed = subprocess.run([sys.executable, '-c', script, path, mode],
+                                           capture_output=True, text=True,
+                                           cwd=os.path.dirname(os.path.abspath(__file__)))
+                runs[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"   {runs['load']['error']}")
+        assert runs['load']['loaded'] is False and '拒绝加载' in runs['load']['error']
+        peak = runs['load']['rss'] - runs['idle']['rss']
+        print(f"   加载增加的峰值内存: {peak // (1024 * 1024)}MB")
+        assert peak < 32 * 1024 * 1024
+    
+    # 超出解压炸弹保护上限时给出明确的错误
+    print("7. 测试解压炸弹保护...")
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = 1000
+    try:
+        processor = ImageProcessor()
+        assert not processor.load_from_bytes(data)
+        assert '解压炸弹' in processor.load_error
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+    print("   内存预算测试: 成功")
+
+
+def test_tracing():
+    """
+    测试性能追踪导出
+    """
+    print("\n=== 测试性能追踪 ===")
+    import tempfile
+    import tracing
+    
+    assert not tracing.enabled()
+    tracing.enable(memory=True)
+    try:
+        processor = ImageProcessor()
+        processor.load_from_base64(create_test_image())
+        processor.crop(10, 10, 200, 150)
+        processor.to_base64('JPEG', 80)
+    finally:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.json')
+            tracing.save(path)
+            with open(path, encoding='utf-8') as f:
+                events = json.load(f)['traceEvents']
+    
+    assert not tracing.enabled()
+    spans = {e['name'] for e in events if e['ph'] == 'X'}
+    print(f"   记录的区间: {sorted(spans)}")
+    for name in ('ImageProcessor.load_from_bytes', 'decode', 'ImageProcessor.crop',
+                 'history.push', 'encode'):
+        assert name in spans
+    assert any(e['ph'] == 'C' and e['name'] == 'tracemalloc' for e in events)
+    # 峰值常驻内存按平台换算为字节，应在合理范围内
+    max_rss = [e['args']['bytes'] for e in events if e['ph'] == 'C' and e['name'] == 'max_rss']
+    assert all(1024 * 1024 <= value < 64 * 1024 ** 3 for value in max_rss)
+    assert all(e['dur'] >= 0 for e in events if e['ph'] == 'X')
+    print("   性能追踪测试: 成功")
+
+
+def test_text_stamp_cache():
+    """
+    测试文字蒙版缓存
+    """
+    print("\n=== 测试文字蒙版缓存 ===")
+    from annotation_layer import StampCache, TextAnnotation, load_font, get_stamp_cache
+    
+    # 多个处理器重复添加同一文字，只栅格化一次，不同颜色共享蒙版
+    cache = get_stamp_cache()
+    cache.clear()
+    before = cache.stats()
+    for color in ('red', 'red', '#0000ff80'):
+        processor = ImageProcessor()
+        processor.load_from_base64(create_test_image())
+        processor.add_text("Watermark", 40, 60, 28, color)
+        # 与直接用ImageDraw.text绘制的结果逐像素一致
+        expected = processor.image.copy()
+        ImageDraw.Draw(expected).text((40, 60), "Watermark", fill=color, font=load_font(None, 28))
+        assert processor.layer.composite(processor.image).tobytes() == expected.tobytes()
+    stats = cache.stats()
+    print(f"   缓存统计: {stats}")
+    assert stats['misses'] - before['misses'] == 1
+    assert stats['hits'] - before['hits'] >= 2
+    
+    # 超出字节预算时淘汰最久未使用的蒙版
+    small = StampCache(max_bytes=1)
+    small.get("a", None, 12)
+    assert small.stats()['entries'] == 0
+    sizes = [stamp.width * stamp.height
+             for stamp, _ in (StampCache().get(text, None, 20) for text in ("one", "two"))]
+    lru = StampCache(max_bytes=sum(sizes) - 1)
+    for text in ("one", "two", "one"):
+        lru.get(text, None, 20)
+    assert lru.stats()['entries'] == 1 and lru.stats()['misses'] == 3
+    
+    # 空文字不绘制
+    empty = TextAnnotation(annotation_id=1, text='')
+    region = Image.new('RGBA', (10, 10), (0, 0, 0, 0))
+    empty.render(ImageDraw.Draw(region))
+    assert region.getbbox() is None
+    print("   文字蒙版缓存测试: 成功")
+
+
+def test_batch_convert():
+    """
+    测试文件夹批量转换
+    """
+    print("\n=== 测试文件夹批量转换 ===")
+    import tempfile
+    from batch_convert import MANIFEST_NAME, BatchConverter
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'screenshots')
+        output = os.path.join(tmp, 'converted')
+        os.makedirs(os.path.join(source, 'sub'))
+        image = Image.new('RGB', (320, 200), 'white')
+        ImageDraw.Draw(image).rectangle([40, 40, 200, 160], fill='blue')
+        for name in ('a.png', 'b.bmp', 'b.png', os.path.join('sub', 'c.png')):
+            image.save(os.path.join(source, name))
+        with open(os.path.join(source, 'broken.png'), 'wb') as f:
+            f.write(b'not an image')
+        
+        # 队列容量为1时流水线仍能完成，单个图像失败不影响其他图像
+        print("1. 测试转换...")
+        converter = BatchConverter('JPEG', 80, readers=1, workers=2, writers=1, queue_size=1,
+                                   recursive=True)
+        report = converter.run(source, output)
+        print(f"   报告: 转换{report['converted']}, 失败{report['failed']}, 瓶颈{report['bottleneck']}")
+        assert (report['found'], report['converted'], report['failed']) == (5, 4, 1)
+        assert report['errors'][0]['source'] == 'broken.png'
+        assert set(report['stages']) == {'read', 'process', 'write'}
+        assert report['stages']['write']['images'] == 4
+        for name in ('a.jpg', 'b.jpg', 'b_png.jpg', os.path.join('sub', 'c.jpg')):
+            with Image.open(os.path.join(output, name)) as converted:
+                assert converted.format == 'JPEG' and converted.size == (320, 200)
+        
+        # 再次运行时跳过已完成的图像，源文件变化后重新转换
+        print("2. 测试断点续传...")
+        report = converter.run(source, output)
+        assert (report['converted'], report['skipped'], report['failed']) == (0, 4, 1)
+        image.rotate(90, expand=True).save(os.path.join(source, 'a.png'))
+        report = converter.run(source, output)
+        assert (report['converted'], report['skipped']) == (1, 3)
+        with Image.open(os.path.join(output, 'a.jpg')) as converted:
+            assert converted.size == (200, 320)
+        with open(os.path.join(output, MANIFEST_NAME), encoding='utf-8') as f:
+            assert len(f.readlines()) == 5
+        
+        # 设置变化时全部重新转换，水印绘制在右下角
+        print("3. 测试水印...")
+        marked = BatchConverter('PNG', workers=1, recursive=True, watermark='test',
+                                watermark_color='red')
+        report = marked.run(source, output)
+        assert report['converted'] == 4
+        with Image.open(os.path.join(output, 'sub', 'c.png')) as converted:
+            assert converted.crop((160, 150, 320, 200)).getcolors() != [(160 * 50, (255, 255, 255))]
+            assert converted.getpixel((0, 0)) == (255, 255, 255)
+        
+        # 默认的半透明水印在RGB图像上与底图混合，而不是按不透明颜色绘制
+        print("4. 测试半透明水印...")
+        dark = os.path.join(tmp, 'dark')
+        os.makedirs(dark)
+        Image.new('RGB', (320, 200), 'black').save(os.path.join(dark, 'd.png'))
+        report = BatchConverter('PNG', workers=1, watermark='test').run(dark, os.path.join(tmp, 'dark_out'))
+        assert report['converted'] == 1
+        with Image.open(os.path.join(tmp, 'dark_out', 'd.png')) as converted:
+            assert converted.mode == 'RGB'
+            extrema = converted.crop((160, 150, 320, 200)).convert('L').getextrema()
+            # 白色按0xa0的透明度混合到黑色上，最亮约为160
+            assert 0 < extrema[1] <= 0xa0 + 1
+    print("   文件夹批量转换测试: 成功")
+
+
 def main():
     """
     主测试函数
@@ -181,6 +1522,26 @@ def main():
         if success:
             # 测试命令行接口
             test_command_line_interface()
+            test_thumbnail()
+            test_annotation_layer()
+            test_dirty_patch()
+            test_request_scheduler()
+            test_parallel_rotate()
+            test_raw_frame()
+            test_tiered_history()
+            test_estimate_size()
+            test_pre_encode()
+            test_save_queue()
+            test_derived_cache()
+            test_multi_frame()
+            test_session_manager()
+            test_clipboard_watcher()
+            test_target_size()
+            test_result_cache()
+            test_memory_budget()
+            test_tracing()
+            test_text_stamp_cache()
+            test_batch_convert()
         
         print("\n测试完成！")
         
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能追踪模块
+
+功能描述：
+- 记录命令行调用中参数解析、模块导入、解码、各项图像操作、历史记录、编码和写入的耗时区间
+- 可选地用tracemalloc按固定间隔采样内存占用，结束时附带分配最多的代码位置；
+  Pillow的像素缓冲区不经过Python分配器，同时记录进程的峰值常驻内存
+- 导出为Chrome trace event格式的JSON，可在chrome://tracing或Perfetto中以火焰图查看
+- 默认关闭，关闭时span()返回空上下文，开销可以忽略
+
+作者：AI Assistant
+版本：1.0.0
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Optional, Dict, Any, Callable, ContextManager, Iterator, List, TypeVar
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+
+# 设置为输出文件路径时启用追踪
+TRACE_ENV = 'PICFROMCLIPBOARD_TRACE'
+
+# 设置为1、true、yes或on时同时采样内存
+TRACE_MEMORY_ENV = 'PICFROMCLIPBOARD_TRACE_MEMORY'
+
+# 内存采样的默认间隔（秒）
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+# ru_maxrss的单位：macOS上为字节，Linux等其他系统上为KB
+MAX_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# 结束时记录的分配最多的代码位置数量
+TOP_ALLOCATIONS = 20
+
+# 时间戳的零点：本模块被导入的时刻，早于其他模块的导入
+ORIGIN = time.perf_counter_ns()
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+def now() -> int:
+    """
+    获取当前时间戳，用于在启用追踪之前记录区间
+
+    返回：
+        纳秒时间戳
+    """
+    return time.perf_counter_ns()
+
+
+class Tracer:
+    """追踪记录类
+
+    以Chrome trace event格式保存事件，所有方法都持有锁，可在多个线程中调用。
+    """
+
+    def __init__(self, memory: bool = False,
+                 memory_interval: float = MEMORY_SAMPLE_INTERVAL) -> None:
+        """
+        初始化追踪记录
+
+        参数：
+            memory: 是否用tracemalloc采样内存
+            memory_interval: 内存采样间隔（秒）
+
+        异常：
+            无
+        """
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._threads: Dict[int, str] = {}
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self.memory = memory
+        if memory:
+            tracemalloc.start()
+            self._sampler = threading.Thread(target=self._sample, args=(memory_interval,),
+                                             name='trace-memory', daemon=True)
+            self._sampler.start()
+
+    def add_span(self, name: str, category: str, start: int, end: int,
+                 args: Optional[Dict[str, Any]] = None) -> None:
+        """
+        记录一个已结束的区间
+
+        参数：
+            name: 区间名称
+            category: 分类，如'decode'、'encode'
+            start: 开始时间戳（纳秒，来自now()）
+            end: 结束时间戳
+            args: 附加信息
+        """
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': (start - ORIGIN) / 1000, 'dur': (end - start) / 1000}
+        if args:
+            event['args'] = args
+        self._add(event)
+
+    def counter(self, name: str, values: Dict[str, float]) -> None:
+        """
+        记录计数器的当前值
+
+        参数：
+            name: 计数器名称
+            values: 各序列的值
+        """
+        self._add({'name': name, 'ph': 'C', 'ts': (now() - ORIGIN) / 1000, 'args': values})
+
+    def instant(self, name: str, args: Optional[Dict[str, Any]] = None) -> None:
+        """
+        记录一个瞬时事件
+
+        参数：
+            name: 事件名称
+            args: 附加信息
+        """
+        event = {'name': name, 'ph': 'i', 's': 'p', 'ts': (now() - ORIGIN) / 1000}
+        if args:
+            event['args'] = args
+        self._add(event)
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        停止内存采样并生成trace event文档
+
+        返回：
+            包含traceEvents的字典
+        """
+        if self.memory and tracemalloc.is_tracing():
+            self._stop.set()
+            if self._sampler is not None:
+                self._sampler.join()
+            snapshot = tracemalloc.take_snapshot()
+            top = snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+            self.instant('top_allocations', {
+                str(stat.traceback): {'size': stat.size, 'count': stat.count} for stat in top
+            })
+            self._sample_once()
+            tracemalloc.stop()
+
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                         'args': {'name': name}} for tid, name in self._threads.items()]
+            return {'traceEvents': metadata + list(self.events), 'displayTimeUnit': 'ms'}
+
+    def _add(self, event: Dict[str, Any]) -> None:
+        thread = threading.current_thread()
+        event['pid'] = self._pid
+        event['tid'] = thread.ident
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    def _sample(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self._sample_once()
+
+    def _sample_once(self) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        self.counter('tracemalloc', {'current': current, 'peak': peak})
+        if resource is not None:
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.counter('max_rss', {'bytes': max_rss * MAX_RSS_UNIT})
+
+
+_tracer: Optional[Tracer] = None
+_disabled = nullcontext()
+
+
+def enable(memory: bool = False) -> Tracer:
+    """
+    启用进程内追踪
+
+    参数：
+        memory: 是否用tracemalloc采样内存
+
+    返回：
+        追踪记录
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(memory)
+    return _tracer
+
+
+def enabled() -> bool:
+    """
+    检查是否已启用追踪
+
+    返回：
+        是否启用
+    """
+    return _tracer is not None
+
+
+def env_settings() -> Dict[str, Any]:
+    """
+    读取环境变量中的追踪设置
+
+    返回：
+        包含path（未设置时为None）和memory的字典
+    """
+    return {
+        'path': os.environ.get(TRACE_ENV) or None,
+        'memory': os.environ.get(TRACE_MEMORY_ENV, '').strip().lower() in ('1', 'true', 'yes', 'on')
+    }
+
+
+def add_span(name: str, category: str, start: int, end: int, **args: Any) -> None:
+    """
+    记录一个已结束的区间，未启用追踪时忽略
+
+    参数：
+        name: 区间名称
+        category: 分类
+        start: 开始时间戳（纳秒，来自now()）
+        end: 结束时间戳
+        **args: 附加信息
+    """
+    if _tracer is not None:
+        _tracer.add_span(name, category, start, end, args)
+
+
+def span(name: str, category: str = 'op', **args: Any) -> ContextManager[None]:
+    """
+    记录with块的耗时
+
+    参数：
+        name: 区间名称
+        category: 分类
+        **args: 附加信息
+
+    返回：
+        上下文管理器，未启用追踪时为空上下文
+    """
+    if _tracer is None:
+        return _disabled
+    return _span(_tracer, name, category, args)
+
+
+@contextmanager
+def _span(tracer: Tracer, name: str, category: str, args: Dict[str, Any]) -> Iterator[None]:
+    start = now()
+    try:
+        yield
+    finally:
+        tracer.add_span(name, category, start, now(), args)
+
+
+def traced(category: str = 'op', name: Optional[str] = None) -> Callable[[F], F]:
+    """
+    记录函数每次调用耗时的装饰器
+
+    参数：
+        category: 分类
+        name: 区间名称，为None时使用函数的限定名，如'ImageProcessor.crop'
+
+    返回：
+        装饰器
+    """
+    def decorator(func: F) -> F:
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _span(_tracer, label, category, {}):
+                return func(*args, **kwargs)
+        return wrapper  # type: ignore[return-value]
+    return decorator
+
+
+def save(path: str) -> None:
+    """
+    结束追踪并写出trace event文件
+
+    参数：
+        path: 输出文件路径
+
+    异常：
+        OSError: 当文件无法写入时抛出
+    """
+    global _tracer
+    if _tracer is None:
+        return
+    document = _tracer.finish()
+    _tracer = None
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(document, f)
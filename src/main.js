@@ -131,6 +131,15 @@ ipcMain.handle('python:execute', async (event, command, options = {}) => {
     if (options.quality) {
       args.push('--quality', options.quality.toString());
     }
+    if (options.maxBytes) {
+      args.push('--max-bytes', options.maxBytes.toString());
+    }
+    if (options.cache) {
+      args.push('--cache');
+    }
+    if (options.trace) {
+      args.push('--trace', options.trace);
+    }
     if (options.params) {
       args.push('--params', JSON.stringify(options.params));
     }